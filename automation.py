@@ -0,0 +1,186 @@
+"""Rule tables for routines the agent runs on its own (the runRoutine action).
+
+A routine is a list of rules checked in order against each fresh hierarchy
+dump; the first one that applies fires. A rule is a dict:
+
+    "name":       reported in progress events
+    "phase":      only applies in this phase (or list of phases); none = any
+    "when":       screen condition, as UiSnapshot.matches ({} always holds)
+    "after":      only applies once this timer has run out
+    "do":         a command dict run like a batch step, e.g.
+                  {"action": "clickText", "text": "Connect"}
+    "startTimer": start this timer (its length must be in the durations)
+    "goto":       switch to this phase afterwards
+    "finish":     the routine is done once this rule has fired
+
+    routine = Routine(SCAN_ROUTINE, {"scan": 600})
+    rule = routine.next_rule(snapshot)
+    ... run rule["do"] ...
+    routine.fired(rule)
+"""
+
+import time
+
+# How many times in a row one rule may fire before the routine gives up on
+# it (the tap isn't having any effect).
+MAX_REPEATS = 5
+
+# The Deeper scan workflow the dashboard used to drive from scan.dart: get
+# past the dialogs, connect and start a boat scan, wait out the scan timer,
+# restart the app, then sync the scans from History and close it. The sync
+# button is checked before History because the History screen shows that
+# title too.
+SCAN_ROUTINE = {
+    "start": "setup",
+    "rules": [
+        {
+            "name": "dismiss_update",
+            "when": {"textContains": "Update Available", "text": "Later"},
+            "do": {"action": "clickText", "text": "Later"},
+        },
+        {
+            "name": "navigate_without_map",
+            "when": {"text": "Navigate Without Map"},
+            "do": {"action": "clickText", "text": "Navigate Without Map"},
+        },
+        {
+            "name": "start_boat_scan",
+            "phase": "setup",
+            "when": {"description": "Boat scan icon"},
+            "do": {"action": "clickByDescription", "description": "Boat scan icon"},
+            "startTimer": "scan",
+            "goto": "scanning",
+        },
+        {
+            "name": "connect",
+            "phase": "setup",
+            "when": {"text": "Connect"},
+            "do": {"action": "clickText", "text": "Connect"},
+        },
+        {
+            "name": "cancel",
+            "phase": "setup",
+            "when": {"text": "Cancel"},
+            "do": {"action": "clickText", "text": "Cancel"},
+        },
+        {
+            "name": "scan_finished",
+            "phase": "scanning",
+            "after": "scan",
+            "do": {"action": "restart"},
+            "goto": "finishing",
+        },
+        {
+            "name": "sync_scans",
+            "phase": "finishing",
+            "when": {"resourceId": "syncScansButton"},
+            "do": {"action": "clickById", "resourceId": "syncScansButton"},
+            "goto": "synced",
+        },
+        {
+            "name": "open_history",
+            "phase": "finishing",
+            "when": {"text": "History"},
+            "do": {"action": "clickText", "text": "History"},
+        },
+        {
+            "name": "open_menu",
+            "phase": "finishing",
+            "when": {"description": "Fab Image"},
+            "do": {"action": "clickByDescription", "description": "Fab Image"},
+        },
+        {
+            "name": "close_app",
+            "phase": "synced",
+            "do": {"action": "close"},
+            "finish": True,
+        },
+    ],
+}
+
+ROUTINES = {"scan": SCAN_ROUTINE}
+
+
+class Routine:
+    """Where a routine is: its phase, running timers and recent firings."""
+
+    def __init__(self, spec, durations=None, max_repeats=MAX_REPEATS):
+        if isinstance(spec, str):
+            if spec not in ROUTINES:
+                raise ValueError(f"Unknown routine {spec!r}")
+            spec = ROUTINES[spec]
+        self.rules = spec["rules"]
+        self.phase = spec.get("start", "start")
+        self.durations = {
+            name: float(seconds) for name, seconds in (durations or {}).items()
+        }
+        for rule in self.rules:
+            name = rule.get("startTimer")
+            if name and name not in self.durations:
+                raise ValueError(f"No duration given for the {name!r} timer")
+        self.max_repeats = max_repeats
+        self.timers = {}
+        self.steps = 0
+        self.done = False
+        self.failed = None
+        self.last_rule = None
+        self.repeats = 0
+
+    def applies(self, rule, snapshot):
+        phase = rule.get("phase")
+        if phase is not None:
+            phases = [phase] if isinstance(phase, str) else phase
+            if self.phase not in phases:
+                return False
+        if rule.get("after") is not None and self.remaining(rule["after"]) != 0:
+            return False
+        return snapshot.matches(rule.get("when") or {})
+
+    def next_rule(self, snapshot):
+        """The first rule that applies to this screen, or None."""
+        for rule in self.rules:
+            if self.applies(rule, snapshot):
+                return rule
+        return None
+
+    def fired(self, rule):
+        """Record that rule's action ran.
+
+        Sets `failed` if the same rule has now fired max_repeats times in a
+        row, since its action evidently isn't changing the screen.
+        """
+        self.steps += 1
+        if rule is self.last_rule:
+            self.repeats += 1
+            if self.repeats >= self.max_repeats:
+                self.failed = (
+                    f"Rule {rule.get('name')!r} fired {self.repeats} times in a row"
+                )
+        else:
+            self.last_rule = rule
+            self.repeats = 1
+        if rule.get("startTimer"):
+            name = rule["startTimer"]
+            self.timers[name] = time.monotonic() + self.durations[name]
+        if rule.get("goto"):
+            self.phase = rule["goto"]
+        if rule.get("finish"):
+            self.done = True
+
+    def remaining(self, name):
+        """Seconds left on a timer; None if it hasn't been started."""
+        ends = self.timers.get(name)
+        if ends is None:
+            return None
+        return max(0.0, ends - time.monotonic())
+
+    def waiting(self):
+        """Whether a running timer still has time left."""
+        return any(self.remaining(name) for name in self.timers)
+
+    def snapshot(self):
+        return {
+            "phase": self.phase,
+            "steps": self.steps,
+            "timers": {name: round(self.remaining(name), 1) for name in self.timers},
+        }
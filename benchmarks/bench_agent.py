@@ -0,0 +1,320 @@
+"""End-to-end agent benchmark on a simulated phone.
+
+Starts the relay (server.py, optionally with extra latency and API Gateway's
+message size limit), runs remote_control's listener in a child process on a
+fake_device session, and has a controller play a scripted command mix
+against it. Reports commands/sec, end-to-end latency percentiles, bytes on
+the controller's wire, the agent's RSS and its own per-stage timings.
+
+    python benchmarks/bench_agent.py --mix navigate --commands 200
+    python benchmarks/bench_agent.py --mix dump --binary --relay-delay 40
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websockets
+
+import server
+
+# Command mixes, played in order and repeated. The navigate cycle leaves the
+# fake device on the screen it started from, so it can loop forever.
+MIXES = {
+    "tap": [{"action": "tap", "x": 540, "y": 1200}],
+    "dump": [{"action": "dumpUi"}],
+    "status": [{"action": "status"}],
+    "navigate": [
+        {"action": "clickText", "text": "Pause"},
+        {"action": "clickText", "text": "Resume"},
+        {"action": "clickByDescription", "description": "Fab Image"},
+        {"action": "clickByDescription", "description": "Fab Image"},
+    ],
+    "mixed": [
+        {"action": "clickText", "text": "Pause"},
+        {"action": "dumpUi"},
+        {"action": "clickText", "text": "Resume"},
+        {"action": "status"},
+        {"action": "clickById", "resourceId": "bottomBar"},
+        {"action": "tap", "x": 540, "y": 1200},
+        {"action": "ping"},
+    ],
+}
+START_SCREEN = "scan_live"
+API_GATEWAY_MESSAGE_LIMIT = 128 * 1024
+AGENT_ID = "bench-agent"
+CONTROLLER_ID = "bench-controller"
+
+
+async def start_relay(port, delay, max_message):
+    """server.py with each routed message held back by `delay` seconds."""
+    loop = asyncio.get_running_loop()
+    route = server.route
+    oversize = [0]
+
+    def delayed_route(sender, message):
+        if max_message and len(message) > max_message:
+            oversize[0] += 1
+        if delay:
+            loop.call_later(delay, route, sender, message)
+        else:
+            route(sender, message)
+
+    server.route = delayed_route
+    relay = await websockets.serve(server.handler, "127.0.0.1", port, max_size=None)
+    return relay, oversize
+
+
+def start_agent(url, args):
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--agent",
+        url,
+        "--latency-scale",
+        str(args.latency_scale),
+    ]
+    return subprocess.Popen(
+        command,
+        stdout=None if args.verbose else subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+
+
+async def run_agent(url, latency_scale):
+    import remote_control
+    from fake_device import fake_session
+
+    remote_control.SERVER_URL = f"{url}?deviceId={AGENT_ID}"
+    session = fake_session(screen=START_SCREEN, latency_scale=latency_scale, seed=1)
+    await remote_control.listen(
+        session, remote_control.RelayCursor(), remote_control.ConnectionHealth()
+    )
+
+
+def memory(pid):
+    """(rss, peak rss) of a process in MiB, from /proc."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+class Controller:
+    def __init__(self, ws):
+        self.ws = ws
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.waiting = {}
+        self.latencies = {}
+        self.statuses = {}
+
+    async def send(self, message):
+        text = json.dumps(message)
+        self.sent_bytes += len(text.encode("utf-8"))
+        await self.ws.send(text)
+
+    async def receive(self):
+        async for raw in self.ws:
+            self.received_bytes += len(raw)
+            if isinstance(raw, bytes):
+                continue  # binary UI frames follow their response
+            data = json.loads(raw)
+            if data.get("relayId") is not None:
+                await self.ws.send(
+                    json.dumps({"action": "ack", "relayId": data["relayId"]})
+                )
+            waiter = self.waiting.pop(data.get("id"), None)
+            if waiter is not None and data.get("action") != "uiStateChunk":
+                waiter.set_result(data)
+
+    async def request(self, command):
+        command_id = command["id"]
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting[command_id] = waiter
+        start = time.perf_counter()
+        await self.send(command)
+        reply = await waiter
+        ms = (time.perf_counter() - start) * 1000
+        self.latencies.setdefault(command["action"], []).append(ms)
+        key = (command["action"], reply.get("status") or "error")
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        return reply
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run(args):
+    relay, oversize = await start_relay(
+        args.port, args.relay_delay / 1000, args.max_message
+    )
+    url = f"ws://127.0.0.1:{args.port}/"
+    agent = start_agent(url, args)
+
+    try:
+        async with websockets.connect(
+            f"{url}?deviceId={CONTROLLER_ID}&role=controller", max_size=None
+        ) as ws:
+            controller = Controller(ws)
+            reader = asyncio.create_task(controller.receive())
+            ids = itertools.count()
+
+            # Wait for the agent process to reach the relay.
+            deadline = time.monotonic() + 30
+            while server.connected_clients.get(AGENT_ID) is None:
+                if time.monotonic() > deadline or agent.poll() is not None:
+                    raise SystemExit("Agent did not connect")
+                await asyncio.sleep(0.05)
+
+            extra = {
+                "sender": CONTROLLER_ID,
+                "deviceId": AGENT_ID,
+                "settleQuiet": args.settle_quiet,
+                "settleTimeout": args.settle_timeout,
+            }
+            if args.ui_diff:
+                extra["uiDiff"] = True
+            await controller.request(
+                {
+                    "action": "hello",
+                    "frames": ["binary" if args.binary else "json"],
+                    "id": next(ids),
+                    **extra,
+                }
+            )
+            controller.latencies.clear()
+            controller.statuses.clear()
+
+            commands = itertools.islice(itertools.cycle(MIXES[args.mix]), args.commands)
+
+            async def client():
+                for command in commands:
+                    await controller.request({**command, "id": next(ids), **extra})
+
+            rss_samples = []
+
+            async def sample_rss():
+                while True:
+                    rss_samples.append(memory(agent.pid)[0] or 0)
+                    await asyncio.sleep(0.2)
+
+            sampler = asyncio.create_task(sample_rss())
+            start = time.perf_counter()
+            await asyncio.gather(*(client() for _ in range(args.inflight)))
+            elapsed = time.perf_counter() - start
+            sampler.cancel()
+            latencies = [ms for v in controller.latencies.values() for ms in v]
+            per_action = {a: list(v) for a, v in controller.latencies.items()}
+
+            stats = await controller.request(
+                {"action": "stats", "id": next(ids), **extra}
+            )
+            rss, peak = memory(agent.pid)
+            reader.cancel()
+    finally:
+        agent.terminate()
+        agent.wait()
+        relay.close()
+        await relay.wait_closed()
+
+    print(
+        f"mix {args.mix}, {args.commands} commands, {args.inflight} in flight,"
+        f" relay delay {args.relay_delay:.0f} ms, latency scale {args.latency_scale}"
+    )
+    print(f"throughput   {len(latencies) / elapsed:.1f} commands/s ({elapsed:.2f}s)")
+    print(
+        f"latency ms   p50 {statistics.median(latencies):.1f}"
+        f"  p95 {percentile(latencies, 0.95):.1f}"
+        f"  p99 {percentile(latencies, 0.99):.1f}  max {max(latencies):.1f}"
+    )
+    for action, values in sorted(per_action.items()):
+        print(
+            f"  {action:<20} n={len(values):<5} p50 {statistics.median(values):8.1f}"
+            f"  p95 {percentile(values, 0.95):8.1f}"
+        )
+    print(
+        f"wire         sent {controller.sent_bytes / 1024:.1f} KiB,"
+        f" received {controller.received_bytes / 1024:.1f} KiB"
+        f" ({controller.received_bytes / max(1, len(latencies)) / 1024:.1f} KiB/command)"
+    )
+    if oversize[0]:
+        print(f"             {oversize[0]} messages over {args.max_message} bytes")
+    if rss is not None:
+        print(
+            f"agent RSS    {rss:.1f} MiB now, {max(rss_samples or [rss]):.1f} MiB"
+            f" sampled max, {peak:.1f} MiB peak"
+        )
+    print(
+        "statuses     "
+        + ", ".join(
+            f"{a}/{s}={n}"
+            for (a, s), n in sorted(controller.statuses.items())
+            if a != "stats"
+        )
+    )
+
+    print("agent stages (p50 / p95 ms)")
+    mix_actions = {command["action"] for command in MIXES[args.mix]}
+    for action, stages in sorted(stats.get("stats", {}).items()):
+        if action in mix_actions:
+            cells = "  ".join(
+                f"{stage} {s['p50_ms']:.1f}/{s['p95_ms']:.1f}"
+                for stage, s in sorted(stages.items())
+            )
+            print(f"  {action:<20} {cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agent", metavar="URL", help=argparse.SUPPRESS)
+    parser.add_argument("--mix", choices=sorted(MIXES), default="navigate")
+    parser.add_argument("--commands", type=int, default=100)
+    parser.add_argument("--inflight", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8797)
+    parser.add_argument(
+        "--relay-delay", type=float, default=0.0, help="one-way ms added per hop"
+    )
+    parser.add_argument(
+        "--max-message",
+        type=int,
+        default=API_GATEWAY_MESSAGE_LIMIT,
+        help="count messages over this size (API Gateway rejects them)",
+    )
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="multiplier for fake_device.LATENCY (0 for none)",
+    )
+    parser.add_argument("--settle-quiet", type=float, default=0.3)
+    parser.add_argument("--settle-timeout", type=float, default=3.0)
+    parser.add_argument("--binary", action="store_true", help="binary UI frames")
+    parser.add_argument("--ui-diff", action="store_true", help="ask for UI diffs")
+    parser.add_argument("--verbose", action="store_true", help="show agent output")
+    args = parser.parse_args()
+
+    if args.agent:
+        asyncio.run(run_agent(args.agent, args.latency_scale))
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
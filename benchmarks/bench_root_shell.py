@@ -0,0 +1,80 @@
+"""Compare spawning a root shell per command with the persistent RootShell.
+
+On a phone:   python benchmarks/bench_root_shell.py --shell su --command "input tap 1 1"
+On a laptop:  python benchmarks/bench_root_shell.py --shell sh
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from device import RootShell
+
+
+def spawn_per_call(argv, command):
+    # What run_as_root used to do for every action.
+    process = subprocess.Popen(
+        argv,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    process.communicate(command + "\n")
+
+
+def timed(fn, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(
+        f"{name:<12} mean {statistics.mean(samples):8.2f} ms"
+        f"  p50 {statistics.median(samples):8.2f} ms  p95 {p95:8.2f} ms"
+        f"  total {sum(samples):9.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shell", default="su", help="root shell binary")
+    parser.add_argument("--command", default="true")
+    parser.add_argument("-n", type=int, default=50)
+    args = parser.parse_args()
+
+    argv = args.shell.split()
+    spawn = timed(lambda: spawn_per_call(argv, args.command), args.n)
+
+    shell = RootShell(argv)
+    shell.execute("true")  # pay the startup once, as the listener does
+    persistent = timed(lambda: shell.execute(args.command), args.n)
+    # Output without a final newline (input/am often print none) must not
+    # hide the sentinel, or each call waits out the timeout and respawns su.
+    spawned = shell.spawned
+    no_newline = timed(lambda: shell.execute("printf chirp"), args.n)
+    _, stdout, _ = shell.execute("printf chirp")
+    assert stdout == "chirp", stdout
+    assert shell.spawned == spawned, "the shell was respawned"
+    shell.close()
+
+    print(f"{args.n} x {args.command!r} via {args.shell!r}")
+    report("spawn", spawn)
+    report("persistent", persistent)
+    report("no newline", no_newline)
+    print(f"speedup      {statistics.mean(spawn) / statistics.mean(persistent):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
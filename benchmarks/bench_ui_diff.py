@@ -0,0 +1,85 @@
+"""Bytes on the wire for full UI snapshots vs node-level diffs.
+
+Replays a sequence of recorded dumps (default: fixtures/ui in a plausible
+scan order) and checks that every diff round-trips to the next tree.
+
+    python benchmarks/bench_ui_diff.py [dump.xml ...]
+"""
+
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import ui_diff
+from ui_encoding import UiStateEncoder
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "fixtures", "ui")
+DEFAULT_SEQUENCE = [
+    "home_update_dialog.xml",
+    "home.xml",
+    "scan_live.xml",
+    "scan_live_next.xml",
+    "scan_live.xml",
+    "scan_paused.xml",
+    "scan_live.xml",
+    "scan_menu_open.xml",
+    "history.xml",
+]
+
+
+def decode(snapshot):
+    """The dump a controller gets out of a ui_state_zip_b64 snapshot."""
+    return gzip.decompress(base64.b64decode(snapshot)).decode("utf-8")
+
+
+def main():
+    paths = sys.argv[1:] or [os.path.join(FIXTURES, p) for p in DEFAULT_SEQUENCE]
+    dumps = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            dumps.append((os.path.basename(path), f.read()))
+
+    encoder = UiStateEncoder()
+    tracker = ui_diff.UiStateTracker()
+    held = None
+    seq = None
+    full_total = sent_total = 0
+    print(f"{'dump':<24} {'full':>8} {'sent':>8} {'kind':>6} {'ms':>7}")
+    for name, xml in dumps:
+        snapshot = encoder.encode(xml)[0]
+        full = len(json.dumps({"ui_state_zip_b64": snapshot}))
+
+        start = time.perf_counter()
+        sent_xml = encoder.as_sent(xml)
+        seq, base_seq, delta = tracker.update("bench", sent_xml, base_seq=seq)
+        if delta is None or len(json.dumps(delta)) >= len(snapshot):
+            delta = None
+            payload = {"ui_seq": seq, "ui_state_zip_b64": snapshot}
+            held = ui_diff.flatten(decode(snapshot))
+        else:
+            payload = {"ui_seq": seq, "ui_base_seq": base_seq, "ui_diff": delta}
+            held = ui_diff.apply(held, delta)
+        sent = len(json.dumps(payload))
+        elapsed = (time.perf_counter() - start) * 1000
+
+        # What the controller rebuilds must match a fresh snapshot exactly.
+        expected = ui_diff.flatten(decode(snapshot))
+        assert held == expected, f"diff round-trip failed at {name}"
+        assert ui_diff.flatten(ui_diff.to_xml(held)) == held, name
+
+        full_total += full
+        sent_total += sent
+        kind = "full" if delta is None else "diff"
+        print(f"{name:<24} {full:>8} {sent:>8} {kind:>6} {elapsed:>7.2f}")
+
+    saved = 100 * (1 - sent_total / full_total)
+    print(f"{'total':<24} {full_total:>8} {sent_total:>8}  saved {saved:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
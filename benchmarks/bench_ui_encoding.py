@@ -0,0 +1,88 @@
+"""Peak memory and size of the old gzip+base64 path vs UiStateEncoder.
+
+Each dump is also inflated to a few MB (by repeating its body) to exercise
+the large-dump path and the frame-size chunking.
+
+    python benchmarks/bench_ui_encoding.py [dump.xml ...]
+"""
+
+import base64
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ui_encoding import UiStateEncoder, strip_defaults
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "fixtures", "ui")
+
+
+def legacy(xml):
+    # capture_ui_state_zipped before this change, plus the json.dumps copy.
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(xml.encode("utf-8"))
+    encoded = base64.b64encode(buf.getvalue()).decode("utf-8")
+    return [json.dumps({"ui_state_zip_b64": encoded})]
+
+
+def streamed(encoder, xml):
+    return [json.dumps({"ui_state_zip_b64": c}) for c in encoder.encode(xml)]
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    frames = fn(*args)
+    elapsed = (time.perf_counter() - start) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return frames, peak, elapsed
+
+
+def inflate(xml, target):
+    head, _, rest = xml.partition("<node")
+    body, _, tail = ("<node" + rest).rpartition("</hierarchy>")
+    copies = max(1, target // len(body))
+    return head + body * copies + "</hierarchy>" + tail
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURES, "*.xml")))
+    encoder = UiStateEncoder()
+    encoder.encode("<hierarchy/>")  # buffer reuse is the steady state
+
+    print(
+        f"{'dump':<28} {'xml KB':>8} {'old KB':>8} {'new KB':>8}"
+        f" {'old peak':>9} {'new peak':>9} {'old ms':>7} {'new ms':>7} {'frames':>6}"
+    )
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            xml = f.read()
+        for name, dump in (
+            (os.path.basename(path), xml),
+            (os.path.basename(path) + " x4MB", inflate(xml, 4 * 2**20)),
+        ):
+            old, old_peak, old_ms = measure(legacy, dump)
+            new, new_peak, new_ms = measure(streamed, encoder, dump)
+
+            parts = [json.loads(frame)["ui_state_zip_b64"] for frame in new]
+            decoded = gzip.decompress(b"".join(base64.b64decode(p) for p in parts))
+            assert decoded.decode("utf-8") == strip_defaults(dump), name
+
+            print(
+                f"{name:<28} {len(dump) / 1024:>8.0f}"
+                f" {sum(map(len, old)) / 1024:>8.1f} {sum(map(len, new)) / 1024:>8.1f}"
+                f" {old_peak / 1024:>8.0f}K {new_peak / 1024:>8.0f}K"
+                f" {old_ms:>7.1f} {new_ms:>7.1f} {len(new):>6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
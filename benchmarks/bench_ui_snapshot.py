@@ -0,0 +1,87 @@
+"""Lookup cost: the old per-command ElementTree scans vs a UiSnapshot.
+
+For each dump, times what clickById/clickTextDirect used to do (parse, list
+every node, linear scan, regex the bounds) against building one UiSnapshot
+and resolving every lookup from its indexes.
+
+    python benchmarks/bench_ui_snapshot.py [dump.xml ...]
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ui_snapshot import UiSnapshot
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "fixtures", "ui")
+ROUNDS = 200
+
+
+def legacy_lookup(xml, key, value):
+    root = ET.fromstring(xml)
+    all_nodes = list(root.iter("node"))
+    for node in all_nodes:
+        if node.attrib.get(key) == value:
+            m = re.match(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", node.attrib["bounds"])
+            x1, y1, x2, y2 = map(int, m.groups())
+            return (x1 + x2) // 2, (y1 + y2) // 2
+    return None
+
+
+def snapshot_lookup(snapshot, key, value):
+    if key == "text":
+        node = snapshot.find(text=value)
+    elif key == "content-desc":
+        node = snapshot.find(description=value)
+    else:
+        node = snapshot.find(resource_id=value)
+    return node.center if node else None
+
+
+def queries(xml):
+    # Every distinct label in the dump, the way a scan session would ask.
+    root = ET.fromstring(xml)
+    found = []
+    for node in root.iter("node"):
+        for key in ("text", "content-desc", "resource-id"):
+            if node.attrib.get(key):
+                found.append((key, node.attrib[key]))
+    return found
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURES, "*.xml")))
+    print(
+        f"{'dump':<24} {'nodes':>6} {'queries':>7} {'legacy ms':>10} {'snapshot ms':>12}"
+    )
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            xml = f.read()
+        qs = queries(xml)
+
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            expected = [legacy_lookup(xml, k, v) for k, v in qs]
+        legacy = (time.perf_counter() - start) * 1000 / ROUNDS
+
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            snapshot = UiSnapshot(xml)
+            got = [snapshot_lookup(snapshot, k, v) for k, v in qs]
+        indexed = (time.perf_counter() - start) * 1000 / ROUNDS
+
+        assert got == expected, path
+        name = os.path.basename(path)
+        print(
+            f"{name:<24} {len(snapshot.nodes):>6} {len(qs):>7}"
+            f" {legacy:>10.2f} {indexed:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Connect-button lookup: test.click_connect's template match vs VisualLocator.
+
+The old fallback reads the template from disk on every call and runs one
+full-resolution colour matchTemplate at a single scale. The locator keeps
+templates cached and searches coarse-to-fine over several scales, optionally
+inside a region of interest.
+
+With stored screenshots and their template:
+
+    python benchmarks/bench_visual.py --template templates/connect_button.png shots/*.png
+
+Without arguments a synthetic 1080x2400 screen is generated with a drawn
+button pasted in at several scales, which shows both speed and what the
+single-scale search misses.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from visual import TemplateCache, VisualLocator
+
+ROUNDS = 20
+SYNTHETIC_SCALES = (0.8, 1.0, 1.25)
+
+
+def legacy_match(screen, template_path):
+    template = cv2.imread(template_path, cv2.IMREAD_COLOR)
+    res = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
+    _, maxv, _, maxloc = cv2.minMaxLoc(res)
+    if maxv > 0.8:
+        th, tw = template.shape[:2]
+        return maxloc[0] + tw // 2, maxloc[1] + th // 2
+    return None
+
+
+def draw_button(scale=1.0):
+    width, height = int(420 * scale), int(130 * scale)
+    button = np.full((height, width, 3), (40, 160, 240), np.uint8)
+    cv2.rectangle(button, (4, 4), (width - 5, height - 5), (255, 255, 255), 3)
+    cv2.putText(
+        button,
+        "Connect",
+        (int(60 * scale), int(88 * scale)),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        2.0 * scale,
+        (255, 255, 255),
+        max(1, int(5 * scale)),
+    )
+    return button
+
+
+def synthetic_screen(scale, rng):
+    screen = np.zeros((2400, 1080, 3), np.uint8)
+    screen[:] = np.linspace(20, 90, 2400, dtype=np.uint8)[:, None, None]
+    for _ in range(40):
+        x, y = rng.integers(0, 1000), rng.integers(0, 2300)
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.rectangle(screen, (x, y), (x + 80, y + 60), color, -1)
+    button = draw_button(scale)
+    h, w = button.shape[:2]
+    x, y = (1080 - w) // 2, 1900
+    screen[y : y + h, x : x + w] = button
+    return screen, (x + w // 2, y + h // 2)
+
+
+def timed(fn, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - start) / rounds * 1000, result
+
+
+def report(label, ms, found, expected):
+    if found is None:
+        where = "not found"
+    else:
+        where = f"at {found}"
+        if expected is not None:
+            error = max(abs(found[0] - expected[0]), abs(found[1] - expected[1]))
+            where += f" (off by {error}px)"
+    print(f"  {label:<22} {ms:8.1f} ms  {where}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("screens", nargs="*", help="stored screenshots")
+    parser.add_argument("--template", help="template image for stored screenshots")
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    parser.add_argument("--roi", default="0,0.6,1,1", help="x1,y1,x2,y2 fractions")
+    args = parser.parse_args()
+    roi = tuple(float(v) for v in args.roi.split(","))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.screens:
+            template_path = args.template
+            cases = [(p, cv2.imread(p, cv2.IMREAD_COLOR), None) for p in args.screens]
+        else:
+            template_path = os.path.join(tmp, "connect_button.png")
+            cv2.imwrite(template_path, draw_button())
+            rng = np.random.default_rng(1)
+            cases = [
+                (f"synthetic x{scale}", *synthetic_screen(scale, rng))
+                for scale in SYNTHETIC_SCALES
+            ]
+
+        locator = VisualLocator(TemplateCache(os.path.dirname(template_path)))
+        name = os.path.splitext(os.path.basename(template_path))[0]
+        locator.locate(cases[0][1], [name])  # load and scale the template once
+
+        for label, screen, expected in cases:
+            print(f"{label} ({screen.shape[1]}x{screen.shape[0]})")
+            ms, found = timed(lambda: legacy_match(screen, template_path), args.rounds)
+            report("legacy single-scale", ms, found, expected)
+            for roi_label, region in (("locator", None), ("locator + roi", roi)):
+                ms, matches = timed(
+                    lambda: locator.locate(screen, [name], roi=region), args.rounds
+                )
+                match = matches[name]
+                found = None if match is None else (match.x, match.y)
+                report(roi_label, ms, found, expected)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Fault injection for relay persistence and replay.
+
+Runs server.py with a throwaway message log, the real listener
+(remote_control.listen with its RelayCursor and CommandPipeline) driving a
+fake_device phone, and one acking controller, and keeps killing the agent's
+connection at random points mid-stream: before a command runs, and after its
+response but before its ack. Some reconnects first fail (--fail-rate), so
+the agent's cursor must survive attempts that never reached the relay.
+Every command must still get a response, and commands the agent already
+handled must not run again. With --restart-relay the relay also comes back
+once with an empty log, whose ids start again at 1.
+
+    python benchmarks/fault_relay.py --commands 300 --kill-rate 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websockets
+
+import remote_control
+import server
+from fake_device import fake_session
+
+AGENT_ID = "agent"
+# Nothing listens here, so connecting fails before any handshake.
+DEAD_URL = f"ws://127.0.0.1:1/?deviceId={AGENT_ID}"
+
+
+class FaultStats:
+    def __init__(self, kill_rate, fail_rate):
+        self.kill_rate = kill_rate
+        self.fail_rate = fail_rate
+        self.executions = {}
+        self.kills = 0
+        self.failed_connects = 0
+        self.skipped = 0
+
+    def maybe_kill(self, ws):
+        if random.random() < self.kill_rate:
+            self.kills += 1
+            ws.transport.abort()
+            return True
+        return False
+
+
+def flaky_pipeline(stats):
+    """CommandPipeline that drops its connection at the interesting points."""
+
+    class FlakyPipeline(remote_control.CommandPipeline):
+        def submit(self, data):
+            relay_id = data.get("relayId")
+            if relay_id is not None and self.cursor.seen(relay_id):
+                stats.skipped += 1
+            super().submit(data)
+
+        async def process(self, data, deadline):
+            if stats.maybe_kill(self.ws):
+                # Lost before running: wait to be cancelled with the pipeline.
+                await asyncio.Event().wait()
+            command_id = data.get("id")
+            stats.executions[command_id] = stats.executions.get(command_id, 0) + 1
+            await super().process(data, deadline)
+
+        async def ack(self, data):
+            # The response is out; the ack dies with the connection.
+            stats.maybe_kill(self.ws)
+            await super().ack(data)
+
+    return FlakyPipeline
+
+
+async def agent(url, stats):
+    session = fake_session(screen="home", latency_scale=0.01)
+    cursor = remote_control.RelayCursor()
+    health = remote_control.ConnectionHealth()
+    remote_control.CommandPipeline = flaky_pipeline(stats)
+    while True:
+        if random.random() < stats.fail_rate:
+            stats.failed_connects += 1
+            try:
+                await remote_control.listen(session, cursor, health, DEAD_URL)
+            except OSError:
+                pass
+        try:
+            await remote_control.listen(session, cursor, health, url)
+        except (OSError, websockets.exceptions.ConnectionClosed):
+            pass
+        await asyncio.sleep(random.uniform(0.01, 0.1))
+
+
+async def controller(url, commands, timeout):
+    responses = {}
+    duplicates = 0
+    async with websockets.connect(f"{url}?deviceId=controller&acks=1") as ws:
+
+        async def receive():
+            nonlocal duplicates
+            async for raw in ws:
+                data = json.loads(raw)
+                if "relayId" in data:
+                    await ws.send(
+                        json.dumps({"action": "ack", "relayId": data["relayId"]})
+                    )
+                if data.get("action") != "tap":
+                    continue
+                if data["id"] in responses:
+                    duplicates += 1
+                responses[data["id"]] = data
+
+        reader = asyncio.create_task(receive())
+        for i in range(commands):
+            command = {
+                "action": "tap",
+                "x": 1,
+                "y": 1,
+                "settle": "fixed",
+                "sleep": 0,
+                "deviceId": AGENT_ID,
+                "sender": "controller",
+            }
+            await ws.send(json.dumps({**command, "id": i}))
+            await asyncio.sleep(random.uniform(0, 0.003))
+
+        deadline = time.monotonic() + timeout
+        while len(responses) < commands and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        reader.cancel()
+    return responses, duplicates
+
+
+async def restart_relay(tmp, port, relay):
+    """Bring the relay back with an empty log."""
+    relay.close()
+    for clients in list(server.connected_clients.values()):
+        for client in list(clients):
+            client.websocket.transport.abort()
+    await relay.wait_closed()
+    server.message_log = server.MessageLog(os.path.join(tmp, "relay-2.db"))
+    asyncio.create_task(server.message_log.run())
+    return await websockets.serve(server.handler, "127.0.0.1", port)
+
+
+async def run(args):
+    # The agent and relay log every message; only the summary matters here.
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as quiet:
+        sys.stdout, stdout = quiet, sys.stdout
+        server.message_log = server.MessageLog(os.path.join(tmp, "relay.db"))
+        writer = asyncio.create_task(server.message_log.run())
+        relay = await websockets.serve(server.handler, "127.0.0.1", args.port)
+        url = f"ws://127.0.0.1:{args.port}/?deviceId={AGENT_ID}"
+
+        stats = FaultStats(args.kill_rate, args.fail_rate)
+        agent_task = asyncio.create_task(agent(url, stats))
+        await asyncio.sleep(0.2)
+        responses, duplicates = await controller(
+            f"ws://127.0.0.1:{args.port}/", args.commands, args.timeout
+        )
+        reran = {k: v for k, v in stats.executions.items() if v > 1}
+        if args.restart_relay:
+            stats.executions.clear()
+            relay = await restart_relay(tmp, args.port, relay)
+            await asyncio.sleep(0.5)
+            more, more_duplicates = await controller(
+                f"ws://127.0.0.1:{args.port}/", args.commands, args.timeout
+            )
+            missing_after_restart = args.commands - len(more)
+            duplicates += more_duplicates
+
+        agent_task.cancel()
+        writer.cancel()
+        relay.close()
+        await relay.wait_closed()
+        sys.stdout = stdout
+
+    missing = sorted(set(range(args.commands)) - set(responses))
+    print(f"commands            {args.commands}")
+    print(f"connections killed  {stats.kills}")
+    print(f"failed reconnects   {stats.failed_connects}")
+    print(f"replays skipped     {stats.skipped}")
+    print(f"responses           {len(responses)} ({duplicates} duplicate)")
+    print(f"re-executed         {len(reran)} (killed mid-command)")
+    print(f"missing responses   {len(missing)} {missing[:10]}")
+    if args.restart_relay:
+        print(f"missing after relay restart {missing_after_restart}")
+        if missing_after_restart:
+            sys.exit(1)
+    if missing:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8798)
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--kill-rate", type=float, default=0.05)
+    parser.add_argument(
+        "--fail-rate",
+        type=float,
+        default=0.3,
+        help="chance a reconnect is preceded by a failed connection attempt",
+    )
+    parser.add_argument("--timeout", type=float, default=20.0)
+    parser.add_argument(
+        "--restart-relay",
+        action="store_true",
+        help="then restart the relay with an empty log and run again",
+    )
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
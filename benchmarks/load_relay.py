@@ -0,0 +1,160 @@
+"""Load test for the relay with simulated agents and controllers.
+
+Starts server.py in-process (or uses --url), connects N fake agents and M
+controllers, and has each controller fire commands at random agents. Agents
+answer after --agent-delay with a --response-bytes payload. Reports
+throughput, round-trip percentiles and any misrouted messages.
+
+    python benchmarks/load_relay.py --agents 40 --controllers 4 --commands 500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websockets
+
+import server
+
+
+async def agent(url, device_id, delay, payload, stats, slow):
+    async with websockets.connect(f"{url}?deviceId={device_id}&role=agent") as ws:
+        async for raw in ws:
+            data = json.loads(raw)
+            if data.get("deviceId") != device_id:
+                stats["misrouted"] += 1
+                continue
+            if slow:
+                await asyncio.sleep(1.0)
+            await asyncio.sleep(delay)
+            response = {
+                "action": data["action"],
+                "status": "ok",
+                "target": data["sender"],
+                "id": data["id"],
+                "ui_state_zip_b64": payload,
+            }
+            await ws.send(json.dumps(response))
+
+
+async def controller(url, name, agents, commands, stats, timeout):
+    latencies = []
+    async with websockets.connect(f"{url}?deviceId={name}&role=controller") as ws:
+        pending = {}
+
+        async def receive():
+            async for raw in ws:
+                data = json.loads(raw)
+                sent = pending.pop(data.get("id"), None)
+                if data.get("target") != name or sent is None:
+                    stats["misrouted"] += 1
+                    continue
+                stats["bytes"] += len(raw)
+                latencies.append((time.perf_counter() - sent) * 1000)
+
+        reader = asyncio.create_task(receive())
+        for i in range(commands):
+            command_id = f"{name}-{i}"
+            pending[command_id] = time.perf_counter()
+            command = {
+                "action": "tap",
+                "x": 1,
+                "y": 1,
+                "deviceId": random.choice(agents),
+                "sender": name,
+                "id": command_id,
+            }
+            await ws.send(json.dumps(command))
+            await asyncio.sleep(0)
+
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        stats["lost"] += len(pending)
+        reader.cancel()
+    return latencies
+
+
+async def run(args):
+    stop = None
+    url = args.url
+    if url is None:
+        relay = await websockets.serve(server.handler, "127.0.0.1", args.port)
+        url = f"ws://127.0.0.1:{args.port}/"
+        stop = relay
+
+    stats = {"misrouted": 0, "lost": 0, "bytes": 0}
+    payload = "A" * args.response_bytes
+    agent_ids = [f"agent{i}" for i in range(args.agents)]
+    agents = [
+        asyncio.create_task(
+            agent(url, d, args.agent_delay, payload, stats, i < args.slow_agents)
+        )
+        for i, d in enumerate(agent_ids)
+    ]
+    await asyncio.sleep(0.5)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            controller(
+                url, f"controller{i}", agent_ids, args.commands, stats, args.timeout
+            )
+            for i in range(args.controllers)
+        )
+    )
+    elapsed = time.perf_counter() - start
+
+    for task in agents:
+        task.cancel()
+    if stop is not None:
+        stop.close()
+        await stop.wait_closed()
+
+    latencies = sorted(l for r in results for l in r)
+    if not latencies:
+        print("No responses received")
+        return
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    print(
+        f"{args.agents} agents, {args.controllers} controllers,"
+        f" {args.commands} commands each"
+    )
+    print(
+        f"round trips   {len(latencies)} in {elapsed:.2f}s"
+        f" ({len(latencies) / elapsed:.0f}/s)"
+    )
+    print(
+        f"latency ms    p50 {statistics.median(latencies):.1f}"
+        f"  p95 {pct(0.95):.1f}  p99 {pct(0.99):.1f}  max {latencies[-1]:.1f}"
+    )
+    print(f"received      {stats['bytes'] / 2**20:.1f} MiB")
+    print(f"lost          {stats['lost']}   misrouted {stats['misrouted']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="existing relay (default: start one)")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--controllers", type=int, default=2)
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--agent-delay", type=float, default=0.01)
+    parser.add_argument("--response-bytes", type=int, default=2048)
+    parser.add_argument("--slow-agents", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Load the bathymetry.csv files under scans/ for data_processing.ipynb.
+
+Each scan folder is named ..._<degrees>_deg_<sand height>_cm and holds a
+bathymetry.csv with the depth (metres) in column 2 and the timestamp
+(milliseconds) in column 4. Only those two columns are parsed, straight into
+NumPy arrays, and the result is cached next to the CSV as a .npz of plain
+.npy arrays together with the CSV's size and mtime; a scan is only parsed
+again when its CSV changed. Scans that do need parsing are spread over a
+process pool.
+
+    scans = load_scans("scans")
+    depths, timestamps = read_columns("scans/.../bathymetry.csv")
+"""
+
+import itertools
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+SCANS_DIR = "scans"
+BATHYMETRY_CSV = "bathymetry.csv"
+CACHE_NAME = ".bathymetry_cache.npz"
+# Bump when the cached arrays change meaning, so old caches are re-parsed.
+CACHE_VERSION = 1
+
+DEPTH_COLUMN = 2
+TIMESTAMP_COLUMN = 4
+# Lines parsed at a time by iter_columns.
+CHUNK_ROWS = 100_000
+
+# Below this many scans to parse, a process pool costs more than it saves.
+PARALLEL_MIN_SCANS = 2
+
+DEGREE_PATTERN = re.compile(r"_([0-9]+(?:\.[0-9]+)?)_deg")
+SAND_PATTERN = re.compile(r"_([0-9]+(?:\.[0-9]+)?)_cm")
+
+# depths in metres and timestamps in milliseconds, both float64 arrays; rows
+# without a timestamp have NaN there.
+Scan = namedtuple("Scan", "folder degree sand_height depths timestamps")
+
+
+def parse_folder_name(name):
+    """(scan degree, sand height in cm) from a scan folder name; None if absent."""
+    deg_match = DEGREE_PATTERN.search(name)
+    sand_match = SAND_PATTERN.search(name)
+    degree = float(deg_match.group(1)) if deg_match else None
+    sand_height = float(sand_match.group(1)) if sand_match else None
+    return degree, sand_height
+
+
+def find_scans(base_dir=SCANS_DIR):
+    """Every folder under base_dir that holds a bathymetry.csv, in walk order."""
+    folders = []
+    for root, dirs, files in os.walk(base_dir):
+        dirs.sort()
+        if BATHYMETRY_CSV in files:
+            folders.append(root)
+    return folders
+
+
+def read_columns(source, columns=(DEPTH_COLUMN, TIMESTAMP_COLUMN), header=None):
+    """The given CSV columns as float64 arrays, one per column.
+
+    source is a path or a list of lines. The first line is skipped if it is
+    a header, i.e. has no numeric field (header=None looks; True/False says).
+    Empty or non-numeric fields become NaN, which needs the slower
+    genfromtxt, so it is only used when the fast parse fails.
+    """
+    if header is None:
+        header = _is_header(_first_line(source))
+    skip = int(header)
+    if not isinstance(source, (str, os.PathLike)):
+        source, skip = source[skip:], 0
+        if not source:
+            return [np.empty(0) for _ in columns]
+    try:
+        table = _loadtxt(source, columns, skiprows=skip)
+    except ValueError:
+        table = np.genfromtxt(
+            source,
+            delimiter=",",
+            usecols=columns,
+            dtype=np.float64,
+            skip_header=skip,
+            invalid_raise=False,
+            ndmin=2,
+        )
+    return [np.ascontiguousarray(table[:, i]) for i in range(len(columns))]
+
+
+def iter_columns(path, columns=(DEPTH_COLUMN, TIMESTAMP_COLUMN), chunk_rows=CHUNK_ROWS):
+    """read_columns over chunk_rows lines at a time, for files too big to load."""
+    with open(path, encoding="utf-8") as f:
+        header = None
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                return
+            arrays = read_columns(lines, columns, header)
+            # Only the file's first line can be a header.
+            header = False
+            if arrays[0].size:
+                yield arrays
+
+
+def _first_line(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding="utf-8") as f:
+            return f.readline()
+    return source[0] if source else ""
+
+
+def _is_header(line):
+    """Whether a CSV line has no numeric field at all."""
+    for field in line.split(","):
+        try:
+            float(field)
+        except ValueError:
+            continue
+        return False
+    return True
+
+
+def _loadtxt(path, columns, skiprows):
+    return np.loadtxt(
+        path,
+        delimiter=",",
+        usecols=columns,
+        dtype=np.float64,
+        skiprows=skiprows,
+        ndmin=2,
+    )
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _cached(folder):
+    """(depths, timestamps) from the folder's cache if it matches the CSV."""
+    cache_path = os.path.join(folder, CACHE_NAME)
+    try:
+        with np.load(cache_path) as cache:
+            if np.array_equal(
+                cache["stamp"], _stamp(os.path.join(folder, BATHYMETRY_CSV))
+            ):
+                return cache["depths"], cache["timestamps"]
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def parse_scan(folder, use_cache=True):
+    """Parse a folder's bathymetry.csv and refresh its cache."""
+    path = os.path.join(folder, BATHYMETRY_CSV)
+    stamp = _stamp(path)
+    depths, timestamps = read_columns(path)
+    if use_cache:
+        # Written under a temporary name so a crash never leaves half a cache.
+        tmp_path = os.path.join(folder, f"{CACHE_NAME}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, stamp=stamp, depths=depths, timestamps=timestamps)
+            os.replace(tmp_path, os.path.join(folder, CACHE_NAME))
+        except OSError as e:
+            print(f"[bathymetry] Could not cache {folder}: {e}")
+    return depths, timestamps
+
+
+def load_scan(folder, use_cache=True):
+    arrays = _cached(folder) if use_cache else None
+    if arrays is None:
+        arrays = parse_scan(folder, use_cache)
+    degree, sand_height = parse_folder_name(os.path.basename(folder))
+    return Scan(folder, degree, sand_height, *arrays)
+
+
+def load_scans(base_dir=SCANS_DIR, use_cache=True, workers=None):
+    """Every scan under base_dir, sorted by sand height.
+
+    Cached scans are read in this process; the rest are parsed in parallel
+    (workers=1 keeps everything in-process).
+    """
+    folders = find_scans(base_dir)
+    arrays = {}
+    stale = []
+    for folder in folders:
+        cached = _cached(folder) if use_cache else None
+        if cached is None:
+            stale.append(folder)
+        else:
+            arrays[folder] = cached
+
+    if len(stale) >= PARALLEL_MIN_SCANS and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = pool.map(parse_scan, stale, [use_cache] * len(stale))
+            arrays.update(zip(stale, parsed))
+    else:
+        arrays.update((folder, parse_scan(folder, use_cache)) for folder in stale)
+
+    scans = []
+    for folder in folders:
+        degree, sand_height = parse_folder_name(os.path.basename(folder))
+        scans.append(Scan(folder, degree, sand_height, *arrays[folder]))
+    scans.sort(key=lambda s: (s.sand_height is None, s.sand_height or 0.0))
+    return scans
@@ -0,0 +1,297 @@
+"""Calibration statistics over every scan folder, as one cached table.
+
+For each scan (bathymetry.load_scan, so CSVs are parsed once) this computes,
+in a process pool:
+
+- outlier rejection: samples further than OUTLIER_MADS scaled median
+  absolute deviations from the median are dropped;
+- mean, std and median depth of what remains, in cm;
+- a bootstrap confidence interval for the mean. Consecutive sonar pings are
+  strongly correlated, so blocks of BLOCK_SAMPLES are resampled rather than
+  single samples, which would give far too narrow an interval.
+
+The rows then get the scan's expected depth (water height minus sand height)
+and, per angle, a weighted linear fit of measured against expected depth,
+with the corrected depth and residual for every scan. The result is cached
+in scans/.calibration_cache.npz and only recomputed when a CSV or a setting
+changes.
+
+Folder names carry the settings: ..._<deg>_deg_<cm>_cm, optionally with
+_<g>_g for the silt load and _<cm>_water for the water height; the folder
+above a scan is its session (e.g. the date).
+
+    cal = calibration_table()
+    rows = select(cal.table, degree=15.0)
+    plt.errorbar(rows["expected_cm"], rows["mean_cm"], yerr=ci_errors(rows))
+"""
+
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bathymetry import (
+    BATHYMETRY_CSV,
+    SCANS_DIR,
+    find_scans,
+    load_scan,
+    parse_folder_name,
+)
+
+CACHE_NAME = ".calibration_cache.npz"
+
+# Water depth of the test tank when the folder name doesn't say (cm).
+WATER_CM = 69.0
+OUTLIER_MADS = 3.5
+BLOCK_SAMPLES = 50
+BOOTSTRAP_ROUNDS = 2000
+CONFIDENCE = 0.95
+SEED = 0
+
+SILT_PATTERN = re.compile(r"_([0-9]+(?:\.[0-9]+)?)_g(?:_|$)")
+WATER_PATTERN = re.compile(r"_([0-9]+(?:\.[0-9]+)?)_water")
+
+SCAN_COLUMNS = (
+    "folder",
+    "session",
+    "degree",
+    "sand_cm",
+    "silt_g",
+    "water_cm",
+    "expected_cm",
+    "samples",
+    "rejected",
+    "mean_cm",
+    "std_cm",
+    "median_cm",
+    "ci_low",
+    "ci_high",
+    "duration_s",
+    "corrected_cm",
+    "residual_cm",
+)
+FIT_COLUMNS = ("degree", "slope", "intercept", "r2", "rmse", "scans")
+
+# table and fits are dicts of equal-length column arrays.
+Calibration = namedtuple("Calibration", "table fits")
+
+
+def parse_settings(folder, water_cm=WATER_CM):
+    """(degree, sand cm, silt g, water cm) from a scan folder's name."""
+    name = os.path.basename(folder)
+    degree, sand_cm = parse_folder_name(name)
+    silt = SILT_PATTERN.search(name)
+    water = WATER_PATTERN.search(name)
+    return (
+        degree,
+        sand_cm,
+        float(silt.group(1)) if silt else 0.0,
+        float(water.group(1)) if water else water_cm,
+    )
+
+
+def reject_outliers(values, mads=OUTLIER_MADS):
+    """Mask of the values within `mads` scaled MADs of the median."""
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    if mad == 0:
+        return np.ones(values.shape, dtype=bool)
+    return np.abs(values - median) <= mads * mad
+
+
+def block_bootstrap_ci(
+    values,
+    block=BLOCK_SAMPLES,
+    rounds=BOOTSTRAP_ROUNDS,
+    confidence=CONFIDENCE,
+    seed=SEED,
+):
+    """Confidence interval for the mean, resampling blocks of consecutive values."""
+    blocks = values.size // block
+    if blocks < 2:
+        mean = float(values.mean()) if values.size else np.nan
+        return mean, mean
+    means = values[: blocks * block].reshape(blocks, block).mean(axis=1)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, blocks, size=(rounds, blocks))
+    resampled = means[picks].mean(axis=1)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(resampled, [tail, 100 - tail])
+    return float(low), float(high)
+
+
+def scan_row(folder, water_cm=WATER_CM, use_cache=True):
+    """The per-scan columns of the table for one folder."""
+    scan = load_scan(folder, use_cache)
+    degree, sand_cm, silt_g, water = parse_settings(folder, water_cm)
+    depths = scan.depths[np.isfinite(scan.depths)] * 100
+    times = scan.timestamps[np.isfinite(scan.timestamps)]
+    row = {
+        "folder": folder,
+        "session": os.path.basename(os.path.dirname(folder)),
+        "degree": np.nan if degree is None else degree,
+        "sand_cm": np.nan if sand_cm is None else sand_cm,
+        "silt_g": silt_g,
+        "water_cm": water,
+        "expected_cm": water - (sand_cm if sand_cm is not None else np.nan),
+        "samples": depths.size,
+        "duration_s": (times[-1] - times[0]) / 1000 if times.size > 1 else 0.0,
+    }
+    if depths.size == 0:
+        row.update(
+            rejected=0,
+            mean_cm=np.nan,
+            std_cm=np.nan,
+            median_cm=np.nan,
+            ci_low=np.nan,
+            ci_high=np.nan,
+        )
+        return row
+    keep = reject_outliers(depths)
+    kept = depths[keep]
+    ci_low, ci_high = block_bootstrap_ci(kept)
+    row.update(
+        rejected=int(depths.size - kept.size),
+        mean_cm=float(kept.mean()),
+        std_cm=float(kept.std()),
+        median_cm=float(np.median(kept)),
+        ci_low=ci_low,
+        ci_high=ci_high,
+    )
+    return row
+
+
+def fit_angles(table):
+    """Weighted least squares of mean_cm on expected_cm for each angle.
+
+    Weights are 1 / CI width squared, so a noisy scan pulls the line less.
+    Also fills in the table's corrected_cm and residual_cm columns.
+    """
+    fits = {name: [] for name in FIT_COLUMNS}
+    table["corrected_cm"] = np.full(table["mean_cm"].shape, np.nan)
+    table["residual_cm"] = np.full(table["mean_cm"].shape, np.nan)
+    usable = np.isfinite(table["mean_cm"]) & np.isfinite(table["expected_cm"])
+    for degree in np.unique(table["degree"][np.isfinite(table["degree"])]):
+        rows = usable & (table["degree"] == degree)
+        x = table["expected_cm"][rows]
+        y = table["mean_cm"][rows]
+        if np.unique(x).size < 2:
+            continue
+        width = table["ci_high"][rows] - table["ci_low"][rows]
+        width = np.where(width > 0, width, np.nan)
+        weights = 1 / np.nan_to_num(width, nan=np.nanmax(width, initial=1.0)) ** 2
+        # np.polyfit weights multiply residuals, hence the square root.
+        slope, intercept = np.polyfit(x, y, 1, w=np.sqrt(weights))
+        predicted = slope * x + intercept
+        residuals = y - predicted
+        total = ((y - y.mean()) ** 2).sum()
+        fits["degree"].append(degree)
+        fits["slope"].append(slope)
+        fits["intercept"].append(intercept)
+        fits["r2"].append(1 - (residuals**2).sum() / total if total else np.nan)
+        fits["rmse"].append(float(np.sqrt((residuals**2).mean())))
+        fits["scans"].append(int(rows.sum()))
+        table["corrected_cm"][rows] = (y - intercept) / slope
+        table["residual_cm"][rows] = residuals
+    return {name: np.asarray(values) for name, values in fits.items()}
+
+
+def _signature(folders, water_cm):
+    """Digest of every CSV's size and mtime plus the settings."""
+    parts = [
+        json.dumps(
+            [
+                water_cm,
+                OUTLIER_MADS,
+                BLOCK_SAMPLES,
+                BOOTSTRAP_ROUNDS,
+                CONFIDENCE,
+                SEED,
+            ]
+        )
+    ]
+    for folder in folders:
+        stat = os.stat(os.path.join(folder, BATHYMETRY_CSV))
+        parts.append(f"{folder}\0{stat.st_size}\0{stat.st_mtime_ns}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _load_cache(path, signature):
+    try:
+        with np.load(path) as cache:
+            if str(cache["signature"]) != signature:
+                return None
+            table = {name: cache[f"scan.{name}"] for name in SCAN_COLUMNS}
+            fits = {name: cache[f"fit.{name}"] for name in FIT_COLUMNS}
+            return Calibration(table, fits)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_cache(path, signature, calibration):
+    arrays = {"signature": np.array(signature)}
+    arrays.update({f"scan.{k}": v for k, v in calibration.table.items()})
+    arrays.update({f"fit.{k}": v for k, v in calibration.fits.items()})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[calibration] Could not cache the table: {e}")
+
+
+def calibration_table(base_dir=None, water_cm=WATER_CM, use_cache=True, workers=None):
+    """The per-scan table and per-angle fits for every scan under base_dir."""
+    if base_dir is None:
+        base_dir = os.path.join(os.getcwd(), SCANS_DIR)
+    folders = find_scans(base_dir)
+    cache_path = os.path.join(base_dir, CACHE_NAME)
+    signature = _signature(folders, water_cm)
+    if use_cache:
+        cached = _load_cache(cache_path, signature)
+        if cached is not None:
+            return cached
+
+    if len(folders) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(
+                pool.map(
+                    scan_row,
+                    folders,
+                    [water_cm] * len(folders),
+                    [use_cache] * len(folders),
+                )
+            )
+    else:
+        rows = [scan_row(folder, water_cm, use_cache) for folder in folders]
+
+    table = {
+        name: np.asarray([row[name] for row in rows])
+        for name in SCAN_COLUMNS
+        if name not in ("corrected_cm", "residual_cm")
+    }
+    fits = fit_angles(table)
+    calibration = Calibration(table, fits)
+    if use_cache:
+        _save_cache(cache_path, signature, calibration)
+    return calibration
+
+
+def select(table, order_by="expected_cm", **criteria):
+    """The rows matching every column=value criterion, sorted by order_by."""
+    rows = np.ones(len(table["folder"]), dtype=bool)
+    for name, value in criteria.items():
+        rows &= table[name] == value
+    subset = {name: column[rows] for name, column in table.items()}
+    order = np.argsort(subset[order_by], kind="stable")
+    return {name: column[order] for name, column in subset.items()}
+
+
+def ci_errors(rows):
+    """Asymmetric error bars (below, above the mean) from the bootstrap CI."""
+    return [rows["mean_cm"] - rows["ci_low"], rows["ci_high"] - rows["mean_cm"]]
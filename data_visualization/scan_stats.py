@@ -0,0 +1,418 @@
+"""Statistics and plot series for long scans without holding them in memory.
+
+A scan's bathymetry.csv is read in chunks (bathymetry.iter_columns) and each
+chunk is folded into fixed-size accumulators:
+
+- RunningStats: count, mean and variance merged chunk by chunk (Welford /
+  Chan et al.), plus min and max.
+- DepthHistogram: counts per depth bin, for quantiles to within half a bin.
+- WindowStats: count, mean, std, min and max per fixed time window.
+- MinMaxSeries: the lowest and highest depth per time bucket, with buckets
+  doubling in width whenever there are more than max_points of them.
+
+Memory and plotting cost then depend on the window and point settings, not
+on how long the scan ran. lttb() thins a series further to an exact number
+of points. Summaries are cached next to the CSV in .scan_summary_cache.npz
+and only recomputed when the CSV's size or mtime or a setting changes.
+
+    summary = summarize_scan("scans/.../bathymetry.csv")
+    plt.plot(*summary.series)
+"""
+
+import json
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from bathymetry import CHUNK_ROWS, iter_columns
+
+CACHE_NAME = ".scan_summary_cache.npz"
+
+# Depth histogram resolution, metres.
+DEPTH_BIN = 0.001
+# Seconds per WindowStats window.
+WINDOW_S = 10.0
+# Time buckets kept by MinMaxSeries (each gives up to two plotted points).
+MAX_POINTS = 2000
+
+ScanSummary = namedtuple("ScanSummary", "stats quantiles windows series")
+STATS_KEYS = ("count", "mean", "std", "min", "max")
+
+
+class RunningStats:
+    """Mean and variance of everything passed to update(), in one pass.
+
+    NaNs are ignored.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self.merge(values.size, mean, m2)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    @property
+    def variance(self):
+        """Population variance, as np.var."""
+        return self.m2 / self.count if self.count else math.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.mean if self.count else math.nan,
+            "std": self.std,
+            "min": self.min if self.count else math.nan,
+            "max": self.max if self.count else math.nan,
+        }
+
+
+class DepthHistogram:
+    """Counts per bin of width `width`, growing to cover the values seen."""
+
+    def __init__(self, width=DEPTH_BIN):
+        self.width = width
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        bins = np.floor(values / self.width).astype(np.int64)
+        low, high = int(bins.min()), int(bins.max())
+        if self.counts.size == 0:
+            self.offset = low
+            self.counts = np.zeros(high - low + 1, dtype=np.int64)
+        elif low < self.offset or high >= self.offset + self.counts.size:
+            start = min(low, self.offset)
+            end = max(high + 1, self.offset + self.counts.size)
+            grown = np.zeros(end - start, dtype=np.int64)
+            at = self.offset - start
+            grown[at : at + self.counts.size] = self.counts
+            self.offset, self.counts = start, grown
+        self.counts += np.bincount(bins - self.offset, minlength=self.counts.size)
+
+    def quantiles(self, qs):
+        """Values at the given quantiles (0-1), at bin centres."""
+        qs = np.asarray(qs, dtype=np.float64)
+        total = self.counts.sum()
+        if total == 0:
+            return np.full(qs.shape, np.nan)
+        cumulative = np.cumsum(self.counts)
+        index = np.searchsorted(cumulative, qs * total, side="left")
+        index = np.minimum(index, self.counts.size - 1)
+        return (index + self.offset + 0.5) * self.width
+
+
+class WindowStats:
+    """count/mean/std/min/max of the values in each `window` seconds.
+
+    Windows are counted from `start`, or from the first time seen. Each
+    chunk's per-window mean and variance are merged into the running ones
+    the same way RunningStats merges chunks.
+    """
+
+    def __init__(self, window=WINDOW_S, start=None):
+        self.window = window
+        self.start = start
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+
+    def update(self, times, values):
+        keep = np.isfinite(times) & np.isfinite(values)
+        times, values = times[keep], values[keep]
+        if times.size == 0:
+            return
+        if self.start is None:
+            self.start = float(times[0])
+        index = np.floor((times - self.start) / self.window).astype(np.int64)
+        keep = index >= 0
+        index, values = index[keep], values[keep]
+        if index.size == 0:
+            return
+        size = max(int(index.max()) + 1, self.count.size)
+        if size > self.count.size:
+            self._grow(size)
+
+        count = np.bincount(index, minlength=size)
+        seen = count > 0
+        mean = np.zeros(size)
+        mean[seen] = np.bincount(index, values, minlength=size)[seen] / count[seen]
+        m2 = np.bincount(index, (values - mean[index]) ** 2, minlength=size)
+
+        total = self.count + count
+        delta = mean - self.mean
+        share = np.divide(count, total, out=np.zeros(size), where=total > 0)
+        self.m2 += m2 + delta * delta * self.count * share
+        self.mean += delta * share
+        self.count = total
+        np.minimum.at(self.min, index, values)
+        np.maximum.at(self.max, index, values)
+
+    def _grow(self, size):
+        extra = size - self.count.size
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.mean = np.concatenate([self.mean, np.zeros(extra)])
+        self.m2 = np.concatenate([self.m2, np.zeros(extra)])
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+
+    def result(self):
+        """Arrays for the windows that saw values: start time, count, mean, ..."""
+        seen = self.count > 0
+        count = self.count[seen]
+        return {
+            "start": (self.start or 0.0) + np.flatnonzero(seen) * self.window,
+            "count": count,
+            "mean": self.mean[seen],
+            "std": np.sqrt(self.m2[seen] / count),
+            "min": self.min[seen],
+            "max": self.max[seen],
+        }
+
+
+class MinMaxSeries:
+    """A plot series that keeps the extremes of every time bucket.
+
+    Starts with `bucket`-second buckets and doubles their width (merging
+    neighbours) whenever more than max_points are in use, so a scan of any
+    length ends up with at most 2 * max_points points and no spike is lost.
+    """
+
+    def __init__(self, max_points=MAX_POINTS, bucket=0.1):
+        self.max_points = max_points
+        self.bucket = bucket
+        self.start = None
+        # Per bucket: time and value of the minimum, then of the maximum.
+        self.lo_t = np.zeros(0)
+        self.lo_v = np.zeros(0)
+        self.hi_t = np.zeros(0)
+        self.hi_v = np.zeros(0)
+
+    def update(self, times, values):
+        keep = np.isfinite(times) & np.isfinite(values)
+        times, values = times[keep], values[keep]
+        if times.size == 0:
+            return
+        if self.start is None:
+            self.start = float(times[0])
+        index = np.floor((times - self.start) / self.bucket).astype(np.int64)
+        keep = index >= 0
+        times, values, index = times[keep], values[keep], index[keep]
+        while max(int(index.max()) + 1, self.lo_v.size) > self.max_points:
+            self._coarsen()
+            index //= 2
+
+        size = max(int(index.max()) + 1, self.lo_v.size)
+        chunk = self._reduce(index, times, values, size)
+        self._grow(size)
+        self._combine(*chunk)
+
+    def _reduce(self, index, times, values, size):
+        """Per-bucket (lo_t, lo_v, hi_t, hi_v) for one chunk, NaN where empty."""
+        order = np.lexsort((values, index))
+        index, times, values = index[order], times[order], values[order]
+        first = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        last = np.r_[first[1:] - 1, index.size - 1]
+        buckets = index[first]
+        out = [np.full(size, np.nan) for _ in range(4)]
+        out[0][buckets], out[1][buckets] = times[first], values[first]
+        out[2][buckets], out[3][buckets] = times[last], values[last]
+        return out
+
+    def _combine(self, lo_t, lo_v, hi_t, hi_v):
+        lower = np.isnan(self.lo_v) | (lo_v < self.lo_v)
+        self.lo_t = np.where(lower, lo_t, self.lo_t)
+        self.lo_v = np.where(lower, lo_v, self.lo_v)
+        higher = np.isnan(self.hi_v) | (hi_v > self.hi_v)
+        self.hi_t = np.where(higher, hi_t, self.hi_t)
+        self.hi_v = np.where(higher, hi_v, self.hi_v)
+
+    def _grow(self, size):
+        extra = size - self.lo_v.size
+        if extra > 0:
+            pad = np.full(extra, np.nan)
+            self.lo_t = np.concatenate([self.lo_t, pad])
+            self.lo_v = np.concatenate([self.lo_v, pad])
+            self.hi_t = np.concatenate([self.hi_t, pad])
+            self.hi_v = np.concatenate([self.hi_v, pad])
+
+    def _coarsen(self):
+        self.bucket *= 2
+        if self.lo_v.size % 2:
+            self._grow(self.lo_v.size + 1)
+        lo_t, lo_v, hi_t, hi_v = self.lo_t, self.lo_v, self.hi_t, self.hi_v
+        self.lo_t, self.lo_v = lo_t[0::2], lo_v[0::2]
+        self.hi_t, self.hi_v = hi_t[0::2], hi_v[0::2]
+        self._combine(lo_t[1::2], lo_v[1::2], hi_t[1::2], hi_v[1::2])
+
+    def result(self):
+        """(times, values) in time order: each bucket's min and max."""
+        seen = ~np.isnan(self.lo_v)
+        times = np.column_stack([self.lo_t[seen], self.hi_t[seen]])
+        values = np.column_stack([self.lo_v[seen], self.hi_v[seen]])
+        # Put each pair in time order, and drop the duplicate when min and
+        # max are the same sample.
+        swap = times[:, 0] > times[:, 1]
+        times[swap] = times[swap][:, ::-1]
+        values[swap] = values[swap][:, ::-1]
+        times, values = times.ravel(), values.ravel()
+        keep = np.r_[True, times[1:] != times[:-1]]
+        return times[keep], values[keep]
+
+
+def lttb(x, y, points):
+    """Largest-Triangle-Three-Buckets downsampling of (x, y) to `points`."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if points >= x.size or points < 3:
+        return x, y
+    edges = np.linspace(1, x.size - 1, points - 1).astype(np.int64)
+    picked = np.empty(points, dtype=np.int64)
+    picked[0], picked[-1] = 0, x.size - 1
+    previous = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket (the last point for the final bucket).
+        if i + 2 < edges.size:
+            next_x = x[end : edges[i + 2]].mean()
+            next_y = y[end : edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        px, py = x[previous], y[previous]
+        area = np.abs(
+            (px - next_x) * (y[start:end] - py) - (px - x[start:end]) * (next_y - py)
+        )
+        previous = start + int(area.argmax())
+        picked[i + 1] = previous
+    return x[picked], y[picked]
+
+
+def _signature(path, quantiles, window, max_points):
+    """The CSV's size and mtime plus the settings, as one string."""
+    stat = os.stat(path)
+    return json.dumps(
+        [
+            os.path.abspath(path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            list(quantiles),
+            window,
+            max_points,
+            DEPTH_BIN,
+        ]
+    )
+
+
+def _load_cache(cache_path, signature):
+    try:
+        with np.load(cache_path) as cache:
+            if str(cache["signature"]) != signature:
+                return None
+            stats = {k: cache[f"stats.{k}"].item() for k in STATS_KEYS}
+            quantiles = dict(
+                zip(cache["quantiles.q"].tolist(), cache["quantiles.values"])
+            )
+            windows = {
+                k[len("windows.") :]: cache[k]
+                for k in cache.files
+                if k.startswith("windows.")
+            }
+            series = (cache["series.times"], cache["series.values"])
+            return ScanSummary(stats, quantiles, windows, series)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_cache(cache_path, signature, summary):
+    arrays = {"signature": np.array(signature)}
+    arrays.update({f"stats.{k}": np.array(v) for k, v in summary.stats.items()})
+    arrays["quantiles.q"] = np.array(list(summary.quantiles))
+    arrays["quantiles.values"] = np.array(list(summary.quantiles.values()))
+    arrays.update({f"windows.{k}": v for k, v in summary.windows.items()})
+    arrays["series.times"], arrays["series.values"] = summary.series
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"[scan_stats] Could not cache the summary: {e}")
+
+
+def summarize_scan(
+    path,
+    quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+    window=WINDOW_S,
+    max_points=MAX_POINTS,
+    chunk_rows=CHUNK_ROWS,
+    use_cache=True,
+):
+    """Stats, quantiles, window aggregates and a plot series for one CSV.
+
+    Depths are in cm and times in seconds since the first timestamp, as the
+    notebook plots them. Rows without a timestamp count towards the stats
+    and quantiles but not the windows or the series.
+    """
+    cache_path = os.path.join(os.path.dirname(path), CACHE_NAME)
+    signature = _signature(path, quantiles, window, max_points)
+    if use_cache:
+        cached = _load_cache(cache_path, signature)
+        if cached is not None:
+            return cached
+
+    stats = RunningStats()
+    histogram = DepthHistogram(DEPTH_BIN * 100)
+    windows = WindowStats(window)
+    series = MinMaxSeries(max_points)
+    first = None
+    for depths, timestamps in iter_columns(path, chunk_rows=chunk_rows):
+        depth_cm = depths * 100
+        stats.update(depth_cm)
+        histogram.update(depth_cm)
+        if first is None:
+            valid = timestamps[np.isfinite(timestamps)]
+            if valid.size:
+                first = valid[0]
+        if first is not None:
+            times = (timestamps - first) / 1000
+            windows.update(times, depth_cm)
+            series.update(times, depth_cm)
+    summary = ScanSummary(
+        stats.snapshot(),
+        dict(zip(quantiles, histogram.quantiles(quantiles))),
+        windows.result(),
+        series.result(),
+    )
+    if use_cache:
+        _save_cache(cache_path, signature, summary)
+    return summary
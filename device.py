@@ -0,0 +1,287 @@
+import asyncio
+import contextvars
+import functools
+import queue
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import uiautomator2 as u2
+
+import metrics
+from ui_diff import UiStateTracker
+from ui_encoding import UiStateEncoder
+from ui_snapshot import UiSnapshot
+
+# How long a hierarchy dump may be reused. Anything that changes the screen
+# (tap, swipe, launch, restart, uiautomator clicks) invalidates it early.
+HIERARCHY_TTL = 1.0
+
+# Blocking device I/O (uiautomator RPCs, su) runs on these threads so the
+# event loop stays free for heartbeats and status queries.
+DEVICE_IO_WORKERS = 4
+
+# Root commands go through one persistent shell instead of spawning su for
+# every tap. On a host driving a phone over ADB this would be e.g.
+# ["adb", "-s", serial, "shell", "su"].
+ROOT_SHELL = ["su"]
+ROOT_COMMAND_TIMEOUT = 15.0
+
+ADB = "adb"
+
+
+class RootShell:
+    """A long-lived root shell that runs commands one at a time.
+
+    Each command's output is framed by a random sentinel printed after it on
+    both stdout and stderr, together with the command's exit status. The
+    sentinel goes on a line of its own (output without a final newline would
+    otherwise hide it) and that extra newline is stripped again. If the
+    shell dies or a command times out the shell is killed and a new one is
+    spawned on the next call.
+    """
+
+    def __init__(self, argv=None, timeout=ROOT_COMMAND_TIMEOUT):
+        self.argv = argv or ROOT_SHELL
+        self.timeout = timeout
+        self.spawned = 0
+        self._proc = None
+        self._stdout = None
+        self._stderr = None
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        with metrics.span("su_spawn"):
+            self._proc = subprocess.Popen(
+                self.argv,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                bufsize=1,
+            )
+        self._stdout = queue.Queue()
+        self._stderr = queue.Queue()
+        for stream, lines in (
+            (self._proc.stdout, self._stdout),
+            (self._proc.stderr, self._stderr),
+        ):
+            threading.Thread(
+                target=_pump_lines, args=(stream, lines), daemon=True
+            ).start()
+        self.spawned += 1
+
+    def _kill(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+        self._proc = None
+
+    def _read_until(self, lines, marker, deadline):
+        collected = []
+        while True:
+            try:
+                line = lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("root command timed out")
+            if line is None:
+                raise RuntimeError("root shell exited")
+            if line.startswith(marker):
+                return collected, line[len(marker) :].strip()
+            collected.append(line)
+
+    def execute(self, command, timeout=None):
+        """Run a command as root; returns (exit_code, stdout, stderr)."""
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._spawn()
+
+            marker = f"__chirp_{uuid.uuid4().hex}__"
+            # Braces keep compound commands together; stdin is detached so the
+            # command can't swallow the framing lines queued behind it.
+            framed = (
+                f"{{ {command}\n}} </dev/null\n"
+                f"printf '\\n%s %s\\n' {marker} \"$?\"\n"
+                f"printf '\\n%s\\n' {marker} >&2\n"
+            )
+            try:
+                self._proc.stdin.write(framed)
+                self._proc.stdin.flush()
+            except OSError:
+                # The shell died between commands; nothing ran yet, so retry.
+                self._kill()
+                self._spawn()
+                self._proc.stdin.write(framed)
+                self._proc.stdin.flush()
+
+            deadline = time.monotonic() + (timeout or self.timeout)
+            try:
+                stdout, code = self._read_until(self._stdout, marker, deadline)
+                stderr, _ = self._read_until(self._stderr, marker, deadline)
+            except (TimeoutError, RuntimeError):
+                self._kill()
+                raise
+            return int(code or -1), _unframe(stdout), _unframe(stderr)
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                try:
+                    self._proc.stdin.close()
+                    self._proc.wait(timeout=2)
+                except (OSError, subprocess.TimeoutExpired):
+                    pass
+            self._kill()
+
+
+def adb_root_shell(serial, adb=ADB):
+    """A RootShell on a USB/ADB-attached phone, for agents running on a host."""
+    return RootShell([adb, "-s", serial, "shell", "su"])
+
+
+def attached_devices(adb=ADB):
+    """Serials of the devices `adb devices` reports as ready."""
+    output = subprocess.run(
+        [adb, "devices"], capture_output=True, text=True, timeout=10, check=True
+    ).stdout
+    serials = []
+    for line in output.splitlines()[1:]:
+        serial, _, state = line.partition("\t")
+        if state.strip() == "device":
+            serials.append(serial)
+    return serials
+
+
+def _unframe(lines):
+    """Output read before a sentinel, minus the newline printed ahead of it."""
+    output = "".join(lines)
+    return output[:-1] if output.endswith("\n") else output
+
+
+def _pump_lines(stream, lines):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+class DeviceSession:
+    """Long-lived uiautomator2 connection plus a short-lived hierarchy cache."""
+
+    def __init__(
+        self,
+        serial=None,
+        hierarchy_ttl=HIERARCHY_TTL,
+        executor=None,
+        root_shell=None,
+        connect=None,
+        package=None,
+        activity=None,
+    ):
+        self.serial = serial
+        # The app this device drives, when it differs from the agent's default.
+        self.package = package
+        self.activity = activity
+        # u2.connect, or a stand-in such as fake_device.FakeDevice.connect.
+        self.connect = connect or u2.connect
+        self.root_shell = root_shell or RootShell()
+        self.hierarchy_ttl = hierarchy_ttl
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=DEVICE_IO_WORKERS, thread_name_prefix="device-io"
+        )
+        # Bumped on every UI mutation so callers can tell whether anything
+        # happened to the screen since they last looked.
+        self.generation = 0
+        self.ui_states = UiStateTracker()
+        self.ui_encoder = UiStateEncoder()
+        # Controllers that negotiated binary frames (see framing.py).
+        self.binary_peers = set()
+        # visual.VisualLocator, created on first use since it needs OpenCV.
+        self.visual = None
+        self._device = None
+        self._xml = None
+        self._xml_at = 0.0
+        self._snapshot = None
+        self._lock = threading.RLock()
+
+    @property
+    def device(self):
+        with self._lock:
+            if self._device is None:
+                with metrics.span("connect"):
+                    self._device = (
+                        self.connect(self.serial) if self.serial else self.connect()
+                    )
+                print(f"[session] Connected to device {self.serial or 'default'}")
+            return self._device
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking call on the device I/O executor."""
+        loop = asyncio.get_running_loop()
+        # Carry the caller's context over so timing spans in the call are
+        # attributed to the action being handled.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(context.run, fn, *args, **kwargs)
+        )
+
+    def reset(self):
+        """Drop the connection; the next access reconnects."""
+        with self._lock:
+            self._device = None
+            self._xml = None
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn(device, ...) and retry once on a fresh connection if it fails."""
+        try:
+            return fn(self.device, *args, **kwargs)
+        except Exception as e:
+            print(f"[session] Device call failed ({e}), reconnecting")
+            self.reset()
+            return fn(self.device, *args, **kwargs)
+
+    def dump_hierarchy(self, fresh=False):
+        with self._lock:
+            age = time.monotonic() - self._xml_at
+            if not fresh and self._xml is not None and age < self.hierarchy_ttl:
+                return self._xml
+            generation = self.generation
+
+        with metrics.span("dump"):
+            xml = self.call(lambda d: d.dump_hierarchy())
+
+        with self._lock:
+            # Don't cache a dump that raced with a mutation.
+            if generation == self.generation:
+                self._xml = xml
+                self._xml_at = time.monotonic()
+        return xml
+
+    def snapshot(self, fresh=False):
+        """The current hierarchy as an indexed UiSnapshot, parsed once per dump."""
+        xml = self.dump_hierarchy(fresh)
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.xml is xml:
+                return self._snapshot
+        snapshot = UiSnapshot(xml)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._xml = None
+
+    def run_as_root(self, command: str):
+        try:
+            with metrics.span("su"):
+                code, stdout, stderr = self.root_shell.execute(command)
+        finally:
+            self.invalidate()
+        print("stdout:", stdout.strip())
+        print("stderr:", stderr.strip())
+        return code, stdout, stderr
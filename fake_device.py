@@ -0,0 +1,309 @@
+"""A simulated phone for running the agent without hardware.
+
+FakeDevice plays back the recorded Deeper-app dumps in fixtures/ui as a small
+screen graph. Taps are hit-tested against the current dump and may move to
+another screen, the live sonar screen alternates between two frames with
+different readouts, and every call sleeps for a configurable latency.
+FakeRootShell stands in for RootShell and turns the `input` / `am` commands
+the agent sends into calls on the device.
+
+    session = fake_session(screen="scan_live", latency_scale=0.5)
+"""
+
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from device import DeviceSession
+from ui_snapshot import UiSnapshot
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "ui")
+
+# Seconds per call, measured roughly on a mid-range phone over USB.
+LATENCY = {
+    "connect": 0.3,
+    "dump": 0.12,
+    "selector": 0.03,
+    "click": 0.04,
+    "swipe": 0.3,
+    "app": 0.5,
+    "su_spawn": 0.08,
+    "su": 0.02,
+}
+JITTER = 0.2
+
+# Tapping a node with this text, content-desc or resource-id (or inside one)
+# moves from the current screen to the next.
+TRANSITIONS = {
+    "home": {
+        "Boat scan icon": "scan_live",
+        "Boat": "scan_live",
+        "eu.deeper.fishdeeper:id/btn_connect": "scan_live",
+    },
+    "home_update_dialog": {"android:id/button1": "home", "android:id/button2": "home"},
+    "scan_live": {"Pause": "scan_paused", "Fab Image": "scan_menu_open"},
+    "scan_paused": {"Resume": "scan_live"},
+    "scan_menu_open": {"History": "history", "Fab Image": "scan_live"},
+    "history": {},
+}
+BACK = {
+    "history": "scan_live",
+    "scan_menu_open": "scan_live",
+    "scan_paused": "scan_live",
+    "scan_live": "home",
+}
+# Screens whose readouts change on every dump.
+LIVE_FRAMES = {"scan_live": ("scan_live", "scan_live_next")}
+START_SCREEN = "home_update_dialog"
+
+ShellResponse = namedtuple("ShellResponse", "output exit_code")
+
+
+class FakeDevice:
+    """The subset of a uiautomator2 device the agent and test.py use."""
+
+    def __init__(
+        self,
+        screen="home",
+        fixtures=FIXTURES,
+        latency=None,
+        latency_scale=1.0,
+        jitter=JITTER,
+        seed=None,
+    ):
+        self.screen = screen
+        self.fixtures = fixtures
+        self.latency = {**LATENCY, **(latency or {})}
+        self.latency_scale = latency_scale
+        self.jitter = jitter
+        self.calls = Counter()
+        self.info = {"displayWidth": 1080, "displayHeight": 2400, "sdkInt": 33}
+        self._random = random.Random(seed)
+        self._frame = 0
+        self._xml = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def connect(self, serial=None):
+        """Drop-in for u2.connect, for DeviceSession(connect=...)."""
+        self._wait("connect")
+        return self
+
+    def _wait(self, call):
+        self.calls[call] += 1
+        delay = self.latency[call] * self.latency_scale
+        if delay > 0:
+            time.sleep(delay * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _load(self, name):
+        if name not in self._xml:
+            with open(
+                os.path.join(self.fixtures, f"{name}.xml"), encoding="utf-8"
+            ) as f:
+                self._xml[name] = f.read()
+        return self._xml[name]
+
+    def _current(self):
+        frames = LIVE_FRAMES.get(self.screen)
+        if frames is None:
+            return self.screen
+        return frames[self._frame % len(frames)]
+
+    def snapshot(self):
+        """The current screen as a UiSnapshot, without the dump latency."""
+        with self._lock:
+            name = self._current()
+            if name not in self._snapshots:
+                self._snapshots[name] = UiSnapshot(self._load(name))
+            return self._snapshots[name]
+
+    def dump_hierarchy(self, compressed=False, pretty=False, max_depth=None):
+        self._wait("dump")
+        with self._lock:
+            self._frame += 1
+            return self._load(self._current())
+
+    def node_at(self, x, y):
+        """The topmost clickable node containing the point, like a real touch.
+
+        Flutter text nodes report full-screen bounds, so they never count.
+        """
+        for node in reversed(self.snapshot().nodes):
+            if node.clickable and node.bounds is not None:
+                x1, y1, x2, y2 = node.bounds
+                if x1 <= x < x2 and y1 <= y < y2:
+                    return node
+        return None
+
+    def tap(self, x, y):
+        """Move to the next screen if the point hits a known control."""
+        transitions = TRANSITIONS.get(self.screen, {})
+        hit = self.node_at(x, y)
+        if hit is None:
+            return False
+        # A control is known by its own labels or those of the text and
+        # icons inside it.
+        labelled = [hit] + [n for n in self.snapshot().nodes if n.ancestor is hit]
+        for node in labelled + list(hit.ancestors()):
+            for key in (node.text, node.description, node.resource_id):
+                if key in transitions:
+                    with self._lock:
+                        self.screen = transitions[key]
+                    return True
+        return False
+
+    def click(self, x, y):
+        self._wait("click")
+        self.tap(x, y)
+
+    def swipe(self, fx, fy, tx, ty, duration=None, steps=None):
+        self._wait("swipe")
+
+    def press(self, key):
+        self._wait("click")
+        if key == "back":
+            with self._lock:
+                self.screen = BACK.get(self.screen, self.screen)
+
+    def app_start(self, package, activity=None, stop=False):
+        self._wait("app")
+        with self._lock:
+            self.screen = START_SCREEN
+
+    def app_stop(self, package):
+        self._wait("app")
+
+    def window_size(self):
+        return self.info["displayWidth"], self.info["displayHeight"]
+
+    def shell(self, command, timeout=None):
+        code, stdout, _ = run_command(self, command)
+        return ShellResponse(stdout, code)
+
+    def __call__(self, **selector):
+        return FakeSelector(self, selector)
+
+    def xpath(self, expression):
+        m = re.fullmatch(
+            r'//\*\[@(text|resource-id|content-desc)=["\'](.*)["\']\]', expression
+        )
+        if m is None:
+            raise ValueError(f"Unsupported xpath: {expression}")
+        key = {
+            "text": "text",
+            "resource-id": "resourceId",
+            "content-desc": "description",
+        }
+        return FakeSelector(self, {key[m.group(1)]: m.group(2)})
+
+
+class FakeSelector:
+    """d(text=...) / d.xpath(...) against the current fixture."""
+
+    def __init__(self, device, selector):
+        self.device = device
+        self.selector = selector
+
+    def _find(self):
+        self.device._wait("selector")
+        snapshot = self.device.snapshot()
+        for node in snapshot.nodes:
+            if all(_selector_matches(node, k, v) for k, v in self.selector.items()):
+                return node
+        return None
+
+    @property
+    def exists(self):
+        return self._find() is not None
+
+    def wait(self, timeout=None):
+        return self.exists
+
+    def until(self, timeout=None):
+        return self if self.exists else None
+
+    @property
+    def info(self):
+        node = self._find()
+        if node is None:
+            raise LookupError(f"No node matches {self.selector}")
+        return dict(node.attrib)
+
+    def get_text(self):
+        return self.info.get("text", "")
+
+    def center(self):
+        node = self._find()
+        if node is None or node.center is None:
+            raise LookupError(f"No node matches {self.selector}")
+        return node.center
+
+    def click(self, timeout=None):
+        x, y = self.center()
+        self.device.click(x, y)
+
+
+def _selector_matches(node, key, value):
+    if key == "text":
+        return node.text == value
+    if key == "textContains":
+        return value in node.text
+    if key == "resourceId":
+        return node.resource_id == value
+    if key == "description":
+        return node.description == value
+    if key == "descriptionContains":
+        return value in node.description
+    if key == "className":
+        return node.cls == value
+    raise ValueError(f"Unsupported selector: {key}")
+
+
+COMMANDS = (
+    (re.compile(r"input tap (\d+) (\d+)"), lambda d, m: d.tap(int(m[1]), int(m[2]))),
+    (re.compile(r"input swipe "), lambda d, m: None),
+    (re.compile(r"input keyevent (?:4|KEYCODE_BACK)\b"), lambda d, m: d.press("back")),
+    (re.compile(r"am start -n (\S+)"), lambda d, m: d.app_start(m[1].split("/")[0])),
+    (re.compile(r"am force-stop (\S+)"), lambda d, m: None),
+)
+
+
+def run_command(device, command):
+    """Apply a shell command's effect on the fake device; (code, stdout, stderr)."""
+    for pattern, effect in COMMANDS:
+        m = pattern.search(command)
+        if m:
+            effect(device, m)
+            break
+    return 0, "", ""
+
+
+class FakeRootShell:
+    """Stands in for RootShell: same interface, effects applied to a FakeDevice."""
+
+    def __init__(self, device):
+        self.device = device
+        self.spawned = 0
+        self._lock = threading.Lock()
+
+    def execute(self, command, timeout=None):
+        with self._lock:
+            if not self.spawned:
+                self.device._wait("su_spawn")
+                self.spawned += 1
+            self.device._wait("su")
+            return run_command(self.device, command)
+
+    def close(self):
+        pass
+
+
+def fake_session(executor=None, **kwargs):
+    """A DeviceSession driving a new FakeDevice; kwargs go to FakeDevice."""
+    device = FakeDevice(**kwargs)
+    return DeviceSession(
+        executor=executor, root_shell=FakeRootShell(device), connect=device.connect
+    )
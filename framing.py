@@ -0,0 +1,161 @@
+"""Binary frames for payloads that shouldn't travel as base64 inside JSON.
+
+Every frame is a fixed header, the target's id and a slice of the payload:
+
+    magic "CH" | version | content type | sender (u32) | message id (u32)
+    | chunk index (u16) | chunk count (u16) | target length (u8) | target
+
+The sender is a random id per process, so chunks from two agents streaming
+to the same controller with the same message id are kept apart.
+
+Relays only need the header (for routing) and never look at the payload.
+Peers agree to use binary frames with a {"action": "hello", "frames": [...]}
+exchange; anyone who hasn't gets the JSON form.
+"""
+
+import itertools
+import random
+import struct
+import time
+from collections import OrderedDict, namedtuple
+
+MAGIC = b"CH"
+VERSION = 2
+HEADER = struct.Struct("!2sBBIIHHB")
+
+CONTENT_JSON = 1
+CONTENT_UI_GZIP = 2
+CONTENT_JPEG = 3
+CONTENT_WEBP = 4
+CONTENT_SCAN_GZIP = 5
+
+# Keep frames under the websocket max_size used by both ends.
+CHUNK_SIZE = 2**20 - 1024
+
+# Limits for partially received messages on the receiving side.
+MAX_PENDING_BYTES = 16 * 2**20
+MAX_PENDING_MESSAGES = 32
+PENDING_TTL = 60.0
+
+FrameHeader = namedtuple(
+    "FrameHeader", "content_type sender message_id chunk chunks target"
+)
+
+SENDER_ID = random.getrandbits(32)
+_message_ids = itertools.count(1)
+
+
+def next_message_id():
+    return next(_message_ids) & 0xFFFFFFFF
+
+
+def is_frame(message):
+    return isinstance(message, (bytes, bytearray)) and message[:2] == MAGIC
+
+
+def encode_frames(
+    payload,
+    content_type,
+    target="",
+    message_id=None,
+    chunk_size=CHUNK_SIZE,
+    sender=SENDER_ID,
+):
+    """Split a payload into binary frames; returns (message_id, [frames])."""
+    if message_id is None:
+        message_id = next_message_id()
+    target_bytes = (target or "").encode("utf-8")[:255]
+    view = memoryview(payload)
+    chunks = max(1, -(-len(view) // chunk_size))
+    if chunks > 0xFFFF:
+        raise ValueError(f"Payload of {len(view)} bytes needs too many chunks")
+
+    frames = []
+    for index in range(chunks):
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            content_type,
+            sender,
+            message_id,
+            index,
+            chunks,
+            len(target_bytes),
+        )
+        body = view[index * chunk_size : (index + 1) * chunk_size]
+        frames.append(b"".join((header, target_bytes, body)))
+    return message_id, frames
+
+
+def parse_header(frame):
+    """Returns (FrameHeader, payload view) without copying the payload."""
+    if len(frame) < HEADER.size:
+        raise ValueError("Frame too short")
+    magic, version, content_type, sender, message_id, chunk, chunks, target_len = (
+        HEADER.unpack_from(frame)
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a chirp frame")
+    start = HEADER.size + target_len
+    target = bytes(frame[HEADER.size : start]).decode("utf-8")
+    header = FrameHeader(content_type, sender, message_id, chunk, chunks, target)
+    return header, memoryview(frame)[start:]
+
+
+class Reassembler:
+    """Collects chunks back into messages, within a fixed memory budget.
+
+    Incomplete messages are dropped oldest-first when the budget or message
+    count is exceeded, and after PENDING_TTL seconds without progress.
+    """
+
+    def __init__(
+        self,
+        max_bytes=MAX_PENDING_BYTES,
+        max_messages=MAX_PENDING_MESSAGES,
+        ttl=PENDING_TTL,
+    ):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._bytes = 0
+
+    def _drop(self, key):
+        _, parts, _ = self._pending.pop(key)
+        self._bytes -= sum(len(p) for p in parts.values())
+        self.dropped += 1
+
+    def add(self, frame):
+        """Feed one frame; returns (header, payload bytes) once complete."""
+        header, payload = parse_header(frame)
+        if header.chunks == 1:
+            return header, bytes(payload)
+
+        now = time.monotonic()
+        for key in [k for k, v in self._pending.items() if now - v[2] > self.ttl]:
+            self._drop(key)
+
+        key = (header.target, header.sender, header.message_id)
+        if key not in self._pending:
+            self._pending[key] = (header, {}, now)
+        first, parts, _ = self._pending[key]
+        if header.chunk not in parts:
+            parts[header.chunk] = bytes(payload)
+            self._bytes += len(payload)
+        self._pending[key] = (first, parts, now)
+        self._pending.move_to_end(key)
+
+        while self._pending and (
+            self._bytes > self.max_bytes or len(self._pending) > self.max_messages
+        ):
+            oldest = next(iter(self._pending))
+            print(f"[frames] Dropping incomplete message {oldest}")
+            self._drop(oldest)
+
+        if key in self._pending and len(parts) == first.chunks:
+            self._pending.pop(key)
+            self._bytes -= sum(len(p) for p in parts.values())
+            return first, b"".join(parts[i] for i in range(first.chunks))
+        return None
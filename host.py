@@ -0,0 +1,136 @@
+"""Drive every phone attached to this host from one process.
+
+Devices are found with `adb devices` and re-checked every DISCOVERY_INTERVAL
+seconds. Each gets its own DeviceSession, relay connection and command queue
+(remote_control.persistent_listener), all on one event loop. Blocking
+uiautomator/ADB calls from every device share one bounded thread pool.
+
+Per-device settings come from a JSON file keyed by adb serial:
+
+    {
+      "server": "wss://.../test",
+      "workers": 8,
+      "devices": {
+        "R58M40ABCDE": {"deviceId": "rig1-a", "package": "eu.deeper.fishdeeper",
+                        "activity": "eu.deeper.app.scan.live.MainScreenActivity"}
+      }
+    }
+
+Entries may also set "site" for the connection metrics. Attached devices
+missing from "devices" use their serial as deviceId unless "onlyListed" is
+true.
+
+    python host.py devices.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import remote_control
+from device import DeviceSession, adb_root_shell, attached_devices
+
+HOST_CONFIG = "devices.json"
+HOST_IO_WORKERS = 8
+DISCOVERY_INTERVAL = 10.0
+
+
+def load_config(path):
+    if path is None or not os.path.exists(path):
+        print(f"[host] No config at {path}, using defaults for every device")
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def device_settings(config, serial):
+    """deviceId/package/activity for a serial, or None to leave it alone."""
+    settings = config.get("devices", {}).get(serial)
+    if settings is None:
+        if config.get("onlyListed"):
+            return None
+        settings = {}
+    return {"deviceId": serial, **settings}
+
+
+def relay_url(config, device_id):
+    server = config.get("server") or remote_control.SERVER_URL.split("?")[0]
+    return f"{server}?deviceId={device_id}"
+
+
+class Host:
+    """The listeners for every attached device, kept in step with adb."""
+
+    def __init__(self, config, workers=None):
+        self.config = config
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or config.get("workers", HOST_IO_WORKERS),
+            thread_name_prefix="device-io",
+        )
+        self.running = {}
+
+    def start(self, serial, settings):
+        device_id = settings["deviceId"]
+        session = DeviceSession(
+            serial,
+            executor=self.executor,
+            root_shell=adb_root_shell(serial),
+            package=settings.get("package"),
+            activity=settings.get("activity"),
+        )
+        health = remote_control.ConnectionHealth(
+            settings.get("site", remote_control.SITE)
+        )
+        remote_control.register_connection_metrics(health, device_id)
+        task = asyncio.create_task(
+            remote_control.persistent_listener(
+                session, relay_url(self.config, device_id), health
+            )
+        )
+        self.running[serial] = (task, session, health)
+        print(f"[host] Started {serial} as {device_id}")
+
+    def stop(self, serial):
+        task, session, health = self.running.pop(serial)
+        task.cancel()
+        metrics.REGISTRY.remove_gauges(health)
+        metrics.REGISTRY.reset(serial)
+        self.executor.submit(session.root_shell.close)
+        print(f"[host] Stopped {serial}")
+
+    async def discover(self):
+        loop = asyncio.get_running_loop()
+        try:
+            serials = await loop.run_in_executor(self.executor, attached_devices)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"[host] adb devices failed: {e}")
+            return
+        for serial in serials:
+            if serial not in self.running:
+                settings = device_settings(self.config, serial)
+                if settings is not None:
+                    self.start(serial, settings)
+        for serial in [s for s in self.running if s not in serials]:
+            self.stop(serial)
+
+    async def run(self, interval=DISCOVERY_INTERVAL):
+        while True:
+            await self.discover()
+            await asyncio.sleep(interval)
+
+
+async def main(args):
+    if remote_control.METRICS_PORT:
+        await metrics.serve(int(remote_control.METRICS_PORT))
+    await Host(load_config(args.config), args.workers).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config", nargs="?", default=HOST_CONFIG)
+    parser.add_argument("--workers", type=int, help="device I/O threads")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,241 @@
+"""Per-action timing spans, aggregated in-process.
+
+Code wraps each stage of handling a command in a span:
+
+    with metrics.span("dump"):
+        xml = device.dump_hierarchy()
+
+Spans are attributed to the action being handled (set once per command with
+metrics.action()), so the same stage shows up separately for tap, launch,
+dumpUi and so on, and to the device whose listener ran them (metrics.device(),
+so one host process driving several phones keeps them apart). Durations land
+in fixed-bucket histograms, which the `stats` action reports per device as
+p50/p95/p99 and the optional HTTP endpoint serves in the Prometheus text
+format, labelled with the device serial.
+
+Set AGENT_METRICS=0 to turn spans into a shared no-op context manager.
+"""
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+
+ENABLED = os.environ.get("AGENT_METRICS", "1") != "0"
+
+# Histogram bucket bounds in seconds, from quick RPCs up to scans and settles.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Percentiles come from the most recent samples of each histogram.
+RECENT_SAMPLES = 1024
+
+current_action = contextvars.ContextVar("current_action", default=None)
+current_device = contextvars.ContextVar("current_device", default=None)
+
+_NOOP = contextlib.nullcontext()
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max", "recent")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        ordered = sorted(self.recent)
+
+        def pct(p):
+            return round(
+                ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2
+            )
+
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 2),
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class Registry:
+    """Histograms keyed by (device, action, stage), plus gauges read at report time.
+
+    Devices are serials; "" when the agent's only device has none.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, action, stage, seconds, device=None):
+        key = (device or "", action or "-", stage)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, read, owner=None):
+        """Report read() as a gauge: a number, or {((label, value), ...): number}.
+
+        Several owners (e.g. one per device) can report under the same name.
+        """
+        with self._lock:
+            self._gauges.setdefault(name, {})[owner] = read
+
+    def remove_gauges(self, owner):
+        with self._lock:
+            for readers in self._gauges.values():
+                readers.pop(owner, None)
+
+    def reset(self, device=None):
+        """Start one device's histograms over."""
+        with self._lock:
+            for key in [k for k in self._histograms if k[0] == (device or "")]:
+                del self._histograms[key]
+
+    def snapshot(self, device=None):
+        """{action: {stage: summary}} of one device, for the stats action."""
+        with self._lock:
+            items = sorted(
+                (key[1:], h)
+                for key, h in self._histograms.items()
+                if key[0] == (device or "")
+            )
+            summaries = [(key, h.summary()) for key, h in items]
+        stats = {}
+        for (action, stage), summary in summaries:
+            stats.setdefault(action, {})[stage] = summary
+        return stats
+
+    def prometheus(self):
+        lines = [
+            "# HELP chirp_stage_seconds Time spent per stage of a command.",
+            "# TYPE chirp_stage_seconds histogram",
+        ]
+        with self._lock:
+            items = sorted(self._histograms.items())
+            rows = [(key, list(h.counts), h.count, h.sum) for key, h in items]
+        for (device, action, stage), counts, count, total in rows:
+            labels = f'action="{action}",stage="{stage}"'
+            if device:
+                labels = f'serial="{device}",{labels}'
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append(
+                    f'chirp_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f"chirp_stage_seconds_sum{{{labels}}} {total}")
+            lines.append(f"chirp_stage_seconds_count{{{labels}}} {count}")
+
+        with self._lock:
+            gauges = [(n, list(r.values())) for n, r in sorted(self._gauges.items())]
+        for name, readers in gauges:
+            lines.append(f"# TYPE {name} gauge")
+            values = {}
+            for read in readers:
+                value = read()
+                values.update(value if isinstance(value, dict) else {(): value})
+            for labels, v in values.items():
+                if v is None:
+                    continue
+                label_text = ",".join(f'{k}="{val}"' for k, val in labels)
+                lines.append(
+                    f"{name}{{{label_text}}} {v}" if label_text else f"{name} {v}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Span:
+    __slots__ = ("stage", "action", "start")
+
+    def __init__(self, stage, action):
+        self.stage = stage
+        self.action = action
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        REGISTRY.observe(
+            self.action or current_action.get(),
+            self.stage,
+            time.perf_counter() - self.start,
+            current_device.get(),
+        )
+        return False
+
+
+def span(stage, action=None):
+    """Time a block as `stage` of the current (or given) action."""
+    if not ENABLED:
+        return _NOOP
+    return _Span(stage, action)
+
+
+def observe(stage, seconds, action=None):
+    if ENABLED:
+        REGISTRY.observe(
+            action or current_action.get(), stage, seconds, current_device.get()
+        )
+
+
+def action(name):
+    """Attribute spans in this task (and executor calls it makes) to `name`."""
+    return current_action.set(name)
+
+
+def device(serial):
+    """Attribute spans in this task (and tasks it starts) to device `serial`."""
+    return current_device.set(serial)
+
+
+async def serve(port, host="127.0.0.1"):
+    """Serve REGISTRY in the Prometheus text format at http://host:port/metrics."""
+
+    async def respond(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            path = request.split()[1] if len(request.split()) > 1 else b"/"
+            if path == b"/metrics":
+                status, body = "200 OK", REGISTRY.prometheus().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("ascii") + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(respond, host, port)
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,156 @@
+"""Known-popup handling from one hierarchy dump per check.
+
+Instead of asking the device whether each known button exists, a
+PopupWatcher takes a single snapshot and matches every rule against it
+locally: exact texts and resource ids are set lookups, patterns are one
+combined regex. The winning node is tapped at the centre of its clickable
+target. When the screen hasn't changed since the last check, the watcher
+waits longer before checking again, up to max_interval.
+
+    watcher = PopupWatcher(lambda: UiSnapshot(d.dump_hierarchy()), d.click)
+    watcher.poll()  # checks if due, taps a popup button if there is one
+"""
+
+import re
+import threading
+import time
+
+from ui_snapshot import ui_fingerprint
+
+# Known popup buttons, in the order they are tried.
+POPUP_DISMISS_TEXTS = [
+    "No thanks",
+    "Not now",
+    "Later",
+    "Cancel",
+    "Close",
+    "Maybe later",
+]
+POPUP_ACCEPT_TEXTS = ["OK", "Allow", "Update", "Install", "Yes"]
+POPUP_RESOURCE_IDS = [
+    "com.android.packageinstaller:id/permission_deny_button",
+    "com.android.packageinstaller:id/permission_allow_button",
+]
+
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 8.0
+BACKOFF = 2.0
+
+
+class PopupMatcher:
+    """Rules compiled for matching against a UiSnapshot's indexes.
+
+    Exact texts come first, then resource ids, then patterns (matched against
+    node text); within each kind the earlier rule wins.
+    """
+
+    def __init__(
+        self,
+        texts=POPUP_DISMISS_TEXTS + POPUP_ACCEPT_TEXTS,
+        resource_ids=POPUP_RESOURCE_IDS,
+        patterns=(),
+    ):
+        self.texts = _priorities(texts)
+        self.resource_ids = _priorities(resource_ids)
+        self.patterns = list(patterns)
+        self.pattern = (
+            re.compile("|".join(f"(?:{p})" for p in self.patterns))
+            if self.patterns
+            else None
+        )
+
+    def match(self, snapshot):
+        """(rule label, node) for the best match on screen, or None."""
+        for rules, index, kind in (
+            (self.texts, snapshot.by_text, "text"),
+            (self.resource_ids, snapshot.by_resource_id, "resourceId"),
+        ):
+            # Walk whichever side is smaller.
+            if len(rules) < len(index):
+                found = [key for key in rules if key in index]
+            else:
+                found = [key for key in index if key in rules]
+            if found:
+                key = min(found, key=rules.__getitem__)
+                return f"{kind}:{key}", index[key][0]
+
+        if self.pattern is not None:
+            for text, nodes in snapshot.by_text.items():
+                if self.pattern.fullmatch(text):
+                    return f"pattern:{text}", nodes[0]
+        return None
+
+
+def _priorities(keys):
+    priorities = {}
+    for i, key in enumerate(keys):
+        priorities.setdefault(key, i)
+    return priorities
+
+
+class PopupWatcher:
+    """Checks for popups on a snapshot callable and taps them away.
+
+    snapshot() returns a UiSnapshot of the current screen and tap(x, y)
+    clicks; both are blocking device calls.
+    """
+
+    def __init__(
+        self,
+        snapshot,
+        tap,
+        matcher=None,
+        min_interval=MIN_INTERVAL,
+        max_interval=MAX_INTERVAL,
+        backoff=BACKOFF,
+    ):
+        self.snapshot = snapshot
+        self.tap = tap
+        self.matcher = matcher or PopupMatcher()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.checks = 0
+        self.handled = 0
+        self._fingerprint = None
+        self._due = 0.0
+        self._lock = threading.Lock()
+
+    def due(self):
+        return time.monotonic() >= self._due
+
+    def check(self):
+        """Look once; returns (rule, (x, y)) if a popup was tapped, else None."""
+        with self._lock:
+            snapshot = self.snapshot()
+            self.checks += 1
+            found = self.matcher.match(snapshot)
+
+            if found is not None:
+                rule, node = found
+                target = node.click_target()
+                if target.center is not None:
+                    self.tap(*target.center)
+                    self.handled += 1
+                    print(f"[popups] Tapped {rule} at {target.center}")
+                    # Whatever is behind the popup may be another one.
+                    self._fingerprint = None
+                    self.interval = self.min_interval
+                    self._due = time.monotonic()
+                    return rule, target.center
+
+            fingerprint = ui_fingerprint(snapshot.xml)
+            if fingerprint == self._fingerprint:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            else:
+                self.interval = self.min_interval
+            self._fingerprint = fingerprint
+            self._due = time.monotonic() + self.interval
+            return None
+
+    def poll(self):
+        """check() if the current interval has elapsed since the last one."""
+        if not self.due():
+            return None
+        return self.check()
@@ -0,0 +1,240 @@
+"""Copy new bathymetry data off a phone into the notebook's scans/ folder.
+
+Connects to the relay as a controller and asks the device's agent for
+everything it hasn't sent before (the pullScans action). Each device file
+is appended to <out>/<name>_<deg>_deg_<cm>_cm/bathymetry.csv, where <name>
+is the file's folder on the phone, the layout the notebook reads. --degree
+and --sand are required but only recorded for new files, so later pulls
+keep appending to the same place. Progress lives
+in <out>/.pull_manifest.json, so an interrupted pull picks up where it
+stopped.
+
+    python pull_scans.py testAndroid --degree 15 --sand 4
+    python pull_scans.py testAndroid --follow 30   # keep pulling every 30s
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import os
+import time
+import zlib
+
+from websockets import connect
+
+from framing import CONTENT_SCAN_GZIP, Reassembler, is_frame
+from scan_export import WINDOW, tail_digest
+from ui_encoding import MAX_FRAME
+
+OUT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data_visualization", "scans"
+)
+MANIFEST_NAME = ".pull_manifest.json"
+CONTROLLER_ID = "scanPuller"
+
+
+def relay_server():
+    from remote_control import SERVER_URL
+
+    return SERVER_URL.split("?")[0]
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def folder_name(device_path, degree, sand):
+    name = os.path.basename(os.path.dirname(device_path)) or "scan"
+    return f"{name}_{degree:g}_deg_{sand:g}_cm"
+
+
+class ScanWriter:
+    """Appends received chunks to the local copies and keeps the manifest."""
+
+    def __init__(self, out_dir, degree, sand):
+        self.out_dir = out_dir
+        self.degree = degree
+        self.sand = sand
+        self.manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+        self.manifest = load_manifest(self.manifest_path)
+        self.received = 0
+
+    def request_manifest(self):
+        """The offsets and tail digests for the pullScans command."""
+        manifest = {}
+        for device_path, entry in self.manifest.items():
+            path = os.path.join(self.out_dir, entry["folder"], "bathymetry.csv")
+            # A local copy that was deleted or edited is fetched again.
+            if entry.get("offset") and os.path.exists(path):
+                if os.path.getsize(path) == entry["offset"]:
+                    manifest[device_path] = {
+                        "offset": entry["offset"],
+                        "tail": entry["tail"],
+                    }
+        return manifest
+
+    def local_path(self, device_path):
+        entry = self.manifest.setdefault(
+            device_path,
+            {
+                "folder": folder_name(device_path, self.degree, self.sand),
+                "offset": 0,
+                "tail": None,
+            },
+        )
+        return os.path.join(self.out_dir, entry["folder"], "bathymetry.csv")
+
+    def write(self, message, payload):
+        """Append one scanChunk; returns False if it doesn't fit our copy."""
+        raw = gzip.decompress(payload)
+        if zlib.crc32(raw) != message["crc"] or len(raw) != message["length"]:
+            print(f"[pull] Corrupt chunk for {message['path']}, skipping")
+            return False
+
+        device_path = message["path"]
+        path = self.local_path(device_path)
+        entry = self.manifest[device_path]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mode = "r+b" if os.path.exists(path) else "wb"
+        with open(path, mode) as f:
+            if message.get("reset"):
+                f.truncate(0)
+            elif f.seek(0, os.SEEK_END) != message["offset"]:
+                print(
+                    f"[pull] {path} holds {f.tell()} bytes but the chunk starts "
+                    f"at {message['offset']}, skipping"
+                )
+                return False
+            f.seek(message["offset"])
+            f.write(raw)
+            f.truncate()
+        entry["offset"] = message["offset"] + len(raw)
+        entry["tail"] = tail_digest(path)
+        save_manifest(self.manifest_path, self.manifest)
+        self.received += len(raw)
+        return True
+
+
+async def pull(args, writer):
+    """One pullScans round trip; returns the agent's final status."""
+    url = f"{args.server}?deviceId={args.controller}&role=controller"
+    async with connect(url, max_size=MAX_FRAME, ping_interval=None) as ws:
+        await ws.send(
+            json.dumps(
+                {
+                    "action": "hello",
+                    "deviceId": args.device,
+                    "sender": args.controller,
+                    "frames": ["binary", "json"],
+                }
+            )
+        )
+        request = {
+            "action": "pullScans",
+            "deviceId": args.device,
+            "sender": args.controller,
+            "id": f"pull-{int(time.time() * 1000)}",
+            "manifest": writer.request_manifest(),
+            "window": args.window,
+        }
+        if args.root:
+            request["root"] = args.root
+        if args.pattern:
+            request["pattern"] = args.pattern
+        await ws.send(json.dumps(request))
+
+        reassembler = Reassembler()
+        waiting = {}  # frame message id -> scanChunk waiting for its payload
+        while True:
+            msg = await asyncio.wait_for(ws.recv(), args.timeout)
+            if is_frame(msg):
+                complete = reassembler.add(msg)
+                if complete is None:
+                    continue
+                header, payload = complete
+                if header.content_type != CONTENT_SCAN_GZIP:
+                    continue
+                message = waiting.pop(header.message_id, None)
+                if message is None:
+                    continue
+            else:
+                message = json.loads(msg)
+                if message.get("action") == "pullScans":
+                    if message["status"] == "started":
+                        print(f"[pull] {len(message['files'])} files on the device")
+                        continue
+                    if message["status"] != "ok":
+                        return message
+                    continue
+                if message.get("action") != "scanChunk":
+                    continue
+                if "scan_frames" in message:
+                    waiting[message["scan_frames"]["id"]] = message
+                    continue
+                payload = base64.b64decode(message["data_b64"])
+
+            if writer.write(message, payload):
+                print(
+                    f"[pull] {message['path']}: "
+                    f"{message['offset'] + message['length']}/{message['size']} bytes"
+                )
+            await ws.send(
+                json.dumps(
+                    {
+                        "action": "scanAck",
+                        "deviceId": args.device,
+                        "sender": args.controller,
+                        "transfer": message["transfer"],
+                        "seq": message["seq"],
+                    }
+                )
+            )
+
+
+async def main(args):
+    writer = ScanWriter(args.out, args.degree, args.sand)
+    while True:
+        try:
+            result = await pull(args, writer)
+            print(f"[pull] {result.get('status')}: {writer.received} bytes received")
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"[pull] Pull failed: {e}")
+        if not args.follow:
+            return
+        await asyncio.sleep(args.follow)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("device", help="deviceId of the phone's agent")
+    parser.add_argument("--server", help="relay URL (default: the agent's)")
+    parser.add_argument("--controller", default=CONTROLLER_ID)
+    parser.add_argument("--out", default=OUT_DIR)
+    parser.add_argument(
+        "--degree", type=float, required=True, help="scan angle for new files"
+    )
+    parser.add_argument(
+        "--sand", type=float, required=True, help="sand height (cm) for new files"
+    )
+    parser.add_argument("--root", help="scan directory on the phone")
+    parser.add_argument("--pattern", help="scan file name pattern")
+    parser.add_argument("--window", type=int, default=WINDOW, help="chunks in flight")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument(
+        "--follow", type=float, default=0, help="pull again every N seconds"
+    )
+    args = parser.parse_args()
+    args.server = args.server or relay_server()
+    asyncio.run(main(args))
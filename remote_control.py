@@ -1,385 +1,1609 @@
 import asyncio
-import subprocess
+import base64
+import gzip
 import json
+import math
+import os
 import random
+import shlex
 from websockets import connect, ConnectionClosed
-import uiautomator2 as u2
-import gzip
-import base64
-from io import BytesIO
 import traceback
+import time
+import zlib
+from collections import deque
+
+import metrics
+from automation import Routine
+from device import DeviceSession
+from framing import (
+    CONTENT_JPEG,
+    CONTENT_JSON,
+    CONTENT_SCAN_GZIP,
+    CONTENT_UI_GZIP,
+    CONTENT_WEBP,
+    Reassembler,
+    encode_frames,
+    is_frame,
+)
+from popups import MAX_INTERVAL, PopupMatcher, PopupWatcher
+from scan_export import (
+    CHUNK_BYTES,
+    SCAN_PATTERN,
+    SCAN_ROOT,
+    WINDOW,
+    AckTimeout,
+    Credits,
+    list_files,
+    read_range,
+    resume_offset,
+)
+from streaming import (
+    BACKLOG_BYTES,
+    MIN_FRAME_INTERVAL,
+    SCREEN_MAX_WIDTH,
+    SCREEN_QUALITY,
+    LinkEstimator,
+    encode_screenshot,
+    frame_interval,
+)
+from ui_diff import is_empty
+from ui_encoding import MAX_FRAME, chunk_messages
+from ui_snapshot import ui_fingerprint
+
+# Step statuses that count as a failure inside a batch.
+FAILED_STATUSES = {"error", "not_found", "no_button", "bad_bounds", "wait_timeout"}
+BATCH_WAIT_TIMEOUT = 10.0
+BATCH_RETRY_DELAY = 1.0
+
+# How many relay message ids to remember for de-duplicating replays.
+PROCESSED_RELAY_IDS = 1000
+
+# Application-level heartbeat. API Gateway answers websocket pings itself, so
+# a half-open connection behind it only shows up as messages going unanswered:
+# the relay echoes each heartbeat, and after HEARTBEAT_MISSES intervals with
+# nothing received the connection is dropped and re-established at once.
+# Until a heartbeat has been echoed (API Gateway alone never does) protocol
+# pongs count as hearing from the relay.
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "15"))
+HEARTBEAT_MISSES = 3
+RTT_SAMPLES = 100
+# Connections that stayed up at least this long reconnect without backoff.
+HEALTHY_CONNECTION = 60.0
+# Reported with the connection metrics so latency can be compared by site.
+SITE = os.environ.get("AGENT_SITE", "default")
+
+# Serve the timing histograms for Prometheus on this local port, if set.
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+# Actions that don't touch the screen are answered as soon as they arrive;
+# everything else goes through the per-device queue and runs in order.
+READ_ONLY_ACTIONS = {
+    "ping",
+    "status",
+    "dumpUi",
+    "cancel",
+    "hello",
+    "stats",
+    "guard",
+    "subscribe",
+    "unsubscribe",
+    "peerDisconnected",
+    "runRoutine",
+    "stopRoutine",
+    "pullScans",
+    "scanAck",
+}
+
+# A subscription (pushed UI updates) lapses unless its controller sends
+# something within the lease. The hierarchy is polled every STREAM_POLL
+# seconds, backing off to STREAM_MAX_POLL while nothing changes.
+SUBSCRIPTION_LEASE = 60.0
+STREAM_POLL = 1.0
+STREAM_MAX_POLL = 4.0
+
+# runRoutine: seconds between checks while no rule applies, how long it may
+# go without any rule applying (outside a timer) before giving up, and how
+# often to report progress while waiting.
+ROUTINE_POLL = 1.0
+ROUTINE_STALL = 120.0
+ROUTINE_PROGRESS = 60.0
 
 SERVER_URL = (
     "wss://ywh1uzhhk9.execute-api.us-east-2.amazonaws.com/test?deviceId=testAndroid"
 )
 APP = "eu.deeper.fishdeeper"
+ACTIVITY = "eu.deeper.app.scan.live.MainScreenActivity"
+
+# After each command we wait for the UI to settle instead of sleeping a fixed
+# time: the hierarchy is polled until its fingerprint has not changed for
+# `quiet` seconds, or `timeout` expires. Commands can override these with
+# "settleQuiet" / "settleTimeout", or ask for the old behaviour with
+# {"settle": "fixed", "sleep": <seconds>}.
+SETTLE_QUIET = 1.0
+SETTLE_TIMEOUT = 10.0
+SETTLE_POLL = 0.25
+SETTLE_LIMITS = {
+    "launch": {"quiet": 2.0, "timeout": 20.0},
+    "restart": {"quiet": 2.0, "timeout": 20.0},
+}
+
 
+def attach_ui_state(session, data, response, xml=None):
+    """Add the UI state to a response.
 
-def capture_ui_state_zipped():
+    Controllers that send {"uiDiff": true, "uiSeq": <seq they hold>} get a
+    node-level diff against the last tree we sent them; everyone else, and
+    anyone whose seq doesn't match or who sends "fullSnapshot", gets the full
+    gzip'd dump. Either way "ui_seq" tells them what they now hold.
 
+    Peers that negotiated binary frames get the gzip'd dump as raw frames
+    after the response instead of base64 inside it.
+
+    Returns any follow-up messages: binary frames, or the uiStateChunk
+    messages needed to carry a dump too big for one frame.
+    """
     try:
-        d = u2.connect()
-        xml = d.dump_hierarchy()
+        if xml is None:
+            xml = session.dump_hierarchy()
+
+        controller = data.get("sender")
+        if data.get("uiDiff") and controller:
+            # Diffs are against the tree the controller decoded, which has
+            # the encoder's default attributes stripped.
+            seq, base_seq, delta = session.ui_states.update(
+                controller,
+                session.ui_encoder.as_sent(xml),
+                base_seq=data.get("uiSeq"),
+                full=bool(data.get("fullSnapshot")),
+            )
+            response["ui_seq"] = seq
+            if delta is not None:
+                # Big diffs (screen changes) can be larger than the gzip'd dump;
+                # both leave the controller holding the same tree at `seq`.
+                # The last dump's encoded size is a good enough yardstick, so
+                # the dump is only encoded when the diff isn't clearly smaller.
+                size = len(json.dumps(delta))
+                full = session.ui_encoder.last_chars
+                if full is None or size >= full:
+                    chunks = session.ui_encoder.encode(xml)
+                    if size >= sum(map(len, chunks)):
+                        return chunk_messages(response, chunks)
+                response["ui_base_seq"] = base_seq
+                response["ui_diff"] = delta
+                return []
 
-        buf = BytesIO()
-        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
-            f.write(xml.encode("utf-8"))
+        if data.get("frames") == "binary" or controller in session.binary_peers:
+            message_id, frames = encode_frames(
+                session.ui_encoder.encode_bytes(xml), CONTENT_UI_GZIP, controller
+            )
+            response["ui_state_frames"] = {"id": message_id, "chunks": len(frames)}
+            return frames
 
-        compressed_b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-        return True, compressed_b64
+        return chunk_messages(response, session.ui_encoder.encode(xml))
     except Exception as e:
-        return False, str(e)
+        response["error"] = str(e)
+        return []
+
+
+async def wait_for_ui_settle(
+    session, quiet=SETTLE_QUIET, timeout=SETTLE_TIMEOUT, poll=SETTLE_POLL
+):
+    """Poll until the UI is stable; returns (settled, settle_s, waited_s, xml)."""
+    start = time.monotonic()
+    last_fp = None
+    changed_at = start
+    while True:
+        xml = await session.run(session.dump_hierarchy, True)
+        now = time.monotonic()
+        fp = ui_fingerprint(xml)
+        if fp != last_fp:
+            last_fp = fp
+            changed_at = now
+        elif now - changed_at >= quiet:
+            return True, changed_at - start, now - start, xml
+        if now - start >= timeout:
+            return False, changed_at - start, now - start, xml
+        await asyncio.sleep(poll)
+
 
+async def settle_ui(session, cmd_type, data, response):
+    """Wait for the UI after a command and record the timings in the response."""
+    if data.get("settle") == "fixed":
+        await asyncio.sleep(float(data.get("sleep", 10.0)))
+        return None
 
-def run_as_root(command: str):
-    process = subprocess.Popen(
-        ["su"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    stdout, stderr = process.communicate(command + "\n")
-    print("stdout:", stdout.strip())
-    print("stderr:", stderr.strip())
+    limits = SETTLE_LIMITS.get(cmd_type, {})
+    quiet = float(data.get("settleQuiet", limits.get("quiet", SETTLE_QUIET)))
+    timeout = float(data.get("settleTimeout", limits.get("timeout", SETTLE_TIMEOUT)))
 
+    settled, settle_s, waited_s, xml = await wait_for_ui_settle(session, quiet, timeout)
+    response["settled"] = settled
+    response["settle_ms"] = round(settle_s * 1000)
+    response["settle_wait_ms"] = round(waited_s * 1000)
+    if not settled:
+        print(f"UI did not settle within {timeout}s after {cmd_type}")
+    return xml
 
-async def handle_command(ws, command):
+
+def parse_command(raw):
+    """Decode a relay message into a command dict, or None if it isn't one."""
     try:
-        data = json.loads(command)
+        data = json.loads(raw)
+    except json.JSONDecodeError:
+        print("Invalid JSON received")
+        return None
 
-        if data.get("message") in ("Forbidden", "forbidden"):
-            return
+    if data.get("message") in ("Forbidden", "forbidden"):
+        return None
+
+    if isinstance(data.get("body"), str):
+        try:
+            data = json.loads(data["body"])
+        except json.JSONDecodeError:
+            pass
+
+    return data
+
+
+def command_deadline(data):
+    """Absolute deadline of a command from its deadline or timeout field.
+
+    Fixed on arrival so queueing time counts against it. Raises ValueError
+    if either field isn't a number.
+    """
+    for field in ("deadline", "timeout"):
+        value = data.get(field)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{field} must be a number")
+        if not math.isfinite(value):
+            raise ValueError(f"{field} must be finite")
+    if data.get("deadline") is not None:
+        return data["deadline"]
+    if data.get("timeout") is not None:
+        return time.time() + data["timeout"]
+    return None
 
-        if isinstance(data.get("body"), str):
+
+def transfer_limits(data):
+    """(chunk bytes, window) for pullScans; ValueError unless both are
+    positive integers."""
+    limits = []
+    for field, default in (("chunkBytes", CHUNK_BYTES), ("window", WINDOW)):
+        value = data.get(field, default)
+        if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+            raise ValueError(f"{field} must be a positive integer")
+        limits.append(value)
+    return tuple(limits)
+
+
+def int_arg(data, field, default=None):
+    """data[field] as an int, so it is safe to put in a shell command.
+
+    Raises ValueError if it is missing (and has no default) or not a number.
+    """
+    value = data.get(field, default)
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be an integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{field} must be an integer") from None
+
+
+def tap_node(session, node, status):
+    """Tap the centre of a snapshot node; returns the response status."""
+    if node.center is None:
+        print(f"Invalid bounds format for {node.attrib.get('bounds')}")
+        return "bad_bounds"
+    cx, cy = node.center
+    session.run_as_root(f"input tap {cx} {cy}")
+    print(f"Tapped at ({cx}, {cy})")
+    return status
+
+
+def visual_locator(session):
+    """The session's template locator, scaled for the phone's screen density."""
+    if session.visual is None:
+        from visual import VisualLocator, parse_density
+
+        _, stdout, _ = session.root_shell.execute("wm density")
+        session.visual = VisualLocator(density=parse_density(stdout))
+    return session.visual
+
+
+def execute_action(session, cmd_type, data, response):
+    """Run one command against the device. Blocking; called from the executor."""
+    if cmd_type == "tap":
+        if data.get("x") is not None and data.get("y") is not None:
+            x, y = int_arg(data, "x"), int_arg(data, "y")
+            session.run_as_root(f"input tap {x} {y}")
+            print(f"Executed: tap {x} {y}")
+
+    elif cmd_type == "swipe":
+        x1, y1, x2, y2 = (int_arg(data, field) for field in ("x1", "y1", "x2", "y2"))
+        duration = int_arg(data, "duration", 300)
+        session.run_as_root(f"input swipe {x1} {y1} {x2} {y2} {duration}")
+        print(f"Executed: swipe from ({x1},{y1}) to ({x2},{y2})")
+
+    elif cmd_type == "launch":
+        package = data.get("package")
+        if package:
+            session.run_as_root(f"am start -n {shlex.quote(package)}")
+            print(f"Launched package: {package}")
+
+    elif cmd_type == "restart":
+        package = data.get("package") or session.package or APP
+        activity = data.get("activity") or session.activity or ACTIVITY
+        session.run_as_root(f"am force-stop {shlex.quote(package)}")
+        time.sleep(1.0)
+        session.run_as_root(f"am start -n {shlex.quote(f'{package}/{activity}')}")
+        print(f"Restarted: {package}/{activity}")
+
+    elif cmd_type == "close":
+        package = data.get("package") or session.package or APP
+        session.run_as_root(f"am force-stop {shlex.quote(package)}")
+        print(f"Closed: {package}")
+
+    elif cmd_type == "clickText":
+        txt = data.get("text")
+        if not txt:
+            response["status"] = "error"
+            response["error"] = "Missing text field"
+        else:
             try:
-                data = json.loads(data["body"])
-            except json.JSONDecodeError:
-                pass
+                print(f"Searching for text: '{txt}'")
+                snapshot = session.snapshot()
 
-        cmd_type = data.get("action") or data.get("type")
-        response = {"action": cmd_type, "status": "ok"}
-        response["target"] = data.get("sender", None)
+                target = None
+                node = snapshot.find(text=txt)
+                if node is not None:
+                    target = node.click_target()
+                    print(f"Clicking {target} for exact '{txt}'")
+                else:
+                    for node in snapshot.find_all_text_containing(txt):
+                        if node.clickable or node.ancestor is not None:
+                            target = node.click_target()
+                            print(f"Clicking {target} for partial '{txt}'")
+                            break
 
-        # Execute commands
-        if cmd_type == "tap":
-            x, y = data.get("x"), data.get("y")
-            if x is not None and y is not None:
-                run_as_root(f"input tap {x} {y}")
-                print(f"Executed: tap {x} {y}")
-
-        elif cmd_type == "swipe":
-            x1, y1, x2, y2 = (
-                data.get("x1"),
-                data.get("y1"),
-                data.get("x2"),
-                data.get("y2"),
-            )
-            duration = data.get("duration", 300)
-            run_as_root(f"input swipe {x1} {y1} {x2} {y2} {duration}")
-            print(f"Executed: swipe from ({x1},{y1}) to ({x2},{y2})")
-
-        elif cmd_type == "launch":
-            package = data.get("package")
-            if package:
-                run_as_root(f"am start -n {package}")
-                print(f"Launched package: {package}")
-
-        elif cmd_type == "restart":
-            package = data.get("package") or "eu.deeper.fishdeeper"
-            activity = (
-                data.get("activity") or "eu.deeper.app.scan.live.MainScreenActivity"
+                if target is None:
+                    print(f"No clickable node or ancestor found for '{txt}'")
+                    response["status"] = "not_found"
+                else:
+                    response["status"] = tap_node(session, target, "clicked")
+
+            except Exception as e:
+                print(f"Error in clickText: {e}")
+                traceback.print_exc()
+                session.reset()
+                response["status"] = "error"
+                response["error"] = str(e)
+
+    elif cmd_type == "clickById":
+        rid = data.get("resourceId")
+        if not rid:
+            response["status"] = "error"
+            response["error"] = "Missing resourceId field"
+        else:
+            try:
+                print(f"Searching XML for resource-id='{rid}' and nearby Button")
+                snapshot = session.snapshot()
+
+                node = snapshot.find(resource_id=rid)
+                if node is None:
+                    print(f"No node found with resource-id='{rid}'")
+                    response["status"] = "not_found"
+                else:
+                    button = snapshot.nearest_button(node)
+                    if button is None:
+                        print(f"No clickable element found near '{rid}'")
+                        response["status"] = "no_button"
+                    else:
+                        print(f"Found {button} for '{rid}'")
+                        response["status"] = tap_node(session, button, "clicked_button")
+
+            except Exception as e:
+                print(f"Error in clickById: {e}")
+                traceback.print_exc()
+                response["status"] = "error"
+                response["error"] = str(e)
+
+    elif cmd_type == "clickTextDirect":
+        txt = data.get("text")
+        if not txt:
+            response["status"] = "error"
+            response["error"] = "Missing text field"
+        else:
+            try:
+                print(f"Clicking directly on text node '{txt}'")
+                node = session.snapshot().find(text=txt)
+                if node is None:
+                    print(f"No node found with text='{txt}'")
+                    response["status"] = "not_found"
+                else:
+                    response["status"] = tap_node(session, node, "clicked_direct_text")
+
+            except Exception as e:
+                print(f"Error in clickTextDirect: {e}")
+                traceback.print_exc()
+                response["status"] = "error"
+                response["error"] = str(e)
+
+    elif cmd_type in ("findImage", "clickImage"):
+        names = data.get("templates") or [data.get("template") or "connect_button"]
+        try:
+            locator = visual_locator(session)
+            with metrics.span("screenshot"):
+                screen = session.call(lambda d: d.screenshot(format="opencv"))
+            found = locator.locate(
+                screen, names, roi=data.get("roi"), threshold=data.get("threshold")
             )
-            run_as_root(f"am force-stop {package}")
-            await asyncio.sleep(1.0)
-            run_as_root(f"am start -n {package}/{activity}")
-            print(f"Restarted: {package}/{activity}")
+            response["matches"] = {
+                name: match._asdict() if match else None
+                for name, match in found.items()
+            }
+            hits = [found[name] for name in names if found[name] is not None]
+            if not hits:
+                response["status"] = "not_found"
+            elif cmd_type == "clickImage":
+                session.run_as_root(f"input tap {hits[0].x} {hits[0].y}")
+                print(
+                    f"Tapped image match {hits[0].name} at ({hits[0].x}, {hits[0].y})"
+                )
+                response["status"] = "clicked"
 
-        elif cmd_type == "ping":
-            response["status"] = "pong"
+        except Exception as e:
+            print(f"Error in {cmd_type}: {e}")
+            traceback.print_exc()
+            response["status"] = "error"
+            response["error"] = str(e)
 
-        elif cmd_type == "clickText":
-            txt = data.get("text")
-            if not txt:
+    elif cmd_type == "clickByDescription":
+        desc = data.get("description")
+        if not desc:
+            response["status"] = "error"
+            response["error"] = "Missing description field"
+        else:
+            try:
+                print(f"Searching for content-desc: '{desc}'")
+                snapshot = session.snapshot()
+                node = snapshot.find(description=desc) or snapshot.find(text=desc)
+                if node is None:
+                    response["status"] = "not_found"
+                else:
+                    target = node.click_target()
+                    print(f"Clicking {target} for '{desc}'")
+                    response["status"] = tap_node(session, target, "clicked")
+
+            except Exception as e:
+                print(f"Error in clickByDescription: {e}")
+                traceback.print_exc()
+                session.reset()
                 response["status"] = "error"
-                response["error"] = "Missing text field"
+                response["error"] = str(e)
+
+
+async def run_action(session, cmd_type, data, response):
+    """Execute one action and wait for the UI; returns the settled dump, if any."""
+    generation = session.generation
+
+    with metrics.span("action"):
+        await session.run(execute_action, session, cmd_type, data, response)
+
+    # Only wait for the screen to settle if the command touched it; otherwise
+    # the dump used for the lookup is still good for the response.
+    xml = None
+    if session.generation != generation:
+        try:
+            with metrics.span("settle"):
+                xml = await settle_ui(session, cmd_type, data, response)
+        except Exception as e:
+            print(f"Settle detection failed: {e}")
+    return xml
+
+
+async def wait_for_condition(session, condition, timeout, poll=SETTLE_POLL):
+    """Poll fresh snapshots until `condition` holds; returns the matching dump."""
+    deadline = time.monotonic() + timeout
+    while True:
+        snapshot = await session.run(session.snapshot, True)
+        if snapshot.matches(condition):
+            return snapshot.xml
+        if time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(poll)
+
+
+async def run_batch(session, data, response):
+    """Run an ordered list of steps as one command.
+
+    Each step is an ordinary command dict, plus optionally
+      "waitFor":   a condition (see UiSnapshot.matches) to wait for afterwards
+      "timeout":   how long to wait for it (BATCH_WAIT_TIMEOUT)
+      "onFailure": "abort" (default), "continue" or "retry"
+      "retries":   extra attempts for "retry" (1)
+    Only the final UI state is returned, with per-step status and timings.
+    """
+    steps = data.get("steps") or []
+    results = []
+    response["steps"] = results
+    xml = None
+
+    for index, step in enumerate(steps):
+        step_type = step.get("action") or step.get("type")
+        policy = step.get("onFailure", "abort")
+        attempts = 1 + (int(step.get("retries", 1)) if policy == "retry" else 0)
+        start = time.monotonic()
+
+        for attempt in range(1, attempts + 1):
+            result = {"action": step_type, "status": "ok"}
+            if step_type in ("batch", None):
+                result["status"] = "error"
+                result["error"] = "Invalid batch step"
+                break
+            try:
+                xml = await run_action(session, step_type, step, result)
+                if step.get("waitFor"):
+                    timeout = float(step.get("timeout", BATCH_WAIT_TIMEOUT))
+                    matched = await wait_for_condition(
+                        session, step["waitFor"], timeout
+                    )
+                    if matched is None:
+                        result["status"] = "wait_timeout"
+                    else:
+                        xml = matched
+            except Exception as e:
+                print(f"Error in batch step {index} ({step_type}): {e}")
+                result["status"] = "error"
+                result["error"] = str(e)
+            if result["status"] not in FAILED_STATUSES:
+                break
+            print(f"Batch step {index} ({step_type}) failed: {result['status']}")
+            if attempt < attempts:
+                # Give the screen a moment and make the retry look at a fresh dump.
+                await asyncio.sleep(BATCH_RETRY_DELAY)
+                await session.run(session.dump_hierarchy, True)
+
+        result["index"] = index
+        result["attempts"] = attempt
+        result["ms"] = round((time.monotonic() - start) * 1000)
+        results.append(result)
+
+        if result["status"] in FAILED_STATUSES and policy != "continue":
+            response["status"] = "aborted"
+            break
+    else:
+        failed = any(r["status"] in FAILED_STATUSES for r in results)
+        response["status"] = "partial" if failed else "ok"
+
+    response["completed"] = len(results)
+    return xml
+
+
+async def handle_command(ws, data, session):
+    cmd_type = data.get("action") or data.get("type")
+    response = {"action": cmd_type, "status": "ok"}
+    response["target"] = data.get("sender", None)
+    if data.get("id") is not None:
+        response["id"] = data["id"]
+    metrics.action(cmd_type)
+
+    try:
+        if cmd_type == "ping":
+            response["status"] = "pong"
+            await ws.send(json.dumps(response))
+            return
+
+        with metrics.span("total"):
+            if cmd_type == "batch":
+                xml = await run_batch(session, data, response)
             else:
+                xml = await run_action(session, cmd_type, data, response)
+
+            with metrics.span("encode"):
+                follow_ups = await session.run(
+                    attach_ui_state, session, data, response, xml
+                )
+
+            with metrics.span("send"):
+                await ws.send(json.dumps(response))
+                for message in follow_ups:
+                    await ws.send(message if is_frame(message) else json.dumps(message))
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print("Error:", e)
+        await ws.send(json.dumps({"error": str(e), "id": data.get("id")}))
+
+
+class RelayCursor:
+    """Relay message ids this agent has already processed.
+
+    The relay replays unacknowledged messages after a reconnect; anything
+    in here was handled and only needs its ack resent. Each connection asks
+    the relay to drop everything up to resume_from(), the highest id below
+    which every message received was handled. An id stays unfinished until
+    its command completes, whatever happens to connections meanwhile. Once
+    a relay has accepted a resumeFrom, a relay id at or below it means the
+    relay lost its log (restarted with a fresh database and counts from 1
+    again): the cursor then forgets what it had seen.
+    """
+
+    def __init__(self, size=PROCESSED_RELAY_IDS):
+        self._recent = deque(maxlen=size)
+        self._seen = set()
+        self._in_flight = set()
+        self.highest = 0
+        self.floor = 0
+
+    def resume_from(self):
+        """The resumeFrom for a new connection; unhandled ids will be replayed."""
+        return min(self._in_flight) - 1 if self._in_flight else self.highest
+
+    def connected(self, resume_from):
+        """A connection asking to resume from resume_from is open."""
+        self.floor = resume_from
+
+    def seen(self, relay_id):
+        return relay_id in self._seen
+
+    def received(self, relay_id):
+        """Note a relay id arriving; True if it was already processed."""
+        if relay_id <= self.floor:
+            print(f"Relay id {relay_id} went backwards, forgetting processed ids")
+            self._recent.clear()
+            self._seen.clear()
+            self._in_flight.clear()
+            self.highest = self.floor = 0
+        if relay_id in self._seen:
+            return True
+        self._in_flight.add(relay_id)
+        return False
+
+    def done(self, relay_id):
+        self._in_flight.discard(relay_id)
+        self.highest = max(self.highest, relay_id)
+        if relay_id in self._seen:
+            return
+        if len(self._recent) == self._recent.maxlen:
+            self._seen.discard(self._recent[0])
+        self._recent.append(relay_id)
+        self._seen.add(relay_id)
+
+
+class ConnectionHealth:
+    """Heartbeat round trips and reconnect history of the relay connection.
+
+    Lives across reconnects, like the session and relay cursor.
+    """
+
+    def __init__(self, site=SITE):
+        self.site = site
+        self.rtts = deque(maxlen=RTT_SAMPLES)
+        self.pending = {}
+        self.heartbeats = 0
+        self.missed = 0
+        self.connects = 0
+        self.dead_peers = 0
+        self.dead = False
+        self.connected_at = None
+        self.disconnected_at = time.monotonic()
+        self.disconnected_s = 0.0
+        self.last_uptime = 0.0
+        self.last_heard = None
+        # Whether the relay echoes heartbeats on this connection.
+        self.echoing = False
+
+    def connected(self):
+        now = time.monotonic()
+        self.disconnected_s += now - self.disconnected_at
+        if self.connects:
+            print(
+                f"Reconnected after {now - self.disconnected_at:.1f}s"
+                f" ({self.connects} reconnects)"
+            )
+        self.connects += 1
+        self.connected_at = self.last_heard = now
+        self.dead = False
+        self.echoing = False
+        self.pending.clear()
+
+    def disconnected(self):
+        if self.connected_at is None:
+            return
+        now = time.monotonic()
+        self.last_uptime = now - self.connected_at
+        self.missed += len(self.pending)
+        self.pending.clear()
+        self.connected_at = None
+        self.disconnected_at = now
+
+    def heard(self):
+        self.last_heard = time.monotonic()
+
+    def silent_for(self):
+        return time.monotonic() - self.last_heard
+
+    def sent(self):
+        self.heartbeats += 1
+        self.pending[self.heartbeats] = time.monotonic()
+        return self.heartbeats
+
+    def answered(self, seq):
+        self.echoing = True
+        sent = self.pending.pop(seq, None)
+        if sent is None:
+            return
+        self.rtts.append((time.monotonic() - sent) * 1000)
+        # Anything older than an answered heartbeat is not coming back.
+        for older in [s for s in self.pending if s < seq]:
+            del self.pending[older]
+            self.missed += 1
+
+    def snapshot(self):
+        now = time.monotonic()
+        disconnected_s = self.disconnected_s
+        if self.connected_at is None:
+            disconnected_s += now - self.disconnected_at
+        rtt = None
+        if self.rtts:
+            ordered = sorted(self.rtts)
+            rtt = {
+                "last": round(self.rtts[-1], 1),
+                "avg": round(sum(ordered) / len(ordered), 1),
+                "min": round(ordered[0], 1),
+                "p95": round(
+                    ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1
+                ),
+                "max": round(ordered[-1], 1),
+            }
+        return {
+            "site": self.site,
+            "connected": self.connected_at is not None,
+            "connection_uptime_s": (
+                round(now - self.connected_at, 1) if self.connected_at else 0.0
+            ),
+            "reconnects": max(0, self.connects - 1),
+            "disconnected_s": round(disconnected_s, 1),
+            "dead_peers": self.dead_peers,
+            "heartbeats": self.heartbeats,
+            "heartbeats_missed": self.missed,
+            "heartbeat_echo": self.echoing,
+            "rtt_ms": rtt,
+        }
+
+
+async def heartbeat(ws, health, interval=HEARTBEAT_INTERVAL, misses=HEARTBEAT_MISSES):
+    """Send heartbeats and drop the connection once the relay goes quiet.
+
+    Runs beside the receiver, so it keeps going while commands execute.
+    Until the relay has echoed a heartbeat (API Gateway never does) an idle
+    connection would look dead, so a protocol ping's pong counts as hearing
+    from it instead.
+    """
+    while True:
+        seq = health.sent()
+        try:
+            await asyncio.wait_for(
+                ws.send(json.dumps({"action": "heartbeat", "seq": seq})), interval
+            )
+        except asyncio.TimeoutError:
+            pass
+        if not health.echoing:
+            try:
+                pong = await ws.ping()
+                await asyncio.wait_for(pong, interval)
+                health.heard()
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.sleep(interval)
+        if health.silent_for() > interval * misses:
+            print(
+                f"[heartbeat] Nothing heard for {health.silent_for():.1f}s, reconnecting"
+            )
+            health.dead_peers += 1
+            health.dead = True
+            ws.transport.abort()
+            return
+
+
+class Subscription:
+    """One controller's stream of UI updates and, optionally, screenshots.
+
+    Options come from the subscribe command: "interval" (hierarchy poll
+    seconds), "lease", "screenshots" (bool), "format" ("jpeg" or "webp"),
+    "maxWidth", "quality", "minInterval" (seconds between screenshots) and
+    "maxKbps" (cap on the screenshot bandwidth).
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.sender = data.get("sender")
+        self.poll = float(data.get("interval", STREAM_POLL))
+        self.lease = float(data.get("lease", SUBSCRIPTION_LEASE))
+        self.screenshots = bool(data.get("screenshots"))
+        self.format = "webp" if data.get("format") == "webp" else "jpeg"
+        self.max_width = int(data.get("maxWidth", SCREEN_MAX_WIDTH))
+        self.quality = int(data.get("quality", SCREEN_QUALITY))
+        self.min_interval = float(data.get("minInterval", MIN_FRAME_INTERVAL))
+        max_kbps = data.get("maxKbps")
+        self.max_rate = float(max_kbps) * 1024 / 8 if max_kbps else None
+        self.task = None
+        self.updates = 0
+        self.frames = 0
+        self.dropped = 0
+        self.renew()
+
+    def renew(self):
+        self.expires = time.monotonic() + self.lease
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def snapshot(self):
+        return {
+            "screenshots": self.screenshots,
+            "updates": self.updates,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "expires_in_s": round(max(0.0, self.expires - time.monotonic()), 1),
+        }
+
+
+class DeviceJobs:
+    """Device work that outlives relay connections: popup guard and routine.
+
+    One lives as long as the listener; each connection's CommandPipeline
+    attaches to it while it is up. Events go out over whichever connection
+    is attached, and are dropped while there is none (the routine shows up
+    in status once a controller asks again).
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.pipeline = None
+        # Held while a queued command runs, so background work never taps in
+        # the middle of one.
+        self.ui_lock = asyncio.Lock()
+        self.guard_task = None
+        self.routine = None
+        self.routine_task = None
+
+    def attach(self, pipeline):
+        self.pipeline = pipeline
+
+    def detach(self, pipeline):
+        if self.pipeline is pipeline:
+            self.pipeline = None
+
+    async def notify(self, data, cmd_type, status, **extra):
+        if self.pipeline is None:
+            return
+        try:
+            await self.pipeline.reply(data, cmd_type, status, **extra)
+        except ConnectionClosed:
+            pass
+
+    def guard(self, data):
+        """Start ({"enable": true}, the default) or stop the popup guard.
+
+        Rules default to popups.POPUP_*; "texts", "resourceIds" and
+        "patterns" replace them. Returns whether the guard is now running.
+        """
+        if not data.get("enable", True):
+            self.stop_guard()
+            return False
+
+        rules = {}
+        for key, arg in (
+            ("texts", "texts"),
+            ("resourceIds", "resource_ids"),
+            ("patterns", "patterns"),
+        ):
+            if data.get(key) is not None:
+                rules[arg] = data[key]
+        watcher = PopupWatcher(
+            self.session.snapshot,
+            lambda x, y: self.session.run_as_root(f"input tap {x} {y}"),
+            PopupMatcher(**rules),
+            max_interval=float(data.get("maxInterval", MAX_INTERVAL)),
+        )
+        self.stop_guard()
+        self.guard_task = asyncio.create_task(self.run_guard(data, watcher))
+        return True
+
+    def stop_guard(self):
+        if self.guard_task is not None:
+            self.guard_task.cancel()
+            self.guard_task = None
+
+    async def run_guard(self, data, watcher):
+        while True:
+            await asyncio.sleep(watcher.interval)
+            try:
+                async with self.ui_lock:
+                    handled = await self.session.run(watcher.check)
+            except Exception as e:
+                print(f"[guard] Popup check failed: {e}")
+                continue
+            if handled is not None:
+                rule, (x, y) = handled
+                await self.notify(data, "popup", "dismissed", rule=rule, x=x, y=y)
+
+    def start_routine(self, data):
+        """Run a routine on the device, replacing any that is running.
+
+        "routine" is a name from automation.ROUTINES (default "scan") or a
+        rule table; "durations" gives the timer lengths in seconds, e.g.
+        {"scan": 1800}. Progress comes back as "routine" events: started,
+        step (after each rule fires), progress (while waiting), and finally
+        finished, failed or stopped.
+        """
+        routine = Routine(data.get("routine", "scan"), data.get("durations"))
+        timing = (
+            float(data.get("poll", ROUTINE_POLL)),
+            float(data.get("stallTimeout", ROUTINE_STALL)),
+            float(data.get("progressInterval", ROUTINE_PROGRESS)),
+        )
+        self.stop_routine()
+        self.routine = routine
+        self.routine_task = asyncio.create_task(
+            self.run_routine(data, routine, *timing)
+        )
+        return routine
+
+    def stop_routine(self):
+        if self.routine_task is None:
+            return False
+        self.routine_task.cancel()
+        self.routine_task = None
+        self.routine = None
+        return True
+
+    def close(self):
+        """The listener is going away: stop whatever is running."""
+        self.stop_guard()
+        self.stop_routine()
+
+    async def run_routine(self, data, routine, poll, stall, progress):
+        metrics.action("runRoutine")
+        await self.notify(data, "routine", "started", **routine.snapshot())
+        last_step = last_report = time.monotonic()
+        try:
+            while not routine.done:
+                rule = None
+                result = {"status": "ok"}
                 try:
-                    d = u2.connect()
-                    print(f"Searching for text: '{txt}'")
-
-                    clicked = False
-
-                    node = d(text=txt)
-                    if node.exists:
-                        info = node.info
-                        if info.get("clickable"):
-                            node.click()
-                            print(f"Clicked directly on clickable text: {txt}")
-                            clicked = True
-                        else:
-                            parent = d.xpath(
-                                f"//*[@text='{txt}']/ancestor::*[@clickable='true']"
-                            )
-                            parents = parent.all()
-                            if parents:
-                                parents[0].click()
-                                print(f"Clicked clickable ancestor for exact '{txt}'")
-                                clicked = True
-                            else:
-                                node.click_exists(timeout=3.0)
-                                print(f"Fallback clicked node for '{txt}'")
-                                clicked = True
-
-                    if not clicked:
-                        for obj in d.xpath(f"//*[contains(@text,'{txt}')]").all():
-                            info = obj.info
-                            if info.get("clickable"):
-                                obj.click()
-                                print(f"Clicked clickable element containing '{txt}'")
-                                clicked = True
-                                break
-                            else:
-                                parent = d.xpath(
-                                    f"//*[contains(@text,'{txt}')]/ancestor::*[@clickable='true']"
+                    # Holding the lock keeps queued commands and the popup
+                    # guard from tapping between the check and the action.
+                    async with self.ui_lock:
+                        snapshot = await self.session.run(self.session.snapshot, True)
+                        rule = routine.next_rule(snapshot)
+                        if rule is not None:
+                            step = dict(rule.get("do") or {})
+                            if step:
+                                await run_action(
+                                    self.session, step.get("action"), step, result
                                 )
-                                parents = parent.all()
-                                if parents:
-                                    parents[0].click()
-                                    print(
-                                        f"Clicked clickable ancestor for partial '{txt}'"
-                                    )
-                                    clicked = True
-                                    break
+                            routine.fired(rule)
+                except Exception as e:
+                    print(f"[routine] Step failed: {e}")
+                    result = {"status": "error", "error": str(e)}
 
-                    if not clicked:
-                        print(f"No clickable node or ancestor found for '{txt}'")
+                now = time.monotonic()
+                if rule is not None:
+                    last_step = last_report = now
+                    await self.notify(
+                        data,
+                        "routine",
+                        "step",
+                        rule=rule.get("name"),
+                        result=result["status"],
+                        **routine.snapshot(),
+                    )
+                    if routine.failed:
+                        await self.notify(
+                            data,
+                            "routine",
+                            "failed",
+                            error=routine.failed,
+                            **routine.snapshot(),
+                        )
+                        return
+                    continue
 
-                    response["status"] = "clicked" if clicked else "not_found"
+                if routine.waiting():
+                    last_step = now
+                elif now - last_step > stall:
+                    await self.notify(
+                        data,
+                        "routine",
+                        "failed",
+                        error=f"No rule applied for {stall:.0f}s",
+                        **routine.snapshot(),
+                    )
+                    return
+                if now - last_report >= progress:
+                    last_report = now
+                    await self.notify(data, "routine", "progress", **routine.snapshot())
+                await asyncio.sleep(poll)
 
-                except Exception as e:
-                    print(f"Error in clickText: {e}")
-                    traceback.print_exc()
-                    response["status"] = "error"
-                    response["error"] = str(e)
-
-        elif cmd_type == "clickById":
-            rid = data.get("resourceId")
-            if not rid:
-                response["status"] = "error"
-                response["error"] = "Missing resourceId field"
+            await self.notify(data, "routine", "finished", **routine.snapshot())
+        except asyncio.CancelledError:
+            await self.notify(data, "routine", "stopped", **routine.snapshot())
+            raise
+        finally:
+            if self.routine is routine:
+                self.routine = None
+                self.routine_task = None
+
+
+class CommandPipeline:
+    """Serializes UI-mutating commands and answers read-only ones immediately."""
+
+    def __init__(self, ws, session, cursor, health=None, jobs=None):
+        self.ws = ws
+        self.session = session
+        self.cursor = cursor
+        self.health = health
+        self.jobs = jobs or DeviceJobs(session)
+        self.queue = asyncio.Queue()
+        self.current = None
+        self.cancelled = set()
+        self.tasks = set()
+        self.processed = 0
+        self.started_at = time.monotonic()
+        # Held while a queued command runs, so the popup guard never taps in
+        # the middle of one.
+        self.ui_lock = self.jobs.ui_lock
+        self.subscriptions = {}
+        self.transfers = {}
+
+    def submit(self, data):
+        cmd_type = data.get("action") or data.get("type")
+        subscription = self.subscriptions.get(data.get("sender"))
+        if subscription is not None:
+            subscription.renew()
+        try:
+            deadline = command_deadline(data)
+        except ValueError as e:
+            self.spawn(self.reject(data, cmd_type, str(e)))
+            return
+
+        relay_id = data.get("relayId")
+        if relay_id is not None and self.cursor.received(relay_id):
+            # Replayed after a reconnect but we already ran it; just re-ack.
+            print(f"Skipping already processed relay message {relay_id}")
+            self.spawn(self.ack(data))
+        elif cmd_type in READ_ONLY_ACTIONS:
+            self.spawn(self.run_read_only(cmd_type, data))
+        else:
+            self.queue.put_nowait((data, deadline, time.perf_counter()))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def reply(self, data, cmd_type, status, **extra):
+        response = {"action": cmd_type, "status": status, **extra}
+        response["target"] = data.get("sender", None)
+        if data.get("id") is not None:
+            response["id"] = data["id"]
+        await self.ws.send(json.dumps(response))
+
+    async def reject(self, data, cmd_type, error):
+        """Answer a command that can't be run, and ack it so it isn't replayed."""
+        await self.reply(data, cmd_type, "error", error=error)
+        await self.ack(data)
+
+    async def hello(self, data, cmd_type):
+        """Frame negotiation: peers that list "binary" get binary UI frames."""
+        sender = data.get("sender")
+        frames = data.get("frames") or []
+        if sender and "binary" in frames:
+            self.session.binary_peers.add(sender)
+        elif sender:
+            self.session.binary_peers.discard(sender)
+        chosen = "binary" if sender in self.session.binary_peers else "json"
+        await self.reply(data, cmd_type, "ok", frames=chosen)
+
+    def status(self):
+        current = None
+        if self.current is not None:
+            data, _ = self.current
+            current = {"action": data.get("action"), "id": data.get("id")}
+        status = {
+            "queued": self.queue.qsize(),
+            "running": current,
+            "processed": self.processed,
+            "uptime_s": round(time.monotonic() - self.started_at, 1),
+            "guarding": self.jobs.guard_task is not None,
+            "routine": (self.jobs.routine.snapshot() if self.jobs.routine else None),
+            "transfers": len(self.transfers),
+            "subscriptions": {
+                sender: sub.snapshot() for sender, sub in self.subscriptions.items()
+            },
+        }
+        if self.health is not None:
+            status["connection"] = self.health.snapshot()
+        return status
+
+    async def run_read_only(self, cmd_type, data):
+        try:
+            await self.handle_read_only(cmd_type, data)
+        except ConnectionClosed:
+            raise
+        except Exception as e:
+            # Bad arguments (e.g. a guard maxInterval that isn't a number).
+            print(f"Error handling {cmd_type}: {e}")
+            await self.reply(data, cmd_type, "error", error=str(e))
+        await self.ack(data)
+
+    async def handle_read_only(self, cmd_type, data):
+        if cmd_type == "status":
+            await self.reply(data, cmd_type, "ok", **self.status())
+        elif cmd_type == "cancel":
+            await self.reply(data, cmd_type, "ok", cancelled=self.cancel(data))
+        elif cmd_type == "hello":
+            await self.hello(data, cmd_type)
+        elif cmd_type == "guard":
+            await self.reply(data, cmd_type, "ok", guarding=self.jobs.guard(data))
+        elif cmd_type == "stats":
+            # {"reset": true} starts the histograms over after reporting them.
+            # Only this device's: a host process may be running several.
+            stats = metrics.REGISTRY.snapshot(self.session.serial)
+            if data.get("reset"):
+                metrics.REGISTRY.reset(self.session.serial)
+            await self.reply(data, cmd_type, "ok", enabled=metrics.ENABLED, stats=stats)
+        elif cmd_type == "subscribe":
+            subscription = self.subscribe(data)
+            if subscription is None:
+                await self.reply(
+                    data, cmd_type, "error", error="subscribe needs a sender"
+                )
             else:
-                try:
-                    import xml.etree.ElementTree as ET, re
-
-                    d = u2.connect()
-                    print(f"Searching XML for resource-id='{rid}' and nearby Button")
-
-                    xml_str = d.dump_hierarchy()
-                    root = ET.fromstring(xml_str)
-                    all_nodes = list(root.iter("node"))
-
-                    def parse_bounds(b):
-                        m = re.match(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", b)
-                        if not m:
-                            return None
-                        x1, y1, x2, y2 = map(int, m.groups())
-                        return (x1 + x2) // 2, (y1 + y2) // 2
-
-                    target_index = None
-                    for i, node in enumerate(all_nodes):
-                        if node.attrib.get("resource-id", "") == rid:
-                            target_index = i
-                            break
+                await self.reply(data, cmd_type, "ok", lease_s=subscription.lease)
+        elif cmd_type == "unsubscribe":
+            stopped = self.unsubscribe(data.get("sender"))
+            await self.reply(data, cmd_type, "ok", stopped=stopped)
+        elif cmd_type == "runRoutine":
+            try:
+                routine = self.jobs.start_routine(data)
+            except (KeyError, TypeError, ValueError) as e:
+                await self.reply(data, cmd_type, "error", error=str(e))
+            else:
+                await self.reply(data, cmd_type, "ok", **routine.snapshot())
+        elif cmd_type == "stopRoutine":
+            await self.reply(data, cmd_type, "ok", stopped=self.jobs.stop_routine())
+        elif cmd_type == "pullScans":
+            try:
+                chunk_bytes, window = transfer_limits(data)
+            except ValueError as e:
+                await self.reply(data, cmd_type, "error", error=str(e))
+            else:
+                # Answered with "started" and "done" from the transfer itself.
+                self.spawn(self.pull_scans(data, chunk_bytes, window))
+        elif cmd_type == "scanAck":
+            seq = data.get("seq")
+            credits = self.transfers.get(data.get("transfer"))
+            if isinstance(seq, bool) or not isinstance(seq, int):
+                await self.reply(
+                    data, cmd_type, "error", error="seq must be an integer"
+                )
+            elif credits is not None:
+                credits.ack(seq)
+        elif cmd_type == "peerDisconnected":
+            # From the relay: a controller's last connection went away.
+            self.unsubscribe(data.get("peer"))
+        else:
+            await handle_command(self.ws, data, self.session)
 
-                    if target_index is None:
-                        print(f"No node found with resource-id='{rid}'")
-                        response["status"] = "not_found"
-                    else:
-                        button_bounds = None
-
-                        for j in range(target_index - 1, -1, -1):
-                            cls = all_nodes[j].attrib.get("class", "")
-                            if "Button" in cls:
-                                button_bounds = all_nodes[j].attrib.get("bounds")
-                                print(
-                                    f"Found preceding Button for '{rid}': {button_bounds}"
-                                )
-                                break
-
-                        if not button_bounds:
-                            for j in range(target_index + 1, len(all_nodes)):
-                                cls = all_nodes[j].attrib.get("class", "")
-                                if "Button" in cls:
-                                    button_bounds = all_nodes[j].attrib.get("bounds")
-                                    print(
-                                        f"Found following Button for '{rid}': {button_bounds}"
-                                    )
-                                    break
-
-                        if not button_bounds:
-                            print(
-                                "No Button class found — trying clickable node near target"
+    async def pull_scans(self, data, chunk_bytes=CHUNK_BYTES, window=WINDOW):
+        """Stream new bytes of the app's scan files to the sender.
+
+        "manifest" maps device paths to {"offset", "tail"} as kept by
+        pull_scans.py; "root" and "pattern" override the scan_export defaults,
+        and chunk_bytes and window come from the command's "chunkBytes" and
+        "window" (see transfer_limits). Each chunk goes out as a scanChunk message
+        (gzip'd, as binary frames or base64) and the receiver answers with
+        {"action": "scanAck", "transfer": ..., "seq": ...}.
+        """
+        transfer = data.get("id") or f"pull-{int(time.time() * 1000)}"
+        package = self.session.package or APP
+        root = data.get("root") or SCAN_ROOT.format(package=package)
+        manifest = data.get("manifest") or {}
+        credits = Credits(window)
+        binary = (
+            data.get("frames") == "binary"
+            or data.get("sender") in self.session.binary_peers
+        )
+        shell = self.session.root_shell
+        metrics.action("pullScans")
+        self.transfers[transfer] = credits
+        sent = 0
+        try:
+            files = await self.session.run(
+                list_files, shell, root, data.get("pattern", SCAN_PATTERN)
+            )
+            await self.reply(
+                data,
+                "pullScans",
+                "started",
+                transfer=transfer,
+                files=[{"path": path, "size": size} for path, size, _ in files],
+            )
+            for path, size, _ in files:
+                offset = await self.session.run(
+                    resume_offset, shell, path, size, manifest.get(path)
+                )
+                reset = offset == 0
+                while offset < size:
+                    await credits.wait()
+                    with metrics.span("read"):
+                        raw = await self.session.run(
+                            read_range,
+                            shell,
+                            path,
+                            offset,
+                            min(chunk_bytes, size - offset),
+                        )
+                    if not raw:
+                        break  # truncated since it was listed
+                    with metrics.span("encode"):
+                        payload = await self.session.run(gzip.compress, raw, 6)
+                    credits.sent += 1
+                    message = {
+                        "action": "scanChunk",
+                        "status": "ok",
+                        "target": data.get("sender"),
+                        "transfer": transfer,
+                        "seq": credits.sent,
+                        "path": path,
+                        "offset": offset,
+                        "length": len(raw),
+                        "size": size,
+                        "crc": zlib.crc32(raw),
+                        "reset": reset,
+                    }
+                    with metrics.span("send"):
+                        if binary:
+                            message_id, frames = encode_frames(
+                                payload, CONTENT_SCAN_GZIP, data.get("sender")
                             )
-                            for j in range(
-                                max(0, target_index - 5),
-                                min(len(all_nodes), target_index + 5),
-                            ):
-                                clickable = (
-                                    all_nodes[j].attrib.get("clickable") == "true"
-                                )
-                                b = all_nodes[j].attrib.get("bounds")
-                                if clickable and b:
-                                    button_bounds = b
-                                    print(f"Found clickable neighbor: {b}")
-                                    break
-
-                        if button_bounds:
-                            xy = parse_bounds(button_bounds)
-                            if xy:
-                                cx, cy = xy
-                                run_as_root(f"input tap {cx} {cy}")
-                                print(f"Tapped at ({cx}, {cy}) for '{rid}'")
-                                response["status"] = "clicked_button"
-                            else:
-                                print(f"Invalid bounds format for {button_bounds}")
-                                response["status"] = "bad_bounds"
+                            message["scan_frames"] = {
+                                "id": message_id,
+                                "chunks": len(frames),
+                            }
+                            await self.ws.send(json.dumps(message))
+                            for frame in frames:
+                                await self.ws.send(frame)
                         else:
-                            print(f"No clickable element found near '{rid}'")
-                            response["status"] = "no_button"
-
-                except Exception as e:
-                    print(f"Error in clickById: {e}")
-                    traceback.print_exc()
-                    response["status"] = "error"
-                    response["error"] = str(e)
-
-        elif cmd_type == "clickTextDirect":
-            txt = data.get("text")
-            if not txt:
-                response["status"] = "error"
-                response["error"] = "Missing text field"
-            else:
-                try:
-                    import xml.etree.ElementTree as ET, re
+                            message["data_b64"] = base64.b64encode(payload).decode(
+                                "ascii"
+                            )
+                            await self.ws.send(json.dumps(message))
+                    offset += len(raw)
+                    sent += len(raw)
+                    reset = False
+            await self.reply(
+                data,
+                "pullScans",
+                "done",
+                transfer=transfer,
+                files=len(files),
+                bytes=sent,
+            )
+        except AckTimeout:
+            await self.reply(
+                data, "pullScans", "stalled", transfer=transfer, bytes=sent
+            )
+        except (OSError, RuntimeError, ValueError) as e:
+            # Includes TimeoutError from a root shell command.
+            print(f"[export] Transfer {transfer} failed: {e}")
+            await self.reply(
+                data, "pullScans", "error", transfer=transfer, bytes=sent, error=str(e)
+            )
+        finally:
+            self.transfers.pop(transfer, None)
 
-                    d = u2.connect()
-                    print(f"Clicking directly on text node '{txt}'")
+    def subscribe(self, data):
+        """Start pushing UI updates to the sender, replacing any earlier stream.
 
-                    xml_str = d.dump_hierarchy()
-                    root = ET.fromstring(xml_str)
-                    all_nodes = list(root.iter("node"))
+        The first update is a full snapshot; after that the sender gets
+        uiUpdate messages with the same ui_seq/ui_diff fields as command
+        responses (or a full dump when the diff wouldn't be smaller), only
+        when the screen changed. Screenshots, if asked for, arrive as
+        screenFrame messages. Subscriptions end on unsubscribe, when the
+        lease runs out, when the relay reports the controller gone, or when
+        this connection drops (controllers subscribe again after a
+        reconnect).
+        """
+        sender = data.get("sender")
+        if not sender:
+            return None
+        self.unsubscribe(sender)
+        subscription = Subscription(data)
+        self.session.ui_states.forget(sender)
+        subscription.task = self.spawn(self.stream(subscription))
+        self.subscriptions[sender] = subscription
+        return subscription
 
-                    target_bounds = None
-                    for node in all_nodes:
-                        if node.attrib.get("text") == txt:
-                            target_bounds = node.attrib.get("bounds")
-                            break
+    def unsubscribe(self, sender):
+        subscription = self.subscriptions.pop(sender, None)
+        if subscription is None:
+            return False
+        subscription.task.cancel()
+        return True
 
-                    if target_bounds:
-                        m = re.match(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", target_bounds)
-                        if m:
-                            x1, y1, x2, y2 = map(int, m.groups())
-                            cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-                            run_as_root(f"input tap {cx} {cy}")
-                            print(f"Tapped directly at ({cx},{cy}) for '{txt}'")
-                            response["status"] = "clicked_direct_text"
-                        else:
-                            response["status"] = "bad_bounds"
+    async def stream(self, subscription):
+        metrics.action("subscribe")
+        link = LinkEstimator(self.ws.transport)
+        request = {
+            "sender": subscription.sender,
+            "uiDiff": True,
+            "frames": subscription.data.get("frames"),
+        }
+        last_fp = None
+        poll = subscription.poll
+        next_frame = time.monotonic()
+        try:
+            while not subscription.expired():
+                try:
+                    xml = await self.session.run(self.session.dump_hierarchy)
+                    fp = ui_fingerprint(xml)
+                    if fp != last_fp:
+                        last_fp = fp
+                        poll = subscription.poll
+                        await self.push_ui(subscription, request, xml)
                     else:
-                        print(f"No node found with text='{txt}'")
-                        response["status"] = "not_found"
+                        poll = min(poll * 2, STREAM_MAX_POLL)
+                    if subscription.screenshots and time.monotonic() >= next_frame:
+                        next_frame = time.monotonic()
+                        next_frame += await self.push_frame(subscription, link)
+                except ConnectionClosed:
+                    raise
+                except Exception as e:
+                    print(f"[stream] Update for {subscription.sender} failed: {e}")
+                wait = poll
+                if subscription.screenshots:
+                    wait = min(wait, max(0.0, next_frame - time.monotonic()))
+                await asyncio.sleep(wait)
+            await self.reply(subscription.data, "unsubscribed", "expired")
+        finally:
+            if self.subscriptions.get(subscription.sender) is subscription:
+                del self.subscriptions[subscription.sender]
 
-                    # return updated UI
-                    await asyncio.sleep(2)
-                    ok, xml_zip = capture_ui_state_zipped()
-                    if ok:
-                        response["ui_state_zip_b64"] = xml_zip
+    async def push_ui(self, subscription, request, xml):
+        message = {
+            "action": "uiUpdate",
+            "status": "ok",
+            "target": subscription.sender,
+        }
+        if subscription.data.get("id") is not None:
+            message["id"] = subscription.data["id"]
+        request["uiSeq"] = self.session.ui_states.current(subscription.sender)
+        follow_ups = await self.session.run(
+            attach_ui_state, self.session, request, message, xml
+        )
+        if "ui_diff" in message and is_empty(message["ui_diff"]):
+            return  # only volatile text changed
+        with metrics.span("send"):
+            await self.ws.send(json.dumps(message))
+            for follow_up in follow_ups:
+                await self.ws.send(
+                    follow_up if is_frame(follow_up) else json.dumps(follow_up)
+                )
+        subscription.updates += 1
 
-                except Exception as e:
-                    print(f"Error in clickTextDirect: {e}")
-                    traceback.print_exc()
-                    response["status"] = "error"
-                    response["error"] = str(e)
-        elif cmd_type == "clickByDescription":
-            desc = data.get("description")
-            if not desc:
-                response["status"] = "error"
-                response["error"] = "Missing description field"
+    async def push_frame(self, subscription, link):
+        """Send one screenshot if the link has room; returns seconds to wait."""
+        rate = link.sample()
+        if subscription.max_rate is not None:
+            rate = min(rate, subscription.max_rate)
+        if link.backlog() > BACKLOG_BYTES:
+            # Still sending older data: skip this frame rather than queue it.
+            subscription.dropped += 1
+            return frame_interval(BACKLOG_BYTES, rate, subscription.min_interval)
+
+        with metrics.span("screenshot"):
+            image = await self.session.run(self.session.call, lambda d: d.screenshot())
+        with metrics.span("encode"):
+            payload, width, height = await self.session.run(
+                encode_screenshot,
+                image,
+                subscription.max_width,
+                subscription.format,
+                subscription.quality,
+            )
+        message = {
+            "action": "screenFrame",
+            "status": "ok",
+            "target": subscription.sender,
+            "format": subscription.format,
+            "width": width,
+            "height": height,
+            "frame": subscription.frames,
+        }
+        if subscription.data.get("id") is not None:
+            message["id"] = subscription.data["id"]
+        binary = (
+            subscription.data.get("frames") == "binary"
+            or subscription.sender in self.session.binary_peers
+        )
+        with metrics.span("send"):
+            if binary:
+                content_type = (
+                    CONTENT_WEBP if subscription.format == "webp" else CONTENT_JPEG
+                )
+                message_id, frames = encode_frames(
+                    payload, content_type, subscription.sender
+                )
+                message["screen_frames"] = {"id": message_id, "chunks": len(frames)}
+                text = json.dumps(message)
+                await self.ws.send(text)
+                for frame in frames:
+                    await self.ws.send(frame)
+                link.sent(len(text) + sum(map(len, frames)))
             else:
+                message["image_b64"] = base64.b64encode(payload).decode("ascii")
+                text = json.dumps(message)
+                await self.ws.send(text)
+                link.sent(len(text))
+        subscription.frames += 1
+        return frame_interval(len(payload), rate, subscription.min_interval)
+
+    def cancel(self, data):
+        """Cancel one command by id, or everything with {"all": true}."""
+        target = data.get("commandId")
+        cancelled = []
+        if data.get("all"):
+            while not self.queue.empty():
+                queued, _, _ = self.queue.get_nowait()
+                cancelled.append(queued.get("id"))
+        elif target is not None:
+            self.cancelled.add(target)
+            cancelled.append(target)
+
+        if self.current is not None:
+            running, task = self.current
+            if data.get("all") or running.get("id") == target:
+                task.cancel()
+                if running.get("id") not in cancelled:
+                    cancelled.append(running.get("id"))
+        return cancelled
+
+    async def worker(self):
+        while True:
+            data, deadline, queued_at = await self.queue.get()
+            metrics.observe(
+                "queue",
+                time.perf_counter() - queued_at,
+                data.get("action") or data.get("type"),
+            )
+            cmd_type = data.get("action") or data.get("type")
+            try:
+                async with self.ui_lock:
+                    await self.process(data, deadline)
+            except ConnectionClosed:
+                # The reply never went out, so don't ack: let it be replayed.
+                raise
+            except Exception as e:
+                # One bad command must not take the only worker down with it.
+                print(f"Error processing {cmd_type}: {e}")
+                traceback.print_exc()
                 try:
-                    d = u2.connect()
-                    print(f"Searching for content-desc: '{desc}'")
-
-                    node = d(description=desc)
-                    if not node.exists:
-                        node = d(text=desc)
-
-                    clicked = False
-                    if node.exists:
-                        info = node.info
-                        if info.get("clickable"):
-                            node.click()
-                            print(
-                                f"Clicked directly on clickable description element: {desc}"
-                            )
-                            clicked = True
-                        else:
-                            xpath_query = f"//*[@content-desc='{desc}']/ancestor::*[@clickable='true']"
-                            if not clicked:
-                                xpath_query = f"//*[@text='{desc}']/ancestor::*[@clickable='true']"
-
-                            parent = d.xpath(xpath_query)
-                            parents = parent.all()
-                            if parents:
-                                parents[0].click()
-                                print(f"Clicked clickable ancestor for '{desc}'")
-                                clicked = True
-                            else:
-                                node.click_exists(timeout=3.0)
-                                print(f"Fallback clicked node bounds for '{desc}'")
-                                clicked = True
-
-                    response["status"] = "clicked" if clicked else "not_found"
+                    await self.reply(data, cmd_type, "error", error=str(e))
+                except Exception:
+                    pass
+            await self.ack(data)
 
-                except Exception as e:
-                    print(f"Error in clickByDescription: {e}")
-                    traceback.print_exc()
-                    response["status"] = "error"
-                    response["error"] = str(e)
+    async def process(self, data, deadline):
+        cmd_type = data.get("action") or data.get("type")
+        command_id = data.get("id")
+
+        if command_id is not None and command_id in self.cancelled:
+            self.cancelled.discard(command_id)
+            await self.reply(data, cmd_type, "cancelled")
+            return
 
-        await asyncio.sleep(10.0)
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                await self.reply(data, cmd_type, "expired")
+                return
 
-        ok, data = capture_ui_state_zipped()
-        if ok:
-            response["ui_state_zip_b64"] = data
-        else:
-            response["error"] = data
+        # Cancelling only abandons the command on our side: a device call
+        # already handed to the executor still runs to completion.
+        task = asyncio.create_task(
+            asyncio.wait_for(handle_command(self.ws, data, self.session), timeout)
+        )
+        self.current = (data, task)
+        try:
+            await task
+        except asyncio.TimeoutError:
+            await self.reply(data, cmd_type, "timeout")
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            await self.reply(data, cmd_type, "cancelled")
+        finally:
+            self.current = None
+            self.cancelled.discard(command_id)
+            self.processed += 1
 
-        await ws.send(json.dumps(response))
+    async def ack(self, data):
+        """Acknowledge a relay message once it has been fully handled."""
+        relay_id = data.get("relayId")
+        if relay_id is None:
+            return
+        self.cursor.done(relay_id)
+        await self.ws.send(json.dumps({"action": "ack", "relayId": relay_id}))
 
-    except Exception as e:
-        print("Error:", e)
-        await ws.send(json.dumps({"error": str(e)}))
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.current is not None:
+            self.current[1].cancel()
 
 
-async def listen():
+async def listen(session, cursor, health, url=None, jobs=None):
+    url = url or SERVER_URL
+    metrics.device(session.serial)
+    resume_from = cursor.resume_from()
+    if resume_from:
+        url = f"{url}&resumeFrom={resume_from}"
     try:
         async with connect(
-            SERVER_URL,
+            f"{url}&acks=1",
             ping_interval=None,  # disable protocol-level ping for now
             ping_timeout=None,
             close_timeout=5,
-            max_size=2**20,
+            max_size=MAX_FRAME,
         ) as ws:
-            print("Connected:", SERVER_URL)
+            print("Connected:", url)
+            cursor.connected(resume_from)
+            health.connected()
+
+            pipeline = CommandPipeline(ws, session, cursor, health, jobs)
+            pipeline.jobs.attach(pipeline)
+            worker = asyncio.create_task(pipeline.worker())
+            pulse = asyncio.create_task(heartbeat(ws, health))
+            reassembler = Reassembler()
+
+            await ws.send(json.dumps({"action": "hello", "frames": ["binary", "json"]}))
 
             async def receiver():
                 while True:
                     try:
                         msg = await ws.recv()
+                        health.heard()
+                        if is_frame(msg):
+                            complete = reassembler.add(msg)
+                            if complete is None:
+                                continue
+                            header, msg = complete
+                            if header.content_type != CONTENT_JSON:
+                                continue
+                        started = time.perf_counter()
+                        data = parse_command(msg)
+                        if data is None:
+                            continue
+                        if data.get("action") == "heartbeatAck":
+                            health.answered(data.get("seq"))
+                            continue
+                        metrics.observe(
+                            "decode",
+                            time.perf_counter() - started,
+                            data.get("action") or data.get("type"),
+                        )
                         print("Raw message:", msg)
-                        await handle_command(ws, msg)
+                        pipeline.submit(data)
                     except ConnectionClosed as cc:
                         print(
                             f"[receiver] Connection closed: code={cc.code} reason={cc.reason}"
@@ -390,9 +1614,15 @@ async def listen():
                             "[receiver] Exception while receiving or handling message:"
                         )
                         traceback.print_exc()
-                        break  # optional: stop loop on error
 
-            await receiver()
+            try:
+                await receiver()
+            finally:
+                pulse.cancel()
+                worker.cancel()
+                pipeline.jobs.detach(pipeline)
+                await pipeline.close()
+                health.disconnected()
 
     except Exception as e:
         print("[listen] Exception caught:")
@@ -400,22 +1630,69 @@ async def listen():
         raise
 
 
-async def persistent_listener():
-    backoff = 1
-    while True:
-        try:
-            await listen()
-            backoff = 1
-        except ConnectionClosed as cc:
-            print(f"Closed: code={cc.code} reason={cc.reason}")
-        except Exception as e:
-            print(f"Disconnected: {e}")
-        sleep_for = min(backoff * 2, 30) + random.uniform(0, 0.5)
-        await asyncio.sleep(sleep_for)
-        backoff = min(backoff * 2, 30)
+def register_connection_metrics(health, device_id=None):
+    """Expose the heartbeat/reconnect figures next to the timing histograms."""
+    site = (("site", health.site),)
+    if device_id:
+        site += (("device", device_id),)
+
+    def read(field, key=None):
+        def value():
+            snapshot = health.snapshot()
+            v = snapshot[field] if key is None else (snapshot[field] or {}).get(key)
+            return {site: v}
+
+        return value
+
+    for name, field, key in (
+        ("chirp_rtt_ms", "rtt_ms", "last"),
+        ("chirp_rtt_p95_ms", "rtt_ms", "p95"),
+        ("chirp_reconnects", "reconnects", None),
+        ("chirp_disconnected_seconds", "disconnected_s", None),
+        ("chirp_dead_peers", "dead_peers", None),
+    ):
+        metrics.REGISTRY.gauge(name, read(field, key), owner=health)
+
+
+async def persistent_listener(session=None, url=None, health=None):
+    """Keep one device connected to the relay, reconnecting forever."""
+    session = session or DeviceSession()
+    health = health or ConnectionHealth()
+    cursor = RelayCursor()
+    jobs = DeviceJobs(session)
+    try:
+        backoff = 1
+        while True:
+            try:
+                await listen(session, cursor, health, url, jobs)
+                backoff = 1
+            except ConnectionClosed as cc:
+                print(f"Closed: code={cc.code} reason={cc.reason}")
+            except Exception as e:
+                print(f"Disconnected: {e}")
+            if health.dead or health.last_uptime >= HEALTHY_CONNECTION:
+                # The link was fine until it dropped; come straight back and let
+                # the relay replay whatever was sent meanwhile.
+                health.last_uptime = 0.0
+                backoff = 1
+                await asyncio.sleep(random.uniform(0, 0.5))
+                continue
+            sleep_for = min(backoff * 2, 30) + random.uniform(0, 0.5)
+            await asyncio.sleep(sleep_for)
+            backoff = min(backoff * 2, 30)
+    finally:
+        jobs.close()
+
+
+async def main():
+    health = ConnectionHealth()
+    register_connection_metrics(health)
+    if METRICS_PORT:
+        await metrics.serve(int(METRICS_PORT))
+    await persistent_listener(health=health)
 
 
 if __name__ == "__main__":
     import contextlib
 
-    asyncio.run(persistent_listener())
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""Incremental copies of the app's scan files (the pullScans action).
+
+The receiver (pull_scans.py) keeps a manifest of how many bytes of each
+device file it already holds, plus an MD5 of its last TAIL_BYTES. The agent
+checks that digest against the same byte range on the phone: if it matches,
+only the bytes past the offset are sent; if not (the file was replaced or
+truncated), the file is sent again from the start. Data is read through the
+root shell in CHUNK_BYTES pieces and travels gzip'd, at most `window`
+chunks ahead of the receiver's acks.
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import shlex
+
+# Where the Deeper app keeps its data, and which files are scans.
+SCAN_ROOT = "/data/data/{package}/files"
+SCAN_PATTERN = "bathymetry.csv"
+
+CHUNK_BYTES = 256 * 1024
+TAIL_BYTES = 4096
+# Chunks in flight before waiting for the receiver, and how long to wait.
+WINDOW = 4
+ACK_TIMEOUT = 60.0
+
+
+def list_files(shell, root, pattern=SCAN_PATTERN):
+    """[(path, size, mtime)] of the files under root matching pattern."""
+    code, stdout, stderr = shell.execute(
+        f"find {shlex.quote(root)} -type f -name {shlex.quote(pattern)} "
+        "-exec stat -c '%s %Y %n' {} +"
+    )
+    if code != 0 and not stdout:
+        raise OSError(f"Listing {root} failed: {stderr.strip()}")
+    files = []
+    for line in stdout.splitlines():
+        parts = line.split(" ", 2)
+        if len(parts) == 3 and parts[0].isdigit():
+            files.append((parts[2], int(parts[0]), int(parts[1])))
+    files.sort()
+    return files
+
+
+def read_range(shell, path, offset, length):
+    """length bytes of a device file starting at offset (fewer at its end)."""
+    code, stdout, stderr = shell.execute(
+        f"tail -c +{offset + 1} {shlex.quote(path)} | head -c {length} | base64"
+    )
+    if code != 0:
+        raise OSError(f"Reading {path} failed: {stderr.strip()}")
+    return base64.b64decode(stdout)
+
+
+def remote_tail_digest(shell, path, offset):
+    """MD5 of the TAIL_BYTES of a device file that end at offset."""
+    start = max(0, offset - TAIL_BYTES)
+    code, stdout, stderr = shell.execute(
+        f"tail -c +{start + 1} {shlex.quote(path)} | head -c {offset - start} | md5sum"
+    )
+    if code != 0:
+        raise OSError(f"Checksumming {path} failed: {stderr.strip()}")
+    return stdout.split(" ", 1)[0].strip()
+
+
+def tail_digest(path):
+    """MD5 of the last TAIL_BYTES of a local file."""
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - TAIL_BYTES))
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def resume_offset(shell, path, size, entry):
+    """Where to continue a device file from, given its manifest entry."""
+    offset = int(entry.get("offset", 0)) if entry else 0
+    if offset == 0:
+        return 0
+    if offset > size or remote_tail_digest(shell, path, offset) != entry.get("tail"):
+        print(f"[export] {path} changed on the device, sending it again")
+        return 0
+    return offset
+
+
+class AckTimeout(Exception):
+    """The receiver stopped acknowledging chunks."""
+
+
+class Credits:
+    """Sliding window of chunks sent but not yet acknowledged."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.sent = 0
+        self.acked = 0
+        self._changed = asyncio.Event()
+
+    def ack(self, seq):
+        if seq is not None and int(seq) > self.acked:
+            self.acked = min(int(seq), self.sent)
+            self._changed.set()
+
+    async def wait(self, timeout=ACK_TIMEOUT):
+        """Block until another chunk may be sent; AckTimeout if acks stop."""
+        while self.sent - self.acked >= self.window:
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise AckTimeout(f"No ack for {timeout:g}s") from None
@@ -1,43 +1,347 @@
 import asyncio
-import websockets
 import json
+import os
+import re
+import sqlite3
+import time
+from urllib.parse import parse_qs, urlparse
 
-connected_clients = set()
+import websockets
 
+from framing import is_frame, parse_header
 
-async def handler(websocket):
-    print("Client connected")
-    connected_clients.add(websocket)
+# Every client gets its own bounded send queue and sender task, so one slow
+# phone can't hold up delivery to the others.
+SEND_QUEUE_SIZE = 256
+# What to do when a client's queue is full: "drop_oldest" discards its oldest
+# queued message, "disconnect" closes it so it reconnects and resyncs.
+SLOW_CONSUMER_POLICY = "drop_oldest"
 
-    try:
-        async for message in websocket:
-            print("Received:", message)
+# Messages are routed on their top-level "target" (responses) or "deviceId"
+# (commands) field, found with a regex instead of decoding the whole message.
+# The same keys inside nested objects (batch steps, routine rules) don't
+# count: JSON_TOKEN skips whole strings and tracks bracket depth up to each
+# candidate match, so the cost grows with how far in the key is (the agent
+# puts "target" before any bulky payload).
+TARGET_FIELD = re.compile(r'"target"\s*:\s*"([^"\\]*)"')
+DEVICE_FIELD = re.compile(r'"deviceId"\s*:\s*"([^"\\]*)"')
+JSON_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+
+LOG_MESSAGES = os.environ.get("RELAY_LOG") == "1"
+
+# Targeted messages for clients that connect with acks=1, or for recipients
+# that aren't connected, are written to a local log and replayed when their
+# recipient (re)connects. Acking clients must acknowledge each message with
+# {"action": "ack", "relayId": n}; for everyone else handing the message to
+# their connection counts as delivery, so it is never logged.
+RELAY_DB = os.environ.get("RELAY_DB", "relay.db")
+RELAY_MESSAGE_TTL = 600.0
+ACK_MESSAGE = re.compile(r'^\{\s*"action"\s*:\s*"ack"\s*,\s*"relayId"\s*:\s*(\d+)')
+
+# Agents send {"action": "heartbeat", "seq": n} to detect half-open
+# connections; the relay answers each one straight back as "heartbeatAck".
+HEARTBEAT_MESSAGE = re.compile(r'^\{\s*"action"\s*:\s*"heartbeat"')
+
+connected_clients = {}
+message_log = None
+
+
+class MessageLog:
+    """Per-device outbound messages in SQLite, kept until acknowledged.
+
+    SQLite is only touched from run(), which applies queued operations in
+    batches on a worker thread so disk I/O stays off the event loop. Relay
+    ids are handed out here rather than by SQLite so append can return one
+    without waiting for the write.
+    """
+
+    def __init__(self, path=RELAY_DB, ttl=RELAY_MESSAGE_TTL):
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " device TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_device ON messages (device, id)"
+        )
+        self.last_id = (
+            self.db.execute(
+                "SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'messages'"
+            ).fetchone()[0]
+            or 0
+        )
+        self.operations = asyncio.Queue()
+
+    def _queue(self, sql, params, result=None):
+        self.operations.put_nowait((sql, params, result))
+
+    def append(self, device, payload):
+        self.last_id += 1
+        self._queue(
+            "INSERT INTO messages (id, device, payload, created) VALUES (?, ?, ?, ?)",
+            (self.last_id, device, payload, time.time()),
+        )
+        return self.last_id
+
+    def ack(self, device, relay_id):
+        self._queue(
+            "DELETE FROM messages WHERE device = ? AND id = ?", (device, relay_id)
+        )
+
+    def ack_through(self, device, relay_id):
+        self._queue(
+            "DELETE FROM messages WHERE device = ? AND id <= ?", (device, relay_id)
+        )
+
+    async def pending(self, device):
+        """Unexpired messages for device, after every write queued so far."""
+        result = asyncio.get_running_loop().create_future()
+        self._queue(
+            "SELECT id, payload FROM messages WHERE device = ? AND created >= ?"
+            " ORDER BY id",
+            (device, time.time() - self.ttl),
+            result,
+        )
+        return await result
+
+    def prune(self):
+        self._queue("DELETE FROM messages WHERE created < ?", (time.time() - self.ttl,))
+
+    def _apply(self, batch):
+        rows = []
+        self.db.execute("BEGIN")
+        try:
+            for sql, params, result in batch:
+                cursor = self.db.execute(sql, params)
+                rows.append(cursor.fetchall() if result is not None else None)
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+        return rows
+
+    async def run(self):
+        """Apply queued operations, everything waiting at once in one transaction."""
+        while True:
+            batch = [await self.operations.get()]
+            while not self.operations.empty():
+                batch.append(self.operations.get_nowait())
             try:
-                data = json.loads(message)
-                print("Parsed command:", data)
+                rows = await asyncio.to_thread(self._apply, batch)
+            except sqlite3.Error as e:
+                print(f"Message log write failed: {e}")
+                rows = [[] for _ in batch]
+            for (_, _, result), found in zip(batch, rows):
+                if result is not None and not result.done():
+                    result.set_result(found)
+
+
+def stamp(message, relay_id):
+    """Insert the relay id as the first field of a JSON object message."""
+    rest = message[1:].lstrip()
+    if rest.startswith("}"):
+        return f'{{"relayId": {relay_id}}}'
+    return f'{{"relayId": {relay_id}, {rest}'
+
+
+class Client:
+    def __init__(self, websocket, device_id, role, acks=False):
+        self.websocket = websocket
+        self.device_id = device_id
+        self.role = role
+        self.acks = acks
+        self.dropped = 0
+        # While the log is being replayed new messages wait here, so they
+        # can't overtake the replayed ones.
+        self.held = []
+        self.queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        self.sender = asyncio.create_task(self.drain())
+
+    def offer(self, message):
+        try:
+            self.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
 
-                to_remove = set()
-                for client in connected_clients:
-                    if client != websocket:
-                        try:
-                            await client.send(message)
-                        except websockets.exceptions.ConnectionClosed:
-                            to_remove.add(client)
+        self.dropped += 1
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            print(f"Disconnecting slow consumer {self.device_id}")
+            asyncio.create_task(self.websocket.close(1013, "slow consumer"))
+            return
+        self.queue.get_nowait()
+        self.queue.put_nowait(message)
 
-                connected_clients.difference_update(to_remove)
+    def deliver(self, message, relay_id=None):
+        if self.held is not None:
+            self.held.append((message, relay_id))
+            return
+        self.send(message, relay_id)
 
-            except json.JSONDecodeError:
-                print("Invalid JSON received")
+    def send(self, message, relay_id=None):
+        self.offer(message)
+        if relay_id is not None and not self.acks:
+            message_log.ack(self.device_id, relay_id)
+
+    def release(self, replayed=()):
+        """Deliver what arrived during replay, minus messages already replayed."""
+        held, self.held = self.held, None
+        for message, relay_id in held:
+            if relay_id is None or relay_id not in replayed:
+                self.send(message, relay_id)
+
+    async def drain(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                await self.websocket.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+    def close(self):
+        self.sender.cancel()
+
+
+def client_identity(websocket):
+    query = parse_qs(urlparse(websocket.request.path).query)
+    device_id = query.get("deviceId", [None])[0] or f"anon-{id(websocket):x}"
+    role = query.get("role", [None])[0]
+    if role is None:
+        role = "controller" if device_id.startswith("controller") else "agent"
+    acks = query.get("acks", ["0"])[0] == "1"
+    resume_from = query.get("resumeFrom", [None])[0]
+    return device_id, role, acks, int(resume_from) if resume_from else None
+
+
+def message_target(message):
+    if is_frame(message):
+        return parse_header(message)[0].target or None
+    if isinstance(message, bytes):
+        return None
+    target = top_level_field(TARGET_FIELD, message)
+    if target is None:
+        target = top_level_field(DEVICE_FIELD, message)
+    return target
+
+
+def top_level_field(pattern, message):
+    """Group 1 of the first match of pattern that is in the outermost object."""
+    depth = 0
+    position = 0
+    for m in pattern.finditer(message):
+        for token in JSON_TOKEN.finditer(message, position, m.start()):
+            bracket = token.group()
+            if bracket in ("{", "["):
+                depth += 1
+            elif bracket in ("}", "]"):
+                depth -= 1
+        if depth == 1:
+            return m.group(1)
+        position = m.start()
+    return None
+
+
+def route(sender, message):
+    if isinstance(message, str) and HEARTBEAT_MESSAGE.match(message):
+        sender.offer(message.replace('"heartbeat"', '"heartbeatAck"', 1))
+        return
+
+    if isinstance(message, str) and message_log is not None:
+        ack = ACK_MESSAGE.match(message)
+        if ack:
+            message_log.ack(sender.device_id, int(ack.group(1)))
+            return
+
+    relay_id = None
+    target = message_target(message)
+    if target is not None and target != sender.device_id:
+        recipients = connected_clients.get(target, ())
+        logged = not recipients or any(client.acks for client in recipients)
+        if message_log is not None and isinstance(message, str) and logged:
+            relay_id = message_log.append(target, message)
+            message = stamp(message, relay_id)
+            if not recipients:
+                print(f"No client for target {target}, queued message {relay_id}")
+        elif not recipients:
+            print(f"No client for target {target}, dropping message")
+    else:
+        # Untargeted messages go to the other side: controllers to agents and
+        # agents to controllers.
+        recipients = [
+            client
+            for clients in connected_clients.values()
+            for client in clients
+            if client is not sender and client.role != sender.role
+        ]
+
+    if LOG_MESSAGES:
+        print(f"{sender.device_id} -> {target or '*'}: {len(message)} bytes")
+    for client in recipients:
+        client.deliver(message, relay_id)
+
+
+async def replay(client, resume_from):
+    """Queue everything the client's device hasn't acknowledged yet."""
+    if resume_from is not None:
+        message_log.ack_through(client.device_id, resume_from)
+    pending = await message_log.pending(client.device_id)
+    if pending:
+        print(f"Replaying {len(pending)} messages to {client.device_id}")
+    for relay_id, payload in pending:
+        client.send(stamp(payload, relay_id), relay_id)
+    client.release({relay_id for relay_id, _ in pending})
+
+
+async def handler(websocket):
+    device_id, role, acks, resume_from = client_identity(websocket)
+    client = Client(websocket, device_id, role, acks)
+    connected_clients.setdefault(device_id, set()).add(client)
+    print(f"Client connected: {device_id} ({role})")
+    if message_log is not None:
+        await replay(client, resume_from)
+    else:
+        client.release()
+
+    try:
+        async for message in websocket:
+            route(client, message)
     except websockets.exceptions.ConnectionClosed:
-        print("Client disconnected")
+        pass
     finally:
-        connected_clients.discard(websocket)
+        print(f"Client disconnected: {device_id}")
+        client.close()
+        clients = connected_clients.get(device_id, set())
+        clients.discard(client)
+        if not clients:
+            connected_clients.pop(device_id, None)
+            if role == "controller":
+                # Lets agents stop anything they were streaming to it.
+                route(
+                    client,
+                    json.dumps({"action": "peerDisconnected", "peer": device_id}),
+                )
+
+
+async def prune_log():
+    while True:
+        await asyncio.sleep(60)
+        message_log.prune()
 
 
 async def main():
+    global message_log
+    message_log = MessageLog()
+    writer = asyncio.create_task(message_log.run())
+    pruner = asyncio.create_task(prune_log())
     async with websockets.serve(handler, "0.0.0.0", 8080):
         print("WebSocket server running on ws://0.0.0.0:8080")
         await asyncio.Future()
+    pruner.cancel()
+    writer.cancel()
 
 
 if __name__ == "__main__":
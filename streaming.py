@@ -0,0 +1,84 @@
+"""Pacing for pushed UI updates and screenshots (the subscribe action).
+
+Screenshots are downscaled and re-encoded as JPEG or WebP before sending.
+How often one goes out depends on how fast the agent's websocket actually
+drains: LinkEstimator watches the transport's write buffer, and a frame is
+dropped rather than queued while earlier data is still waiting, so the
+controller always gets the newest picture instead of a backlog.
+"""
+
+import io
+import time
+
+SCREEN_MAX_WIDTH = 360
+SCREEN_QUALITY = 60
+SCREEN_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+# Frame interval bounds, and the share of the measured link screenshots may
+# use (the rest is left for command responses).
+MIN_FRAME_INTERVAL = 0.2
+MAX_FRAME_INTERVAL = 5.0
+LINK_SHARE = 0.5
+# Assumed until the first measurement.
+DEFAULT_LINK_BPS = 128 * 1024
+# Anything still buffered above this means the link is behind.
+BACKLOG_BYTES = 16 * 1024
+
+
+class LinkEstimator:
+    """Bytes per second the websocket drains, measured while it is backlogged.
+
+    While the write buffer is empty the link is keeping up and there is
+    nothing to measure, so the last estimate is kept.
+    """
+
+    def __init__(self, transport, initial=DEFAULT_LINK_BPS, smoothing=0.3):
+        self.transport = transport
+        self.rate = initial
+        self.smoothing = smoothing
+        self._buffered = 0
+        self._queued = 0
+        self._at = time.monotonic()
+
+    def backlog(self):
+        try:
+            return self.transport.get_write_buffer_size()
+        except (AttributeError, RuntimeError):
+            return 0
+
+    def sent(self, size):
+        self._queued += size
+
+    def sample(self):
+        now = time.monotonic()
+        buffered = self.backlog()
+        elapsed = now - self._at
+        if self._buffered > 0 and elapsed > 0:
+            drained = self._buffered + self._queued - buffered
+            if drained > 0:
+                measured = drained / elapsed
+                self.rate += self.smoothing * (measured - self.rate)
+        self._buffered = buffered
+        self._queued = 0
+        self._at = now
+        return self.rate
+
+
+def frame_interval(frame_bytes, rate, min_interval=MIN_FRAME_INTERVAL):
+    """Seconds until the next frame so screenshots stay within LINK_SHARE."""
+    interval = frame_bytes / max(1.0, rate * LINK_SHARE)
+    return min(MAX_FRAME_INTERVAL, max(min_interval, interval))
+
+
+def encode_screenshot(
+    image, max_width=SCREEN_MAX_WIDTH, fmt="jpeg", quality=SCREEN_QUALITY
+):
+    """Downscale a PIL screenshot; returns (bytes, width, height)."""
+    if image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, SCREEN_FORMATS.get(fmt, "JPEG"), quality=quality)
+    return out.getvalue(), image.width, image.height
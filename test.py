@@ -1,29 +1,38 @@
-# Requires: pip install uiautomator2 opencv-python numpy pillow
+# Requires: pip install uiautomator2 (and opencv-python for the image fallback)
 import uiautomator2 as u2
 import time
-import cv2
-import numpy as np
-from PIL import Image
+
+from popups import PopupWatcher
+from ui_snapshot import UiSnapshot
 
 DEVICE_IP = "192.168.1.42"  # or adb serial / "usb" to auto connect
 APP_PACKAGE = "com.fishdeeper.app"  # example package; replace
 APP_ACTIVITY = ".MainActivity"  # if needed
 
-# Known popup buttons/texts to try automatically (ordered)
-POPUP_ACCEPT_TEXTS = ["OK", "Allow", "Update", "Install", "Yes"]
-POPUP_DISMISS_TEXTS = [
-    "No thanks",
-    "Not now",
-    "Later",
-    "Cancel",
-    "Close",
-    "Maybe later",
-]
-
 # Connect to device
 d = u2.connect(DEVICE_IP)  # or u2.connect_usb() / u2.connect()
 d.app_start(APP_PACKAGE)  # start app
 
+# Known popups (popups.POPUP_*_TEXTS / POPUP_RESOURCE_IDS) are matched against
+# one dump per check instead of one exists() round trip per button.
+popups = PopupWatcher(lambda: UiSnapshot(d.dump_hierarchy()), d.click)
+
+# Templates are loaded once, on first use since visual.py needs OpenCV, and
+# matched at this phone's density.
+locator = None
+
+
+def visual_locator():
+    global locator
+    if locator is None:
+        from visual import TemplateCache, VisualLocator, parse_density
+
+        locator = VisualLocator(
+            TemplateCache("templates"),
+            density=parse_density(d.shell("wm density").output),
+        )
+    return locator
+
 
 def wait_for(selector_fn, timeout=15, poll=0.5):
     """Wait until selector_fn() returns truthy; returns its value or None."""
@@ -32,39 +41,23 @@ def wait_for(selector_fn, timeout=15, poll=0.5):
         val = selector_fn()
         if val:
             return val
-        # also check for popups each poll
-        handle_known_popups()
+        # also check for popups; less often while the screen isn't changing
+        popups.poll()
         time.sleep(poll)
     return None
 
 
 def handle_known_popups():
-    # 1) try text-based matches
-    for t in POPUP_DISMISS_TEXTS + POPUP_ACCEPT_TEXTS:
-        e = d(text=t)
-        if e.exists:
-            try:
-                e.click()
-                print(f"Clicked popup button with text: {t}")
-                time.sleep(0.3)
-                return True
-            except Exception:
-                pass
-    # 2) try resource-id known popups (example ids)
-    known_ids = [
-        "com.android.packageinstaller:id/permission_deny_button",
-        "com.android.packageinstaller:id/permission_allow_button",
-    ]
-    for rid in known_ids:
-        e = d(resourceId=rid)
-        if e.exists:
-            try:
-                e.click()
-                print(f"Clicked popup resource: {rid}")
-                return True
-            except Exception:
-                pass
-    return False
+    try:
+        handled = popups.check()
+    except Exception as e:
+        print("Popup check failed:", e)
+        return False
+    if handled is None:
+        return False
+    print(f"Clicked popup button: {handled[0]}")
+    time.sleep(0.3)
+    return True
 
 
 # Example: navigate to sonar connect button
@@ -92,14 +85,9 @@ def click_connect():
     # image-based fallback (load template image)
     try:
         screen = d.screenshot(format="opencv")
-        template = cv2.imread("templates/connect_button.png", cv2.IMREAD_COLOR)
-        res = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
-        minv, maxv, minloc, maxloc = cv2.minMaxLoc(res)
-        if maxv > 0.8:
-            th, tw = template.shape[:2]
-            x = maxloc[0] + tw // 2
-            y = maxloc[1] + th // 2
-            d.tap(x, y)
+        match = visual_locator().locate(screen, ["connect_button"])["connect_button"]
+        if match:
+            d.tap(match.x, match.y)
             print("Tapped image-matched Connect button")
             return True
     except Exception as e:
@@ -0,0 +1,139 @@
+import threading
+import xml.etree.ElementTree as ET
+
+# Once a diff touches more than this share of the tree a full snapshot is
+# both smaller and cheaper for the controller to apply.
+MAX_DIFF_RATIO = 0.5
+
+
+def flatten(xml):
+    """Flatten a hierarchy dump into {path: attributes}.
+
+    A node's path is its parent's path plus "<index>:<class>", which stays
+    stable while sibling text and bounds change. The hierarchy element itself
+    is stored under the empty path.
+    """
+    root = ET.fromstring(xml)
+    nodes = {"": dict(root.attrib)}
+    stack = [(root, "")]
+    while stack:
+        element, path = stack.pop()
+        seen = {}
+        for position, child in enumerate(element):
+            if child.tag != "node":
+                continue
+            key = f"{child.get('index', position)}:{child.get('class', '')}"
+            count = seen.get(key, 0)
+            seen[key] = count + 1
+            if count:
+                key = f"{key}#{count}"
+            child_path = f"{path}/{key}" if path else key
+            nodes[child_path] = dict(child.attrib)
+            stack.append((child, child_path))
+    return nodes
+
+
+def diff(old, new):
+    """Node-level changes that turn the flattened tree `old` into `new`."""
+    added = {path: attrs for path, attrs in new.items() if path not in old}
+    removed = [path for path in old if path not in new]
+    changed = {}
+    for path, attrs in new.items():
+        previous = old.get(path)
+        if previous is None or previous == attrs:
+            continue
+        delta = {k: v for k, v in attrs.items() if previous.get(k) != v}
+        for k in previous:
+            if k not in attrs:
+                delta[k] = None
+        changed[path] = delta
+    return {"added": added, "removed": removed, "changed": changed}
+
+
+def is_empty(delta):
+    return not (delta["added"] or delta["removed"] or delta["changed"])
+
+
+def apply(flat, delta):
+    """Apply a diff to a flattened tree, returning a new one."""
+    result = dict(flat)
+    for path in delta["removed"]:
+        result.pop(path, None)
+    for path, attrs in delta["changed"].items():
+        merged = dict(result.get(path, {}))
+        for k, v in attrs.items():
+            if v is None:
+                merged.pop(k, None)
+            else:
+                merged[k] = v
+        result[path] = merged
+    result.update(delta["added"])
+    return result
+
+
+def _child_order(path):
+    key = path.rsplit("/", 1)[-1]
+    index, _, rest = key.partition(":")
+    _, _, dup = rest.partition("#")
+    return (int(index) if index.isdigit() else 0, int(dup or 0), key)
+
+
+def to_xml(flat):
+    """Rebuild a hierarchy dump from a flattened tree."""
+    children = {}
+    for path in flat:
+        if path:
+            parent = path.rsplit("/", 1)[0] if "/" in path else ""
+            children.setdefault(parent, []).append(path)
+
+    root = ET.Element("hierarchy", flat.get("", {}))
+    stack = [(root, "")]
+    while stack:
+        element, path = stack.pop()
+        for child_path in sorted(children.get(path, []), key=_child_order):
+            child = ET.SubElement(element, "node", flat[child_path])
+            stack.append((child, child_path))
+    return ET.tostring(root, encoding="unicode")
+
+
+class UiStateTracker:
+    """Remembers the last tree sent to each controller so we can send diffs.
+
+    Every version sent to a controller gets a sequence number. A controller
+    asks for a diff by sending the sequence it currently holds; if that isn't
+    the one we last sent it (lost message, reconnect, restart) it gets a full
+    snapshot instead.
+    """
+
+    def __init__(self):
+        self._peers = {}
+        self._lock = threading.Lock()
+
+    def update(self, controller, xml, base_seq=None, full=False):
+        """Record the new tree; returns (seq, base_seq, delta) or (seq, None, None)."""
+        flat = flatten(xml)
+        with self._lock:
+            seq, previous = self._peers.get(controller, (0, None))
+            if full or previous is None or base_seq != seq:
+                self._peers[controller] = (seq + 1, flat)
+                return seq + 1, None, None
+
+            delta = diff(previous, flat)
+            if is_empty(delta):
+                return seq, seq, delta
+
+            touched = len(delta["added"]) + len(delta["removed"])
+            touched += len(delta["changed"])
+            self._peers[controller] = (seq + 1, flat)
+            if touched > MAX_DIFF_RATIO * len(flat):
+                return seq + 1, None, None
+            return seq + 1, seq, delta
+
+    def current(self, controller):
+        """The seq we last sent a controller (0 if nothing yet)."""
+        with self._lock:
+            return self._peers.get(controller, (0, None))[0]
+
+    def forget(self, controller):
+        with self._lock:
+            self._peers.pop(controller, None)
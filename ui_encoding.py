@@ -0,0 +1,143 @@
+import binascii
+import threading
+import uuid
+import zlib
+
+# Attributes the controller never reads when they hold uiautomator's default
+# value (and NAF, which it never reads at all). clickable, bounds, text,
+# resource-id, content-desc, class, package and index are always kept.
+STRIP_DEFAULTS = tuple(
+    f' {name}="false"'
+    for name in (
+        "checkable",
+        "checked",
+        "focusable",
+        "focused",
+        "scrollable",
+        "long-clickable",
+        "password",
+        "selected",
+    )
+) + (' enabled="true"', ' visible-to-user="true"', ' NAF="true"')
+
+# The listener's websocket max_size is 1 MiB; leave room for the rest of the
+# response around the encoded dump.
+MAX_FRAME = 2**20
+MAX_UI_STATE_CHARS = MAX_FRAME - 64 * 1024
+
+# Text is compressed in slices of roughly this many characters, always cut
+# just after a '>' so no attribute straddles two slices.
+SLICE_CHARS = 64 * 1024
+
+# Small dumps compress hard; big ones trade ratio for CPU time on the phone.
+COMPRESSION_LEVELS = ((64 * 1024, 9), (2 * 2**20, 6), (None, 4))
+
+
+def strip_defaults(text):
+    for attribute in STRIP_DEFAULTS:
+        text = text.replace(attribute, "")
+    return text
+
+
+def compression_level(size):
+    for limit, level in COMPRESSION_LEVELS:
+        if limit is None or size < limit:
+            return level
+
+
+class UiStateEncoder:
+    """gzip+base64 encoder for hierarchy dumps that reuses its output buffer.
+
+    The dump is stripped and compressed slice by slice, so only one slice of
+    UTF-8 bytes and the compressed output exist at any time besides the
+    original string.
+    """
+
+    def __init__(self, strip=True, max_chars=MAX_UI_STATE_CHARS):
+        self.strip = strip
+        self.max_chars = max_chars
+        self._buffer = bytearray()
+        self._length = 0
+        # Base64 length of the last dump encoded, a cheap size estimate for
+        # the next one (None until something has been encoded).
+        self.last_chars = None
+        self._lock = threading.Lock()
+
+    def _append(self, data):
+        end = self._length + len(data)
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(max(end - len(self._buffer), len(self._buffer))))
+        self._buffer[self._length : end] = data
+        self._length = end
+
+    def _compress(self, xml):
+        self._length = 0
+        compressor = zlib.compressobj(
+            compression_level(len(xml)), zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+        start = 0
+        while start < len(xml):
+            end = start + SLICE_CHARS
+            if end < len(xml):
+                cut = xml.rfind(">", start, end)
+                end = cut + 1 if cut >= start else end
+            piece = xml[start:end]
+            if self.strip:
+                piece = strip_defaults(piece)
+            self._append(compressor.compress(piece.encode("utf-8")))
+            start = end
+        self._append(compressor.flush())
+        self.last_chars = -(-self._length // 3) * 4
+
+    def as_sent(self, xml):
+        """The dump as the controller will decode it from encode(xml)."""
+        return strip_defaults(xml) if self.strip else xml
+
+    def encode_bytes(self, xml):
+        """Return the dump as gzip bytes, for binary frames."""
+        with self._lock:
+            self._compress(xml)
+            return bytes(self._buffer[: self._length])
+
+    def encode(self, xml):
+        """Return the dump as base64 gzip text, split into chunks of at most
+        max_chars (a single-element list in the usual case)."""
+        with self._lock:
+            self._compress(xml)
+            # Base64 works in 3-byte groups; cut on a group boundary so each
+            # chunk decodes on its own and they concatenate to the full file.
+            step = self.max_chars // 4 * 3
+            view = memoryview(self._buffer)
+            try:
+                return [
+                    binascii.b2a_base64(
+                        view[i : min(i + step, self._length)], newline=False
+                    ).decode("ascii")
+                    for i in range(0, self._length, step)
+                ]
+            finally:
+                view.release()
+
+
+def chunk_messages(response, chunks):
+    """Put the first chunk in the response and return follow-up messages for
+    the rest, for dumps that would not fit in one websocket frame."""
+    if len(chunks) == 1:
+        response["ui_state_zip_b64"] = chunks[0]
+        return []
+
+    state_id = uuid.uuid4().hex[:12]
+    response["ui_state_id"] = state_id
+    response["ui_state_chunks"] = len(chunks)
+    response["ui_state_zip_b64_part"] = chunks[0]
+    return [
+        {
+            "action": "uiStateChunk",
+            "target": response.get("target"),
+            "ui_state_id": state_id,
+            "chunk": i,
+            "chunks": len(chunks),
+            "ui_state_zip_b64_part": chunk,
+        }
+        for i, chunk in enumerate(chunks[1:], start=1)
+    ]
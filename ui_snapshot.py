@@ -0,0 +1,199 @@
+import bisect
+import hashlib
+import re
+import xml.etree.ElementTree as ET
+
+BOUNDS = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+
+# clickById looks this many nodes either side of the target for something
+# clickable when there is no Button around.
+NEIGHBOUR_WINDOW = 5
+
+# Live sonar readings (depth, temperature, clock) change every second and would
+# keep the screen from ever looking stable, so purely numeric text is masked
+# before fingerprinting.
+VOLATILE_TEXT = re.compile(r'text="[-+\d\s.,:%°]*(?:m|ft|cm|C|F)?"')
+
+
+def ui_fingerprint(xml):
+    """A digest of the dump that ignores live readouts."""
+    masked = VOLATILE_TEXT.sub('text=""', xml)
+    return hashlib.blake2b(masked.encode("utf-8"), digest_size=16).digest()
+
+
+class UiNode:
+    __slots__ = (
+        "order",
+        "attrib",
+        "parent",
+        "bounds",
+        "center",
+        "clickable",
+        "ancestor",
+    )
+
+    def __init__(self, order, attrib, parent):
+        self.order = order
+        self.attrib = attrib
+        self.parent = parent
+        self.clickable = attrib.get("clickable") == "true"
+        # Nearest clickable ancestor (not counting the node itself).
+        self.ancestor = None
+        if parent is not None:
+            self.ancestor = parent if parent.clickable else parent.ancestor
+
+        self.bounds = None
+        self.center = None
+        m = BOUNDS.match(attrib.get("bounds", ""))
+        if m:
+            x1, y1, x2, y2 = map(int, m.groups())
+            self.bounds = (x1, y1, x2, y2)
+            self.center = ((x1 + x2) // 2, (y1 + y2) // 2)
+
+    @property
+    def text(self):
+        return self.attrib.get("text", "")
+
+    @property
+    def description(self):
+        return self.attrib.get("content-desc", "")
+
+    @property
+    def resource_id(self):
+        return self.attrib.get("resource-id", "")
+
+    @property
+    def cls(self):
+        return self.attrib.get("class", "")
+
+    def ancestors(self):
+        node = self.parent
+        while node is not None:
+            yield node
+            node = node.parent
+
+    def click_target(self):
+        """The node a user tap should land on: itself if clickable, else the
+        nearest clickable ancestor, else itself anyway."""
+        if self.clickable or self.ancestor is None:
+            return self
+        return self.ancestor
+
+    def __repr__(self):
+        label = self.text or self.description or self.resource_id or self.cls
+        return f"<UiNode {self.order} {label!r} {self.bounds}>"
+
+
+class UiSnapshot:
+    """One parsed hierarchy dump with lookup indexes.
+
+    Built in a single streaming pass; every click action resolves against it
+    locally instead of going back to the device.
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.nodes = []
+        self.by_text = {}
+        self.by_description = {}
+        self.by_resource_id = {}
+        self.by_class = {}
+        self._button_orders = []
+
+        parser = ET.XMLPullParser(events=("start", "end"))
+        parser.feed(xml)
+        stack = []
+        for event, element in parser.read_events():
+            if element.tag != "node":
+                continue
+            if event == "end":
+                stack.pop()
+                element.clear()
+                continue
+
+            parent = stack[-1] if stack else None
+            node = UiNode(len(self.nodes), dict(element.attrib), parent)
+            self.nodes.append(node)
+            stack.append(node)
+
+            for index, key in (
+                (self.by_text, node.text),
+                (self.by_description, node.description),
+                (self.by_resource_id, node.resource_id),
+                (self.by_class, node.cls),
+            ):
+                if key:
+                    index.setdefault(key, []).append(node)
+            if "Button" in node.cls:
+                self._button_orders.append(node.order)
+        parser.close()
+
+    def find(self, text=None, description=None, resource_id=None):
+        """First node with this text, else description, else resource id."""
+        for index, key in (
+            (self.by_text, text),
+            (self.by_description, description),
+            (self.by_resource_id, resource_id),
+        ):
+            if key and key in index:
+                return index[key][0]
+        return None
+
+    def matches(self, condition):
+        """Check a screen predicate such as {"text": "Connect"}.
+
+        Keys: text, textContains, description, resourceId, className; all
+        given keys must match (on any node). {"absent": {...}} inverts an
+        inner condition and {"any": [...]} matches if one of them does.
+        """
+        for key, value in condition.items():
+            if key == "text":
+                ok = value in self.by_text
+            elif key == "textContains":
+                ok = any(value in text for text in self.by_text)
+            elif key == "description":
+                ok = value in self.by_description
+            elif key == "resourceId":
+                ok = value in self.by_resource_id
+            elif key == "className":
+                ok = value in self.by_class
+            elif key == "absent":
+                ok = not self.matches(value)
+            elif key == "any":
+                ok = any(self.matches(c) for c in value)
+            else:
+                raise ValueError(f"Unknown condition {key!r}")
+            if not ok:
+                return False
+        return True
+
+    def find_all_text_containing(self, fragment):
+        matches = []
+        for text, nodes in self.by_text.items():
+            if fragment in text:
+                matches.extend(nodes)
+        matches.sort(key=lambda n: n.order)
+        return matches
+
+    def nearest_button(self, node):
+        """The Button clickById should tap for `node`.
+
+        Prefers the closest preceding Button in document order, then the
+        closest following one, then any clickable node within a few places.
+        """
+        i = bisect.bisect_left(self._button_orders, node.order)
+        if i > 0:
+            return self.nodes[self._button_orders[i - 1]]
+        if i < len(self._button_orders):
+            j = i
+            if self._button_orders[j] == node.order:
+                j += 1
+            if j < len(self._button_orders):
+                return self.nodes[self._button_orders[j]]
+
+        lo = max(0, node.order - NEIGHBOUR_WINDOW)
+        hi = min(len(self.nodes), node.order + NEIGHBOUR_WINDOW)
+        for candidate in self.nodes[lo:hi]:
+            if candidate.clickable and candidate.bounds:
+                return candidate
+        return None
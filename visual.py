@@ -0,0 +1,213 @@
+"""Template matching for the visual fallbacks (e.g. the Connect button).
+
+A VisualLocator keeps every template in memory, resized per scale, and finds
+them in a screenshot coarse-to-fine: each scale is tried against a
+downsampled copy of the screen (or of a region of interest), and only the
+best candidates are re-checked at full resolution in a small window around
+the coarse hit. Scales are relative to the density the templates were
+captured at, so the same template works across phones. Several templates
+share one screenshot, one greyscale conversion and one downsampled screen.
+
+    locator = VisualLocator(density=parse_density(d.shell("wm density").output))
+    match = locator.locate(d.screenshot(format="opencv"), ["connect_button"])
+"""
+
+import os
+import re
+import threading
+from collections import namedtuple
+
+import cv2
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# Density (dpi) of the phone the templates were captured on.
+REFERENCE_DENSITY = 480
+# Scales tried around the density ratio, for UI scaling and font settings.
+SCALES = (0.8, 0.9, 1.0, 1.1, 1.25)
+# The coarse pass runs at this fraction of full resolution, unless that
+# would leave the template smaller than MIN_COARSE_SIZE pixels.
+COARSE_SCALE = 0.25
+MIN_COARSE_SIZE = 16
+# Coarse candidates re-checked at full resolution.
+REFINE_CANDIDATES = 2
+THRESHOLD = 0.8
+
+# x, y is the centre of the match in screenshot coordinates.
+Match = namedtuple("Match", "name score x y width height scale")
+
+
+def parse_density(text):
+    """dpi from `wm density` output (the override, if one is set)."""
+    values = re.findall(r"density:\s*(\d+)", text or "")
+    return int(values[-1]) if values else None
+
+
+def to_gray(image):
+    if image.ndim == 2:
+        return image
+    code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+    return cv2.cvtColor(image, code)
+
+
+class TemplateCache:
+    """Greyscale templates loaded once and resized once per scale.
+
+    A name is a file in `directory` without its .png suffix, or a path.
+    Files are reloaded when their mtime changes.
+    """
+
+    def __init__(self, directory=TEMPLATE_DIR):
+        self.directory = directory
+        self._images = {}
+        self._scaled = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        if os.path.splitext(name)[1]:
+            return name
+        return os.path.join(self.directory, f"{name}.png")
+
+    def original(self, name):
+        path = self.path(name)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._images.get(name)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise FileNotFoundError(f"Cannot read template {path}")
+        with self._lock:
+            self._images[name] = (mtime, image)
+            self._scaled = {k: v for k, v in self._scaled.items() if k[0] != name}
+        return image
+
+    def get(self, name, scale):
+        image = self.original(name)
+        key = (name, round(scale, 4))
+        with self._lock:
+            scaled = self._scaled.get(key)
+        if scaled is None:
+            if key[1] == 1:
+                scaled = image
+            else:
+                height, width = image.shape[:2]
+                size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+                scaled = cv2.resize(image, size, interpolation=interpolation)
+            with self._lock:
+                self._scaled[key] = scaled
+        return scaled
+
+
+class VisualLocator:
+    def __init__(
+        self,
+        cache=None,
+        density=None,
+        scales=SCALES,
+        threshold=THRESHOLD,
+        coarse_scale=COARSE_SCALE,
+    ):
+        self.cache = cache or TemplateCache()
+        self.density = density
+        self.scales = scales
+        self.threshold = threshold
+        self.coarse_scale = coarse_scale
+
+    def base_scale(self):
+        if not self.density:
+            return 1.0
+        return self.density / REFERENCE_DENSITY
+
+    def candidate_scales(self):
+        """The scales around the density ratio, plus the template's own size."""
+        base = self.base_scale()
+        return sorted({round(base * relative, 4) for relative in self.scales} | {1.0})
+
+    def locate(self, screen, names, roi=None, threshold=None):
+        """Find each template; returns {name: Match or None}.
+
+        roi is (x1, y1, x2, y2) in pixels, or in fractions of the screen when
+        every value is <= 1.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        gray = to_gray(screen)
+        left, top, region = self._crop(gray, roi)
+        coarse_screens = {}
+        results = {}
+        for name in names:
+            match = self._locate_one(region, coarse_screens, name)
+            if match is not None and match.score >= threshold:
+                results[name] = match._replace(x=match.x + left, y=match.y + top)
+            else:
+                results[name] = None
+        return results
+
+    def _crop(self, gray, roi):
+        if roi is None:
+            return 0, 0, gray
+        height, width = gray.shape[:2]
+        x1, y1, x2, y2 = roi
+        if all(0 <= v <= 1 for v in roi):
+            x1, x2 = x1 * width, x2 * width
+            y1, y2 = y1 * height, y2 * height
+        x1, y1 = max(0, int(x1)), max(0, int(y1))
+        x2, y2 = min(width, int(x2)), min(height, int(y2))
+        return x1, y1, gray[y1:y2, x1:x2]
+
+    def _coarse(self, region, coarse_screens, factor):
+        if factor not in coarse_screens:
+            height, width = region.shape[:2]
+            size = (max(1, round(width * factor)), max(1, round(height * factor)))
+            coarse_screens[factor] = cv2.resize(
+                region, size, interpolation=cv2.INTER_AREA
+            )
+        return coarse_screens[factor]
+
+    def _locate_one(self, region, coarse_screens, name):
+        region_h, region_w = region.shape[:2]
+
+        candidates = []
+        for scale in self.candidate_scales():
+            template = self.cache.get(name, scale)
+            th, tw = template.shape[:2]
+            if th > region_h or tw > region_w:
+                continue
+            factor = min(1.0, max(self.coarse_scale, MIN_COARSE_SIZE / min(th, tw)))
+            coarse_template = self.cache.get(name, scale * factor)
+            coarse_screen = self._coarse(region, coarse_screens, factor)
+            ch, cw = coarse_template.shape[:2]
+            if ch > coarse_screen.shape[0] or cw > coarse_screen.shape[1]:
+                continue
+            result = cv2.matchTemplate(
+                coarse_screen, coarse_template, cv2.TM_CCOEFF_NORMED
+            )
+            _, score, _, (cx, cy) = cv2.minMaxLoc(result)
+            candidates.append((score, scale, factor, cx, cy, template))
+
+        best = None
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        for score, scale, factor, cx, cy, template in candidates[:REFINE_CANDIDATES]:
+            th, tw = template.shape[:2]
+            if factor == 1.0:
+                x, y = cx, cy  # the coarse pass already ran at full resolution
+            else:
+                # Re-match in a window around the coarse hit at full resolution.
+                margin = int(2 / factor)
+                x0 = max(0, int(cx / factor) - margin)
+                y0 = max(0, int(cy / factor) - margin)
+                x1 = min(region_w, int(cx / factor) + tw + margin)
+                y1 = min(region_h, int(cy / factor) + th + margin)
+                window = region[y0:y1, x0:x1]
+                if window.shape[0] < th or window.shape[1] < tw:
+                    continue
+                result = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+                _, score, _, (wx, wy) = cv2.minMaxLoc(result)
+                x, y = x0 + wx, y0 + wy
+            if best is None or score > best.score:
+                best = Match(
+                    name, float(score), x + tw // 2, y + th // 2, tw, th, scale
+                )
+        return best